@@ -0,0 +1,157 @@
+"""Minimal in-process MQTT 3.1.1 broker for benchmarks, QoS 0 delivery and
+retained messages only. Not for use outside of benchmarks."""
+import socket
+import struct
+import logging
+import threading
+import socketserver
+from paho.mqtt.client import topic_matches_sub
+
+logger = logging.getLogger('odo.benchmarks.broker')
+
+def _encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+def _read_exact(sock, count):
+    data = b""
+    while len(data) < count:
+        chunk = sock.recv(count - len(data))
+        if not chunk:
+            raise ConnectionError
+        data += chunk
+    return data
+
+def _read_packet(sock):
+    header = _read_exact(sock, 1)[0]
+    length = 0
+    multiplier = 1
+    while True:
+        byte = _read_exact(sock, 1)[0]
+        length += (byte & 0x7f) * multiplier
+        multiplier *= 128
+        if not byte & 0x80:
+            break
+    return header, _read_exact(sock, length) if length else b""
+
+def _publish_packet(topic, payload, retain=False):
+    topic = topic.encode('utf-8')
+    body = struct.pack("!H", len(topic)) + topic + payload
+    return bytes([0x30 | (1 if retain else 0)]) + _encode_length(len(body)) + body
+
+class _Session(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.subscriptions = []
+        self.lock = threading.Lock()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send(self, packet):
+        with self.lock:
+            try:
+                self.request.sendall(packet)
+            except OSError:
+                pass
+
+    def handle(self):
+        broker = self.server.broker
+        try:
+            while True:
+                header, body = _read_packet(self.request)
+                kind = header >> 4
+                if kind == 1:
+                    self.send(b"\x20\x02\x00\x00")
+                    broker.add(self)
+                elif kind == 3:
+                    broker.route(header, body)
+                    if (header >> 1) & 0x03:
+                        topic_length = struct.unpack("!H", body[:2])[0]
+                        self.send(b"\x40\x02" + body[2 + topic_length:4 + topic_length])
+                elif kind == 8:
+                    packet_id = body[:2]
+                    offset = 2
+                    granted = bytearray()
+                    topics = []
+                    while offset < len(body):
+                        topic_length = struct.unpack("!H", body[offset:offset + 2])[0]
+                        topics.append(body[offset + 2:offset + 2 + topic_length].decode('utf-8'))
+                        offset += 3 + topic_length
+                        granted.append(0)
+                    self.subscriptions.extend(topics)
+                    self.send(b"\x90" + _encode_length(2 + len(granted)) + packet_id + bytes(granted))
+                    broker.send_retained(self, topics)
+                elif kind == 10:
+                    self.send(b"\xb0\x02" + body[:2])
+                elif kind == 12:
+                    self.send(b"\xd0\x00")
+                elif kind == 14:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            broker.remove(self)
+
+class Broker(object):
+    def __init__(self, host="127.0.0.1", port=0):
+        self.sessions = []
+        self.retained = {}
+        self.messages = 0
+        self._lock = threading.Lock()
+        self.server = socketserver.ThreadingTCPServer((host, port), _Session)
+        self.server.daemon_threads = True
+        self.server.broker = self
+        self.host, self.port = self.server.server_address
+        self.thread = None
+
+    def add(self, session):
+        with self._lock:
+            self.sessions.append(session)
+
+    def remove(self, session):
+        with self._lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+
+    def route(self, header, body):
+        topic_length = struct.unpack("!H", body[:2])[0]
+        topic = body[2:2 + topic_length].decode('utf-8')
+        offset = 2 + topic_length
+        if (header >> 1) & 0x03:
+            offset += 2
+        payload = body[offset:]
+        with self._lock:
+            self.messages += 1
+            if header & 0x01:
+                if payload:
+                    self.retained[topic] = payload
+                else:
+                    self.retained.pop(topic, None)
+            sessions = list(self.sessions)
+
+        packet = _publish_packet(topic, payload)
+        for session in sessions:
+            if any(topic_matches_sub(sub, topic) for sub in session.subscriptions):
+                session.send(packet)
+
+    def send_retained(self, session, topics):
+        with self._lock:
+            retained = list(self.retained.items())
+        for topic, payload in retained:
+            if any(topic_matches_sub(sub, topic) for sub in topics):
+                session.send(_publish_packet(topic, payload, retain=True))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="broker", daemon=True)
+        self.thread.start()
+        logger.debug(f"Broker listening on {self.host}:{self.port}")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,52 @@
+import timeit
+
+from odo.credentials import WiegandCredential, encode_batch
+
+class LegacyWiegandCredential(object):
+    """WiegandCredential encoders as they were before values were cached"""
+    def __init__(self, bits, hex):
+        self.bits = bits
+        self.hex = hex
+
+    def to_binary(self):
+        return bin(int(self.hex, 16))[2:].zfill(int(self.bits))
+
+    def _prox_preamble(self):
+        t = int()
+        bitnum = self.bits
+
+        if bitnum < 37:
+            t = 1 << 37
+            t = t | 1 << bitnum
+
+        for bit in self.to_binary():
+            bitnum = bitnum - 1
+            if bit == '1':
+                t = t | 1 << bitnum
+            else:
+                t = t | 0 << bitnum
+
+        return hex(t)[2:]
+
+def report(name, legacy, current, number):
+    legacy_time = min(timeit.repeat(legacy, number=number, repeat=5)) / number * 1e6
+    current_time = min(timeit.repeat(current, number=number, repeat=5)) / number * 1e6
+    print(f"{name:<24} {legacy_time:>10.2f} {current_time:>10.2f} {legacy_time / current_time:>8.1f}x")
+
+if __name__ == "__main__":
+    legacy = LegacyWiegandCredential(26, "20a7456")
+    credential = WiegandCredential(payload={"bits": 26, "hex": "20a7456"})
+    batch = [WiegandCredential(payload={"bits": 26, "hex": f"{0x20a7000 + i:x}"}) for i in range(1000)]
+    legacy_batch = [LegacyWiegandCredential(26, f"{0x20a7000 + i:x}") for i in range(1000)]
+
+    print(f"{'us per call':<24} {'legacy':>10} {'current':>10} {'speedup':>9}")
+    report("to_binary", legacy.to_binary, credential.to_binary, 100000)
+    report("_prox_preamble", legacy._prox_preamble, credential._prox_preamble, 100000)
+    report("preamble, new credential",
+           lambda: LegacyWiegandCredential(26, "20a7456")._prox_preamble(),
+           lambda: WiegandCredential(payload={"bits": 26, "hex": "20a7456"})._prox_preamble(),
+           20000)
+    report("preamble x1000 batch",
+           lambda: [c._prox_preamble() for c in legacy_batch],
+           lambda: encode_batch(batch, "preamble"),
+           100)
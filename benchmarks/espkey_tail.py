@@ -0,0 +1,78 @@
+import logging
+from time import perf_counter
+
+from espkey.reader import ESPKeyReader
+
+logging.basicConfig(level=logging.WARNING,
+                    format='%(asctime)s - [%(name)s] - %(levelname)s - %(message)s [%(threadName)s]',
+)
+
+class FakeResponse(object):
+    def __init__(self, status_code=200, content=b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers if headers is not None else {}
+
+class FakeLogSession(object):
+    """Serves an in-memory log.txt like a real webserver, honouring Range
+    headers and sending an ETag if asked to. Counts the requests it gets"""
+    def __init__(self, support_range=True, etag=True):
+        self.log = bytearray()
+        self.support_range = support_range
+        self.etag = etag
+        self.requests = 0
+
+    def append(self, timestamp, hex="20a7456", bits=26):
+        self.log += f"{timestamp} {hex}:{bits}\n".encode('utf-8')
+
+    def _headers(self):
+        return {"ETag": f'"{len(self.log)}"'} if self.etag else {}
+
+    def head(self, url, timeout=None):
+        self.requests += 1
+        return FakeResponse(200, headers={**self._headers(), "Content-Length": str(len(self.log))})
+
+    def get(self, url, headers=None, params=None, timeout=None):
+        self.requests += 1
+        headers = headers or {}
+        if self.etag and headers.get("If-None-Match") == self._headers()["ETag"]:
+            return FakeResponse(304, headers=self._headers())
+        if self.support_range and "Range" in headers:
+            start = int(headers["Range"].split('=')[1].rstrip('-'))
+            if start >= len(self.log):
+                return FakeResponse(416, headers={"Content-Range": f"bytes */{len(self.log)}"})
+            return FakeResponse(206, bytes(self.log[start:]), headers={**self._headers(), "Content-Range": f"bytes {start}-{len(self.log) - 1}/{len(self.log)}"})
+        return FakeResponse(200, bytes(self.log), headers=self._headers())
+
+def bench(tail_mode, support_range, etag, sizes=(1000, 10000, 100000), polls=200, every=10):
+    """One capture every polls, the rest of the polls find the log unchanged"""
+    print(f"tail_mode={tail_mode} server_range={support_range} etag={etag}")
+    print(f"{'lines':>8} {'us/poll':>10} {'bytes/poll':>12} {'requests/poll':>14} {'unchanged %':>12} {'captures':>9}")
+    for size in sizes:
+        session = FakeLogSession(support_range=support_range, etag=etag)
+        for ts in range(size):
+            session.append(ts)
+        esp = ESPKeyReader(tail_mode=tail_mode)
+        esp.session = session
+        esp.get_pacs_data()
+
+        esp.bytes_fetched = 0
+        esp.not_modified = 0
+        session.requests = 0
+        captures = 0
+        start = perf_counter()
+        for i in range(polls):
+            if i % every == 0:
+                session.append(size + i)
+            captures += len(esp.get_pacs_data())
+        elapsed = perf_counter() - start
+        print(f"{size:>8} {elapsed / polls * 1e6:>10.1f} {esp.bytes_fetched / polls:>12.0f} {session.requests / polls:>14.2f} {esp.not_modified / polls * 100:>12.0f} {captures:>9}")
+
+if __name__ == "__main__":
+    # Range honoured, with and without a conditional GET
+    bench("range", True, True)
+    bench("range", True, False)
+    # Range ignored, the ETag or else a HEAD size check skips idle polls
+    bench("range", False, True)
+    bench("range", False, False)
+    bench("full", True, False)
@@ -0,0 +1,108 @@
+"""Stand-in for an ESPKey's web server, serves /version and a log.txt that
+grows at a set rate. Range requests are honoured like the real device's
+webserver. Run directly to point a real Odo at it:
+
+    python -m benchmarks.fake_espkey --port 8080 --rate 1
+"""
+import json
+import time
+import logging
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger('odo.benchmarks.fake_espkey')
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send(self, code, body=b"", headers={}):
+        self.send_response(code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_GET(self):
+        espkey = self.server.espkey
+        if self.path.rstrip('/').endswith("version"):
+            self._send(200, json.dumps({"version": "fake", "ChipID": "0"}).encode('utf-8'), {"Content-Type": "application/json"})
+            return
+        if not self.path.lstrip('/').startswith(espkey.log_name):
+            self._send(404)
+            return
+
+        log = espkey.snapshot()
+        requested = self.headers.get("Range")
+        if requested is None:
+            self._send(200, log)
+            return
+        start = int(requested.split('=')[1].split('-')[0])
+        if start >= len(log):
+            self._send(416, headers={"Content-Range": f"bytes */{len(log)}"})
+            return
+        self._send(206, log[start:], {"Content-Range": f"bytes {start}-{len(log) - 1}/{len(log)}"})
+
+    do_HEAD = do_GET
+
+class FakeESPKey(object):
+    def __init__(self, host="127.0.0.1", port=0, log_name="log.txt"):
+        self.log_name = log_name
+        self.log = bytearray()
+        self.appended = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.espkey = self
+        self.host, self.port = self.server.server_address
+        self.url = f"http://{self.host}:{self.port}/"
+
+    def snapshot(self):
+        with self._lock:
+            return bytes(self.log)
+
+    def append(self, hex, bits=26):
+        """Adds a capture to the log, returns the time it landed"""
+        with self._lock:
+            timestamp = len(self.appended) + 1
+            self.log += f"{timestamp} {hex}:{bits}\n".encode('utf-8')
+            self.appended[hex] = time.perf_counter()
+            return self.appended[hex]
+
+    def produce(self, count, rate, first=0x20a7000, bits=26):
+        """Appends count unique credentials on a fixed schedule of rate per second"""
+        start = time.perf_counter()
+        for i in range(count):
+            delay = start + i / rate - time.perf_counter()
+            if self._stop.wait(max(delay, 0)):
+                return
+            self.append(f"{first + i:x}", bits)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-espkey", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--rate", type=float, default=1, help="captures per second")
+    parser.add_argument("--count", type=int, default=100)
+    args = parser.parse_args()
+    espkey = FakeESPKey(host="0.0.0.0", port=args.port).start()
+    print(f"Serving {espkey.url}{espkey.log_name}")
+    try:
+        espkey.produce(args.count, args.rate)
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        espkey.stop()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Stand-in for the pm3 client wrapper, answers the commands Odo sends with
+canned output after a configurable delay. Point the proxmark3 module's
+`command` option at this file to run without hardware.
+
+FAKE_PM3_DELAY      seconds per write/read command (default 0.5)
+FAKE_PM3_STARTUP    seconds before the first prompt (default 0)
+FAKE_PM3_FAIL       fraction of iclass writes that fail a block (default 0)
+"""
+import os
+import sys
+import random
+from time import sleep
+
+prompt = "[usb] pm3 --> "
+delay = float(os.environ.get("FAKE_PM3_DELAY", 0.5))
+startup = float(os.environ.get("FAKE_PM3_STARTUP", 0))
+fail_rate = float(os.environ.get("FAKE_PM3_FAIL", 0))
+
+def out(text=""):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+def iclass_encode(args):
+    sleep(delay)
+    failed = random.random() < fail_rate
+    out("[=] encoding legacy credential\n")
+    for block in (6, 7, 8):
+        if failed and block == 8:
+            out(f"[-] Write block {block}/0x{block:02x} ( \x1b[31mfail\x1b[0m )\n")
+        else:
+            out(f"[+] Write block {block}/0x{block:02x} ( \x1b[32mok\x1b[0m )\n")
+
+def main():
+    port = None
+    if "-p" in sys.argv:
+        port = sys.argv[sys.argv.index("-p") + 1]
+    sleep(startup)
+    out(f"[=] Using UART port {port}\n[=] Communicating with PM3 over USB-CDC\n")
+    out(prompt)
+
+    cloned = None
+    for line in sys.stdin:
+        command = line.strip()
+        if command in ("quit", "exit", "q"):
+            break
+        elif command.startswith("hf iclass encode"):
+            iclass_encode(command.split())
+        elif command.startswith("lf hid clone"):
+            sleep(delay)
+            cloned = command.split()[-1]
+            out(f"[=] Preparing to clone HID tag using raw {cloned}\n[+] Done\n")
+        elif command.startswith("lf hid reader"):
+            sleep(delay)
+            if cloned is not None:
+                out(f"[+] [H10301  ] HID H10301 26-bit\n[=] raw: {cloned.zfill(24)}\n")
+        elif command:
+            out(f"[!] Unknown command: {command}\n")
+        out(prompt)
+
+if __name__ == "__main__":
+    main()
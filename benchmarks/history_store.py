@@ -0,0 +1,57 @@
+"""Cost of recording credential events in the history store and of paging
+through them, first page against one deep in the history"""
+import os
+import argparse
+import tempfile
+from time import perf_counter
+
+from history.store import CredentialStore
+
+def fill(store, count, batch):
+    """Appends count seen events from 8 readers over count / 4 credentials,
+    committing every batch. Returns seconds per event"""
+    started = perf_counter()
+    for i in range(count):
+        store.append("seen", {"bits": 26, "hex": f"{0x20a7000 + i % (count // 4 or 1):x}", "source": f"door{i % 8}", "trace": {"id": f"{i:032x}", "stages": {}}}, timestamp=1.6e9 + i)
+        if i % batch == batch - 1:
+            store.commit()
+    store.commit()
+    return (perf_counter() - started) / count
+
+def page_times(store, pages, **query):
+    """Seconds for the first page and the last of pages walked with before"""
+    before = None
+    times = []
+    for i in range(pages):
+        started = perf_counter()
+        events, before = store.query(before=before, **query)
+        times.append(perf_counter() - started)
+        if before is None:
+            break
+    return times[0], times[-1], i + 1
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=100000, help="events to record")
+    parser.add_argument("--batch", type=int, default=256, help="events per commit")
+    parser.add_argument("--pages", type=int, default=100, help="pages to walk")
+    parser.add_argument("--limit", type=int, default=50, help="events per page")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = CredentialStore(os.path.join(directory, "history.db"))
+        store.open()
+        append = fill(store, args.count, args.batch)
+        print(f"{args.count} events, {append * 1e6:.1f} us each committing every {args.batch}, {os.path.getsize(store.path) / 2**20:.1f} MiB")
+        print(f"{'query':<24} {'first ms':>9} {'last ms':>9} {'page':>6}")
+        for name, query in (
+                ("all", {}),
+                ("source", {"source": "door3"}),
+                ("credential", {"hex": "20a7010", "bits": 26}),
+                ("unique", {"unique": True})):
+            first, last, page = page_times(store, args.pages, limit=args.limit, **query)
+            print(f"{name:<24} {first * 1000:>9.2f} {last * 1000:>9.2f} {page:>6}")
+        store.close()
+
+if __name__ == "__main__":
+    main()
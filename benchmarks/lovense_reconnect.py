@@ -0,0 +1,252 @@
+"""Lovense reconnect time and multi-toy fan-out against a fake bleak backend.
+Toys advertise and answer commands like the real thing, with latencies from
+ble_timing, and can be taken out of range and brought back. The old scan,
+connect and sleep cycle is replayed against the same backend for comparison."""
+import os
+import logging
+import asyncio
+import tempfile
+import argparse
+from time import perf_counter
+
+import lovense
+import lovense.device
+from lovense import Lovense
+from lovense.patterns import error
+
+logging.basicConfig(level=logging.WARNING,
+                    format='%(asctime)s - [%(name)s] - %(levelname)s - %(message)s [%(threadName)s]',
+)
+
+# Seconds, roughly what a toy next to the adapter does
+ble_timing = {
+    "advertising_interval": 0.1,
+    "connect": 0.4,
+    "reply": 0.02
+}
+
+replies = {
+    "DeviceType": "C:11:0082059AD3BD;",
+    "GetBatch": "220103;",
+    "Battery": "85;"
+}
+
+class FakeDevice(object):
+    def __init__(self, address, name):
+        self.address = address
+        self.name = name
+
+    def __repr__(self):
+        return f"{self.address}: {self.name}"
+
+class FakeAdvertisement(object):
+    def __init__(self, local_name):
+        self.local_name = local_name
+
+class FakeRadio(object):
+    """Toys in range of the adapter"""
+    def __init__(self):
+        self.toys = {}
+        self.clients = []
+
+        self.writes = []
+
+    def add(self, address, name, present=True, write_latency=0):
+        self.toys[address] = {"device": FakeDevice(address, name), "present": present, "write_latency": write_latency}
+
+    def present(self, address):
+        return address in self.toys and self.toys[address]["present"]
+
+    def leave(self, address):
+        """Takes a toy out of range, dropping any connection to it"""
+        self.toys[address]["present"] = False
+        for client in list(self.clients):
+            if client.address == address and client.is_connected:
+                client.drop()
+
+    def enter(self, address):
+        self.toys[address]["present"] = True
+
+    async def advertisements(self):
+        """Yields every toy in range each advertising interval"""
+        while True:
+            await asyncio.sleep(ble_timing["advertising_interval"])
+            for toy in list(self.toys.values()):
+                if toy["present"]:
+                    yield toy["device"]
+
+radio = FakeRadio()
+
+class FakeScanner(object):
+    @staticmethod
+    async def find_device_by_filter(filterfunc, timeout=10.0, **kwargs):
+        async def first():
+            async for device in radio.advertisements():
+                if filterfunc(device, FakeAdvertisement(device.name)):
+                    return device
+        try:
+            return await asyncio.wait_for(first(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    @staticmethod
+    async def discover(timeout=5.0, **kwargs):
+        await asyncio.sleep(timeout)
+        return [toy["device"] for toy in radio.toys.values() if toy["present"]]
+
+class FakeClient(object):
+    """Connects to an address string the way bluez does, by waiting up to
+    timeout for the toy to advertise"""
+    def __init__(self, address_or_ble_device, disconnected_callback=None, services=None, timeout=30, **kwargs):
+        self.address = getattr(address_or_ble_device, "address", address_or_ble_device)
+        self.disconnected_callback = disconnected_callback
+        self.timeout = timeout
+        self.is_connected = False
+        self.notify = None
+
+    async def __aenter__(self):
+        started = perf_counter()
+        while not radio.present(self.address):
+            if perf_counter() - started >= self.timeout:
+                raise lovense.BleakError(f"Device with address {self.address} was not found")
+            await asyncio.sleep(ble_timing["advertising_interval"])
+        await asyncio.sleep(ble_timing["connect"])
+        self.is_connected = True
+        radio.clients.append(self)
+        return self
+
+    async def __aexit__(self, *args):
+        await self.disconnect()
+
+    def drop(self):
+        self.is_connected = False
+        if self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+
+    async def disconnect(self):
+        self.is_connected = False
+        if self in radio.clients:
+            radio.clients.remove(self)
+
+    async def start_notify(self, char, callback):
+        self.notify = callback
+
+    async def stop_notify(self, char):
+        self.notify = None
+
+    async def write_gatt_char(self, char, data, response=False):
+        if not self.is_connected:
+            raise lovense.BleakError("Not connected")
+        radio.writes.append((perf_counter(), self.address, data.decode()))
+        command = data.decode().split(':')[0].rstrip(';')
+        reply = replies.get(command, "OK;")
+        # A toy far from the adapter or busy retransmitting
+        await asyncio.sleep(radio.toys[self.address]["write_latency"])
+        if response:
+            await asyncio.sleep(ble_timing["reply"])
+        asyncio.get_running_loop().call_later(ble_timing["reply"], self._reply, reply)
+
+    def _reply(self, reply):
+        if self.notify is not None and self.is_connected:
+            self.notify(0, bytearray(reply, encoding="UTF-8"))
+
+class NullMqttClient(object):
+    def publish(self, topic, payload, retain=False, **kwargs):
+        pass
+
+    def disconnect(self):
+        pass
+
+async def legacy_reconnect(away):
+    """The old cycle after a drop: the write error cancels the session, sleeps
+    3s and 5s, then a full 5s discover before connecting"""
+    started = perf_counter()
+    await asyncio.sleep(3)
+    await asyncio.sleep(5)
+    while True:
+        devices = await FakeScanner.discover()
+        for d in devices:
+            if str(d.name).startswith("LVS-"):
+                async with FakeClient(d):
+                    return perf_counter() - started
+        await asyncio.sleep(3)
+
+async def wait_connected(lvs, address, connects, timeout=30):
+    """Waits for a toy's connects'th connection to finish asking it what it is"""
+    deadline = perf_counter() + timeout
+    while True:
+        device = lvs.devices.get(address)
+        if device is not None and device._ble_connects.get() >= connects and device.pipeline is not None and device.pipeline.matched >= 2:
+            return device.state.reconnect_time
+        if perf_counter() > deadline:
+            raise TimeoutError(f"{address} not connected after {timeout}s")
+        await asyncio.sleep(0.01)
+
+async def fan_out(lvs):
+    """One failure pattern to every toy, seconds until each one finished it"""
+    await asyncio.sleep(1.5)
+    started = perf_counter()
+    first = len(radio.writes)
+    await lvs.vibe_pattern(error, event="written/failure")
+    finished = {}
+    for when, address, command in radio.writes[first:]:
+        finished[address] = when - started
+    return finished
+
+async def scenarios(lvs, away):
+    results = []
+    scanner = asyncio.ensure_future(lvs.scanner())
+
+    results.append(("cold start, nothing cached", await wait_connected(lvs, "AA:00:00:00:00:01", 1)))
+
+    radio.leave("AA:00:00:00:00:01")
+    await asyncio.sleep(away)
+    radio.enter("AA:00:00:00:00:01")
+    results.append((f"toy back after {away}s, cached address", await wait_connected(lvs, "AA:00:00:00:00:01", 2)))
+
+    radio.leave("AA:00:00:00:00:01")
+    radio.add("AA:00:00:00:00:02", "LVS-Spare", write_latency=0.3)
+    results.append(("second toy while the first is away, from being found by scan", await wait_connected(lvs, "AA:00:00:00:00:02", 1)))
+
+    radio.enter("AA:00:00:00:00:01")
+    await wait_connected(lvs, "AA:00:00:00:00:01", 3)
+    finished = await fan_out(lvs)
+
+    lvs._cleanup()
+    await scanner
+    return results, finished
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--away", type=float, default=0.5, help="Seconds the toy is out of range")
+    parser.add_argument("--cached-timeout", type=float, default=1, help="Direct connect timeout for the cached address")
+    parser.add_argument("--skip-legacy", action="store_true", help="Don't replay the old cycle, it takes about 15s")
+    args = parser.parse_args()
+
+    lovense.device.BleakClient = FakeClient
+    lovense.BleakScanner = FakeScanner
+    radio.add("AA:00:00:00:00:01", "LVS-Lush")
+
+    cache = os.path.join(tempfile.mkdtemp(), "lovense_device.json")
+    lvs = Lovense(device_cache=cache, cached_timeout=args.cached_timeout)
+    lvs.mqtt_client = NullMqttClient()
+    results, finished = lvs.event_loop.run_until_complete(scenarios(lvs, args.away))
+
+    print(f"{'scenario':<62} {'reconnect s':>12}")
+    for name, seconds in results:
+        print(f"{name:<62} {seconds:>12.2f}")
+    for address, device in lvs.devices.items():
+        print(f"{address} connects by path: cached {device._ble_connect_paths['cached'].get()} scan {device._ble_connect_paths['scan'].get()}")
+
+    print(f"\n'error' pattern ({sum(duration for command, duration in error):.1f}s) fanned out to both toys, the spare takes 300ms per write")
+    for address, seconds in sorted(finished.items()):
+        print(f"{address} last write after {seconds:.2f}s")
+
+    if not args.skip_legacy:
+        radio.add("AA:00:00:00:00:01", "LVS-Lush")
+        seconds = lvs.event_loop.run_until_complete(legacy_reconnect(args.away))
+        print(f"{'old scan and sleep cycle, toy back after ' + str(args.away) + 's':<62} {seconds:>12.2f}")
+    lvs.event_loop.close()
+
+if __name__ == "__main__":
+    main()
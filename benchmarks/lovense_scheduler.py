@@ -0,0 +1,166 @@
+"""Lovense pattern scheduler timing. The scheduler runs against a virtual clock
+with simulated BLE write latency so results are exact and repeatable, then
+event loop stalls are compared with the old blocking vibe_pattern in real time."""
+import time
+import heapq
+import random
+import asyncio
+import itertools
+
+from lovense.scheduler import PatternScheduler
+from lovense.patterns import foho, error, vibe_off, event_priorities
+
+class VirtualClock(object):
+    """Time only moves when every task is waiting on it"""
+    def __init__(self):
+        self.time = 0.0
+        self.timers = []
+        self._seq = itertools.count()
+
+    def now(self):
+        return self.time
+
+    async def sleep_until(self, deadline):
+        if deadline <= self.time:
+            await asyncio.sleep(0)
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.timers, (deadline, next(self._seq), future))
+        await future
+
+    async def sleep(self, seconds):
+        await self.sleep_until(self.time + seconds)
+
+    async def run_until(self, end):
+        while True:
+            for i in range(20):
+                await asyncio.sleep(0)
+            while self.timers and self.timers[0][2].done():
+                heapq.heappop(self.timers)
+            if not self.timers or self.timers[0][0] > end:
+                self.time = max(self.time, end)
+                return
+            deadline, seq, future = heapq.heappop(self.timers)
+            self.time = deadline
+            future.set_result(None)
+
+class FakeToy(object):
+    """Records each command with its virtual time, writes take latency seconds"""
+    def __init__(self, clock, latency=(0.005, 0.04), seed=1):
+        self.clock = clock
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.writes = []
+
+    async def write(self, command):
+        self.writes.append((self.clock.now(), command))
+        await self.clock.sleep(self.random.uniform(*self.latency))
+
+async def legacy_play(toy, clock, pattern):
+    """vibe_pattern's timing, each step sleeps its duration after the write returns"""
+    for command, duration in pattern:
+        await toy.write(command)
+        await clock.sleep(duration)
+    await toy.write(vibe_off)
+
+def pattern_length(pattern):
+    return sum(duration for command, duration in pattern)
+
+async def drift(latency, repeats=200):
+    """How far the end of each pattern lands from where it should"""
+    results = {}
+    for name in ("legacy", "scheduler"):
+        clock = VirtualClock()
+        toy = FakeToy(clock, latency=latency)
+        scheduler = PatternScheduler(toy.write, clock=clock)
+        errors = []
+        for i in range(repeats):
+            start = clock.now()
+            if name == "legacy":
+                task = asyncio.ensure_future(legacy_play(toy, clock, error))
+            else:
+                task = scheduler.submit("written/failure", error)
+            while not task.done():
+                await clock.run_until(clock.now() + 0.01)
+            errors.append(toy.writes[-1][0] - start - pattern_length(error))
+        errors.sort()
+        results[name] = (errors[len(errors) // 2], errors[-1])
+    return results, scheduler.stats()
+
+async def burst(events=20, spacing=0.02):
+    """A burst of seen events while one is already buzzing"""
+    clock = VirtualClock()
+    toy = FakeToy(clock)
+    scheduler = PatternScheduler(toy.write, clock=clock, priorities=event_priorities)
+    for i in range(events):
+        scheduler.submit("seen", foho)
+        await clock.run_until(clock.now() + spacing)
+    await clock.run_until(clock.now() + 5)
+    return scheduler.stats(), toy.writes[-1][0]
+
+async def preemption(at=0.15):
+    """A failed write arriving part way through a seen pattern"""
+    clock = VirtualClock()
+    toy = FakeToy(clock, latency=(0.01, 0.01))
+    scheduler = PatternScheduler(toy.write, clock=clock, priorities=event_priorities)
+    scheduler.submit("seen", foho)
+    await clock.run_until(at)
+    scheduler.submit("written/failure", error)
+    await clock.run_until(at + 2)
+    first_error = next(when for when, command in toy.writes if when >= at and command == error[0][0])
+    return first_error - at, scheduler.stats()
+
+async def loop_stall(blocking, patterns=5):
+    """Worst delay seen by a 10ms ticker standing in for BLE notifications"""
+    async def write(command):
+        await asyncio.sleep(0)
+
+    async def blocking_play(pattern):
+        for command, duration in pattern:
+            await write(command)
+            time.sleep(duration)
+
+    worst = 0.0
+    running = True
+
+    async def ticker():
+        nonlocal worst
+        while running:
+            before = time.perf_counter()
+            await asyncio.sleep(0.01)
+            worst = max(worst, time.perf_counter() - before - 0.01)
+
+    tick = asyncio.ensure_future(ticker())
+    scheduler = PatternScheduler(write)
+    for i in range(patterns):
+        if blocking:
+            await blocking_play(foho)
+        else:
+            await scheduler.submit(i, foho)
+    running = False
+    await tick
+    return worst
+
+def main():
+    loop = asyncio.new_event_loop()
+    for latency in ((0.005, 0.04), (0.05, 0.3)):
+        results, stats = loop.run_until_complete(drift(latency))
+        print(f"Pattern end error, 'error' pattern with {latency[0] * 1000:.0f}-{latency[1] * 1000:.0f}ms simulated BLE writes (virtual clock)")
+        print(f"{'':<10} {'p50 ms':>8} {'max ms':>8}")
+        for name, (p50, worst) in results.items():
+            print(f"{name:<10} {p50 * 1000:>8.1f} {worst * 1000:>8.1f}")
+        print(f"scheduler step jitter p50 {stats['jitter_p50'] * 1000:.1f}ms max {stats['jitter_max'] * 1000:.1f}ms\n")
+
+    stats, elapsed = loop.run_until_complete(burst())
+    print(f"20 seen events 20ms apart: played {stats['played']} merged {stats['merged']}, last write at {elapsed:.2f}s")
+
+    latency, stats = loop.run_until_complete(preemption())
+    print(f"failure during seen: first failure step after {latency * 1000:.1f}ms, preempted {stats['preempted']}")
+
+    print(f"\nWorst event loop stall over 5 patterns (real time)")
+    print(f"blocking vibe_pattern {loop.run_until_complete(loop_stall(True)) * 1000:>8.1f} ms")
+    print(f"scheduler             {loop.run_until_complete(loop_stall(False)) * 1000:>8.1f} ms")
+    loop.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import time
+import logging
+import threading
+import statistics
+import paho.mqtt.client as mqtt
+
+from odo.models import BaseMqttDeviceModel
+from .broker import Broker
+
+logging.basicConfig(level=logging.WARNING,
+                    format='%(asctime)s - [%(name)s] - %(levelname)s - %(message)s [%(threadName)s]',
+)
+
+topic = "benchmarks/ping"
+
+class LatencyModule(BaseMqttDeviceModel):
+    """Records how long each ping took to reach its handler"""
+    def __init__(self, *args, **kwargs):
+        super(LatencyModule, self).__init__(*args, **kwargs)
+        self._subscribe_topics = [topic]
+        self.latencies = []
+        self.connected = threading.Event()
+
+    def _subscribe(self):
+        super(LatencyModule, self)._subscribe()
+        self.connected.set()
+
+    def _on_message(self, client, userdata, msg):
+        self.latencies.append(time.perf_counter() - float(msg.payload))
+
+class PumpedModule(LatencyModule):
+    """The previous runtime, the module thread pumps loop() itself with an optional sleep in between"""
+    def __init__(self, pause=0, *args, **kwargs):
+        super(PumpedModule, self).__init__(*args, **kwargs)
+        self.pause = pause
+
+    def run(self):
+        self.mqtt_client = self._create_mqtt_client()
+        self.running = True
+        self.loop()
+
+    def loop(self):
+        while self.running:
+            self.mqtt_client.loop()
+            if self.pause:
+                time.sleep(self.pause)
+
+    def terminate(self):
+        self.running = False
+        self.join()
+        self.mqtt_client.disconnect()
+
+def bench(module, port, idle=5, pings=100, spacing=0.02):
+    module.start()
+    module.connected.wait(10)
+
+    # Idle CPU, the broker is idle too so the process total is the module's
+    cpu = time.process_time()
+    time.sleep(idle)
+    idle_cpu = (time.process_time() - cpu) / idle * 100
+
+    sender = mqtt.Client()
+    sender.connect("127.0.0.1", port)
+    sender.loop_start()
+    for i in range(pings):
+        sender.publish(topic, repr(time.perf_counter()))
+        time.sleep(spacing)
+    time.sleep(1.5)
+    sender.loop_stop()
+    sender.disconnect()
+    module.terminate()
+
+    latencies = sorted(module.latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else float("nan")
+    return idle_cpu, len(latencies), statistics.median(latencies) * 1000, p99 * 1000
+
+if __name__ == "__main__":
+    broker = Broker().start()
+    runtimes = (
+        ("pumped loop()", lambda: PumpedModule(mqtt_host="127.0.0.1", mqtt_port=broker.port)),
+        ("pumped loop() + 0.5s sleep", lambda: PumpedModule(pause=0.5, mqtt_host="127.0.0.1", mqtt_port=broker.port)),
+        ("network thread", lambda: LatencyModule(mqtt_host="127.0.0.1", mqtt_port=broker.port))
+    )
+    print(f"{'runtime':<28} {'idle cpu %':>10} {'received':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, create in runtimes:
+        idle_cpu, received, p50, p99 = bench(create(), broker.port)
+        print(f"{name:<28} {idle_cpu:>10.2f} {received:>9} {p50:>8.2f} {p99:>8.2f}")
+    broker.stop()
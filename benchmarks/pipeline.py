@@ -0,0 +1,137 @@
+"""End to end credential pipeline benchmark. Runs the real ESPKey and Proxmark3
+modules against a local broker, a fake ESPKey and the fake pm3 client, and
+times each credential from landing in log.txt to being reported written.
+
+    python -m benchmarks.pipeline --count 30 --rate 2 --devices 1 --delay 0.2
+"""
+import os
+import time
+import logging
+import argparse
+import threading
+import statistics
+import paho.mqtt.client as mqtt
+
+from espkey import ESPKey
+from proxmark3 import Proxmark3
+from odo.serialization import decode
+from .broker import Broker
+from .fake_espkey import FakeESPKey
+from .proxmark3_pool import fake_pm3
+
+logging.basicConfig(level=logging.WARNING,
+                    format='%(asctime)s - [%(name)s] - %(levelname)s - %(message)s [%(threadName)s]',
+)
+
+class Observer(object):
+    """Watches the credential topics and notes when each credential reaches them"""
+    def __init__(self, port, expected):
+        self.seen = {}
+        self.written = {}
+        self.failed = 0
+        self.progress = time.perf_counter()
+        self.expected = expected
+        self.done = threading.Event()
+        self.client = mqtt.Client()
+        self.client.on_message = self._on_message
+        self.client.connect("127.0.0.1", port)
+        self.client.subscribe("credentials/seen")
+        self.client.subscribe("credentials/written")
+        self.client.loop_start()
+
+    def _on_message(self, client, userdata, msg):
+        now = time.perf_counter()
+        self.progress = now
+        payload = decode(msg.payload)["payload"]
+        if msg.topic == "credentials/seen":
+            self.seen.setdefault(payload["hex"], now)
+        elif payload.get("status") not in (None, "pending"):
+            self.written.setdefault(payload["hex"], now)
+            if payload["status"] != "success":
+                self.failed += 1
+            if len(self.written) >= self.expected:
+                self.done.set()
+
+    def wait(self, idle):
+        """Waits for every credential, or until nothing has moved for idle seconds"""
+        while not self.done.wait(0.5):
+            if time.perf_counter() - self.progress > idle:
+                return
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def run(count, rate, devices, delay, poll_interval, wire_format, idle):
+    os.environ["FAKE_PM3_DELAY"] = str(delay)
+    broker = Broker().start()
+    espkey = FakeESPKey().start()
+    observer = Observer(broker.port, count)
+
+    module_config = {"mqtt_host": "127.0.0.1", "mqtt_port": broker.port, "wire_format": wire_format}
+    pm3 = Proxmark3(ports=[f"/dev/fake{i}" for i in range(devices)], command=fake_pm3, mode="seen", queue_size=count, **module_config)
+    esp = ESPKey(url=espkey.url, poll_interval=poll_interval, poll_interval_min=min(0.25, poll_interval), **module_config)
+    pm3.start()
+    while any(device.status != "connected" for device in pm3.devices):
+        time.sleep(0.05)
+    esp.start()
+    while esp.readers[0].session is None:
+        time.sleep(0.05)
+
+    start = time.perf_counter()
+    espkey.produce(count, rate)
+    observer.wait(idle)
+    elapsed = max(observer.written.values(), default=time.perf_counter()) - start
+
+    esp.terminate()
+    pm3.terminate()
+    esp.join(5)
+    pm3.join(5)
+    observer.close()
+    espkey.stop()
+    broker.stop()
+
+    capture = [observer.written[hex] - espkey.appended[hex] for hex in observer.written]
+    seen = [observer.written[hex] - observer.seen[hex] for hex in observer.written if hex in observer.seen]
+    return {
+        "written": len(observer.written),
+        "lost": count - len(observer.written),
+        "failed": observer.failed,
+        "throughput": len(observer.written) / elapsed if elapsed > 0 else 0,
+        "capture_p50": percentile(capture, 0.5),
+        "capture_p99": percentile(capture, 0.99),
+        "seen_p50": percentile(seen, 0.5),
+        "seen_p99": percentile(seen, 0.99)
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=30, help="credentials per run")
+    parser.add_argument("--rate", type=float, default=2, help="captures per second")
+    parser.add_argument("--devices", type=int, default=1, help="fake Proxmark3s")
+    parser.add_argument("--delay", type=float, default=0.2, help="fake pm3 seconds per command")
+    parser.add_argument("--poll-interval", type=float, default=1, help="ESPKey poll_interval")
+    parser.add_argument("--wire-format", default="json")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--idle", type=float, default=10, help="seconds without progress before giving up on lost credentials")
+    args = parser.parse_args()
+
+    print(f"{args.count} credentials at {args.rate}/s, {args.devices} device(s), pm3 delay {args.delay}s, poll {args.poll_interval}s, {args.wire_format}")
+    print(f"{'run':>4} {'written':>8} {'lost':>5} {'failed':>7} {'cred/s':>7} {'capture p50':>12} {'p99':>7} {'seen p50':>9} {'p99':>7}")
+    results = []
+    for i in range(args.repeat):
+        result = run(args.count, args.rate, args.devices, args.delay, args.poll_interval, args.wire_format, args.idle)
+        results.append(result)
+        print(f"{i + 1:>4} {result['written']:>8} {result['lost']:>5} {result['failed']:>7} {result['throughput']:>7.2f} "
+              f"{result['capture_p50']:>12.3f} {result['capture_p99']:>7.3f} {result['seen_p50']:>9.3f} {result['seen_p99']:>7.3f}")
+
+    if args.repeat > 1:
+        median = {key: statistics.median(result[key] for result in results) for key in results[0]}
+        print(f"{'med':>4} {median['written']:>8.0f} {median['lost']:>5.0f} {median['failed']:>7.0f} {median['throughput']:>7.2f} "
+              f"{median['capture_p50']:>12.3f} {median['capture_p99']:>7.3f} {median['seen_p50']:>9.3f} {median['seen_p99']:>7.3f}")
@@ -0,0 +1,59 @@
+import os
+import json
+import logging
+import threading
+from time import perf_counter, sleep
+
+from proxmark3 import Proxmark3
+from espkey.models import ESPKeyCredential
+
+logging.basicConfig(level=logging.WARNING,
+                    format='%(asctime)s - [%(name)s] - %(levelname)s - %(message)s [%(threadName)s]',
+)
+
+fake_pm3 = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fake_pm3.py")
+
+class CountingMqttClient(object):
+    """Counts finished writes instead of talking to a broker"""
+    def __init__(self):
+        self.written = 0
+        self.done = threading.Event()
+        self.expected = 0
+
+    def publish(self, topic, payload, retain=False, **kwargs):
+        if topic == "credentials/written" and json.loads(payload)["payload"]["status"] != "pending":
+            self.written += 1
+            if self.written >= self.expected:
+                self.done.set()
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+def bench(devices, jobs=12, target="iclass"):
+    pm3 = Proxmark3(ports=[f"/dev/fake{i}" for i in range(devices)], command=fake_pm3, target=target, queue_size=jobs)
+    pm3.mqtt_client = CountingMqttClient()
+    pm3.mqtt_client.expected = jobs
+    pm3.state.payload.mode = "seen"
+    pm3.running = True
+    threading.Thread(target=pm3.loop, daemon=True).start()
+    while any(device.status != "connected" for device in pm3.devices):
+        sleep(0.1)
+
+    start = perf_counter()
+    for i in range(jobs):
+        pm3._queue_write(ESPKeyCredential(payload={"bits": 26, "hex": f"{0x20a7000 + i:x}"}), "seen")
+    pm3.mqtt_client.done.wait()
+    elapsed = perf_counter() - start
+    pm3.terminate()
+    return elapsed
+
+if __name__ == "__main__":
+    jobs = 12
+    print(f"FAKE_PM3_DELAY={os.environ.get('FAKE_PM3_DELAY', 0.5)}s {jobs} iclass writes")
+    print(f"{'devices':>8} {'seconds':>8} {'writes/s':>9}")
+    for devices in (1, 2, 3):
+        elapsed = bench(devices, jobs=jobs)
+        print(f"{devices:>8} {elapsed:>8.2f} {jobs / elapsed:>9.2f}")
@@ -0,0 +1,36 @@
+import json
+import timeit
+
+from espkey.models import ESPKeyCredential
+from proxmark3.models import Proxmark3StateModel
+from odo.models import MqttApiModel
+from odo.serialization import encoders
+
+def _reflect(o):
+    if isinstance(o, MqttApiModel):
+        return {"version": o.version, "type": o.type, "payload": o.payload}
+    if hasattr(o, "_fields"):
+        return {field: getattr(o, field) for field in o._fields}
+    return o.__dict__
+
+def legacy_to_json(model):
+    """to_json as it was, each nested object reflected on through json's default hook"""
+    return json.dumps(model, default=_reflect)
+
+def report(name, model, number=50000):
+    legacy_time = min(timeit.repeat(lambda: legacy_to_json(model), number=number, repeat=5)) / number * 1e6
+    print(f"{name:<12} {'legacy json':<12} {legacy_time:>8.2f} {len(legacy_to_json(model)):>6}")
+    for wire_format in encoders:
+        encode_time = min(timeit.repeat(lambda: model.encode(wire_format), number=number, repeat=5)) / number * 1e6
+        payload = model.encode(wire_format)
+        decode_time = min(timeit.repeat(lambda: type(model).decode(payload), number=number, repeat=5)) / number * 1e6
+        print(f"{name:<12} {wire_format:<12} {encode_time:>8.2f} {len(payload):>6} {decode_time:>10.2f}")
+
+if __name__ == "__main__":
+    credential = ESPKeyCredential(payload={"bits": 26, "hex": "20a7456", "timestamp": 1234567, "source": "espkey.local"})
+    state = Proxmark3StateModel()
+    state.payload.devices = [{"port": "/dev/ttyACM0", "target": "iclass", "status": "connected", "writes": 12}]
+
+    print(f"{'model':<12} {'format':<12} {'us/enc':>8} {'bytes':>6} {'us/dec':>10}")
+    report("credential", credential)
+    report("state", state)
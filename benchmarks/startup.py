@@ -0,0 +1,44 @@
+"""Startup cost of each module in a fresh interpreter, importing every module
+up front as main.py used to against importing only the one enabled through
+the plugin registry."""
+import sys
+import json
+import subprocess
+
+from odo.plugins import builtin_modules
+
+child = """
+import json
+from time import perf_counter
+started = perf_counter()
+from odo.plugins import PluginRegistry, resident_memory
+{imports}
+print(json.dumps({{"seconds": perf_counter() - started, "memory": resident_memory()}}))
+"""
+
+eager = """
+from espkey import ESPKey
+from proxmark3 import Proxmark3
+from screen_ws13 import Screen
+from lovense import Lovense
+"""
+
+def measure(imports, repeat=5):
+    """Best of repeat fresh interpreters"""
+    runs = []
+    for i in range(repeat):
+        output = subprocess.run([sys.executable, "-c", child.format(imports=imports)], capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return min(run["seconds"] for run in runs), min(run["memory"] for run in runs)
+
+def main():
+    core_seconds, core_memory = measure("")
+    eager_seconds, eager_memory = measure(eager)
+    print(f"{'enabled':<12} {'import all ms':>14} {'lazy ms':>9} {'import all MiB':>15} {'lazy MiB':>9}")
+    for name in builtin_modules:
+        seconds, memory = measure(f"PluginRegistry().load({name!r})")
+        print(f"{name:<12} {eager_seconds * 1000:>14.0f} {seconds * 1000:>9.0f} {eager_memory / 2**20:>15.1f} {memory / 2**20:>9.1f}")
+    print(f"core only {core_seconds * 1000:.0f} ms, {core_memory / 2**20:.1f} MiB")
+
+if __name__ == "__main__":
+    main()
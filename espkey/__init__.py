@@ -1,109 +1,138 @@
 import requests
-import sys
-import re
-from time import sleep
 import logging
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
 
 logging.getLogger('odo.espkey')
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 from odo.models import BaseMqttDeviceModel
-from .models import ESPKeyStateModel, ESPKeyCredential
+from odo.credentials import DedupCache
+from .models import ESPKeyStateModel
+from .reader import ESPKeyReader
+from odo.tracing import stamp
 
 class ESPKey(BaseMqttDeviceModel):
-    def __init__(self, url="http://espkey.local/", log="log.txt", poll_interval=1, *args, **kwargs):
+    def __init__(self, url="http://espkey.local/", log="log.txt", poll_interval=1, poll_interval_min=0.25, poll_interval_max=None, poll_backoff=1.5, stats_interval=60, tail_mode="range", seen_max=4096, seen_max_age=86400, timeout=5, hosts=None, dedup_window=60, dedup_max=1024, *args, **kwargs):
         super(ESPKey, self).__init__(*args, **kwargs)
         self.logger = logging.getLogger('odo.espkey.ESPKey')
-        self.url = url
-        self.logfile = log
-        self.session = None
-        self.session_retry = True
         self.poll_interval = poll_interval
+        self.poll_interval_min = min(poll_interval_min, poll_interval)
+        self.poll_interval_max = poll_interval_max if poll_interval_max is not None else poll_interval
+        self.poll_backoff = poll_backoff
+        self.stats_interval = stats_interval
+        self.session_retry_min = 1
+        self.session_retry_interval = 10
         self.state = ESPKeyStateModel()
-        self.credentials = []
-        self.latest_credential = ESPKeyCredential()
-    
-    def _create_session(self):
-        s = requests.Session()
-        got_session = False
-        while self.session_retry:
-            try:
-                resp = s.get(self.url + 'version', timeout=5)
-                got_session = True
-            except requests.exceptions.ConnectionError:
-                self.logger.error("Could not establish session with ESPKey, sleeping for 10 seconds")
-                sleep(10)
-                continue
-                
-            if resp.status_code != 200:
-                self.logger.error(f"Invalid response code: {resp.status_code} to request for /version")
-                continue
-            else:
-                self.session_retry = False
-
-        if got_session:   
-            self.state = ESPKeyStateModel(payload=resp.json()) 
-            self.state.payload.status = "connected"
-            self.logger.info(f"ESPKey Connected. Version: {self.state.to_json()}")
-            self._send_state()
-            return s
+        self._workers = []
+        # Shared by every reader, the same badge at two doors is published once
+        self.dedup = DedupCache(window=dedup_window, max_size=dedup_max)
+        self.metrics.counter("credentials_suppressed_total", "Credentials read again within dedup_window and not published", fn=lambda: self.dedup.suppressed)
+        self.metrics.gauge("credential_dedup_size", "Credentials remembered for deduplication", fn=lambda: len(self.dedup))
+
+        reader_defaults = {
+            "log": log,
+            "tail_mode": tail_mode,
+            "seen_max": seen_max,
+            "seen_max_age": seen_max_age,
+            "timeout": timeout,
+            "metrics": self.metrics
+        }
+        self.readers = []
+        self.fleet = bool(hosts)
+        if self.fleet:
+            for host in hosts:
+                if isinstance(host, str):
+                    host = {"url": host}
+                reader = ESPKeyReader(**{**reader_defaults, **host})
+                if any(other.name == reader.name for other in self.readers):
+                    raise ValueError(f"Two ESPKey hosts named {reader.name}, give each a unique name")
+                self.readers.append(reader)
+            self.state.payload.hosts = {}
         else:
-            self.logger.error("Could not get session and not retrying")
-            sys.exit(1)
-
-    def get_log(self):
-        if self.session is None:
-            self.logger.debug("No session found, creating one")
-            self.session = self._create_session()
-        logurl = self.url + self.logfile
-        resp = self.session.get(logurl)
-        if resp.status_code != 200:
-            self.logger.error("Error fetching logfile")
-            return False
-        return resp
+            self.readers.append(ESPKeyReader(url=url, **reader_defaults))
+
+    def _state_topic(self, reader):
+        if self.fleet:
+            return f"devices/{self.__module__.lower()}/{reader.name}/state"
+        return self.state_topic
+
+    def _send_reader_state(self, reader):
+        reader.state.payload.stats = reader.stats()
+        if self.fleet:
+            self.state.payload.hosts[reader.name] = reader.state.payload.status
+            if reader.state.payload.status == "connected":
+                self.state.payload.status = "connected"
+            elif "connected" not in self.state.payload.hosts.values():
+                self.state.payload.status = "disconnected"
+            self.publish_state(self._state_topic(reader), reader.state)
+        else:
+            self.state = reader.state
+        self._send_state()
 
     def get_pacs_data(self):
-        carddata = re.compile(r'^(\d*)\s(\w*):(\d*)')
-        logdata = self.get_log()
-        got_new_credential = False
-        credential = None
-        for line in logdata.iter_lines():
-            card = carddata.match(line.decode('utf-8'))
-            if card:
-                if card.group(1) in self.credentials:
+        return self.readers[0].get_pacs_data()
+
+    def _poll_reader(self, reader):
+        """Polls one ESPKey until terminated, a slow or dead host only holds up its own worker.
+        The interval drops to poll_interval_min after a capture and backs off
+        towards poll_interval_max while the log is idle"""
+        interval = self.poll_interval
+        last_stats = monotonic()
+        poll_errors = self.metrics.counter("espkey_poll_errors_total", "Polls that failed with a request error", labels={"reader": reader.name})
+        self.metrics.gauge("espkey_poll_interval_seconds", "Current adaptive poll interval", labels={"reader": reader.name}, fn=lambda: interval)
+        # An ESPKey booting alongside the Pi is retried quickly, one that stays down less often
+        retry = self.session_retry_min
+        while self.running:
+            if reader.session is None:
+                if not reader.connect():
+                    self.logger.error(f"{reader.name}: no session, sleeping for {retry} seconds")
+                    self.wait(retry)
+                    retry = min(retry * 2, self.session_retry_interval)
                     continue
-                else:
-                    got_new_credential = True
-                    credential = ESPKeyCredential(payload={
-                        "bits": int(card.group(3)),
-                        "hex": card.group(2),
-                        "timestamp": int(card.group(1))
-                    })
-                    self.logger.info(f"New credential from log: {credential}")
-                    self.credentials.append(card.group(1))
-
-        if credential is not None:
-            if self.latest_credential.payload is not None:
-                if credential.payload.hex == self.latest_credential.payload.hex:
-                    self.logger.info(f"Repeat credential: {card.group(2)}")
-                    got_new_credential = False
-
-            self.latest_credential = credential
-
-        return got_new_credential, credential
+                retry = self.session_retry_min
+                self._send_reader_state(reader)
+
+            try:
+                credentials = reader.get_pacs_data()
+            except requests.exceptions.RequestException as e:
+                self.logger.error(f"{reader.name}: error polling log: {e}")
+                poll_errors.inc()
+                reader.disconnect()
+                self._send_reader_state(reader)
+                continue
+
+            if credentials:
+                for credential in credentials:
+                    if self.dedup.check(credential):
+                        stamp(credential.payload.trace, "seen")
+                        self.logger.debug(f"Publish -> {credential.to_json()}")
+                        self.publish(self.credential_topic["seen"], credential)
+                    else:
+                        self.logger.info(f"{reader.name}: repeat credential: {credential}")
+                interval = self.poll_interval_min
+            else:
+                interval = min(interval * self.poll_backoff, self.poll_interval_max)
+
+            if monotonic() - last_stats >= self.stats_interval:
+                self._send_reader_state(reader)
+                last_stats = monotonic()
+
+            self.wait(interval)
+
+        reader.disconnect()
+
+    def healthy(self):
+        """A poll worker that died on an unexpected error leaves its reader unwatched"""
+        return super(ESPKey, self).healthy() and not any(worker.done() for worker in self._workers)
 
     def _cleanup(self):
+        self._stop_event.set()
         self._disconnect()
         self.logger.info("ESPKey client closed")
 
     def loop(self):
-        while self.running:
-            got_credential, credential = self.get_pacs_data()
-            if got_credential:
-                self.logger.debug(f"Publish -> {credential.to_json()}")
-                self.mqtt_client.publish(self.credential_topic["seen"], credential.to_json())
-            else:
-                sleep(self.poll_interval)
-
-            self.mqtt_client.loop()
+        with ThreadPoolExecutor(max_workers=len(self.readers), thread_name_prefix="espkey") as pool:
+            self._workers = [pool.submit(self._poll_reader, reader) for reader in self.readers]
+            self.wait()
@@ -0,0 +1,55 @@
+from collections import OrderedDict
+from time import monotonic
+
+class SeenIndex(object):
+    """Tracks which ESPKey log entries have already been handled.
+
+    ESPKey timestamps are milliseconds since boot, so a timestamp going
+    backwards in the log starts a new epoch. Entries past the
+    (epoch, timestamp) high-water mark are new without a lookup, anything
+    at or below it is checked against a hashed set bounded by size and age.
+    """
+    def __init__(self, max_size=4096, max_age=86400):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.high_water = (0, -1)
+        self._epoch = 0
+        self._last = -1
+        self._seen = OrderedDict()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def rewind(self):
+        """Call when the log is read again from the start"""
+        self._epoch = 0
+        self._last = -1
+
+    def _expire(self):
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+
+        if self.max_age is not None:
+            cutoff = monotonic() - self.max_age
+            while self._seen:
+                key, added = next(iter(self._seen.items()))
+                if added >= cutoff:
+                    break
+                self._seen.popitem(last=False)
+
+    def add(self, timestamp, hex=None, bits=None):
+        """Returns True if the entry has not been seen before"""
+        if timestamp < self._last:
+            self._epoch += 1
+        self._last = timestamp
+
+        mark = (self._epoch, timestamp)
+        key = hash((timestamp, hex, bits))
+        if mark <= self.high_water and key in self._seen:
+            return False
+
+        if mark > self.high_water:
+            self.high_water = mark
+        self._seen[key] = monotonic()
+        self._expire()
+        return True
@@ -1,11 +1,15 @@
-from odo.models import StateModel
+from odo.models import StateModel, PayloadModel
 from odo.credentials import WiegandCredential, WiegandPayload
 
-class ESPKeyStatePayload(object):
-    def __init__(self, status="disconnected", version=None, ChipID=None, *args, **kwargs):
+class ESPKeyStatePayload(PayloadModel):
+    _fields = ("version", "ChipID", "status", "hosts", "stats")
+
+    def __init__(self, status="disconnected", version=None, ChipID=None, hosts=None, stats=None, *args, **kwargs):
         self.version = version
         self.ChipID = ChipID
         self.status = status
+        self.hosts = hosts
+        self.stats = stats
 
 class ESPKeyStateModel(StateModel):
     def __init__(self, payload=dict(), *args, **kwargs):
@@ -13,12 +17,18 @@ class ESPKeyStateModel(StateModel):
         self.payload = ESPKeyStatePayload(**payload)
 
 class ESPKeyPayload(WiegandPayload):
-    def __init__(self, bits=None, hex=None, timestamp=None, *args, **kwargs):
-        self.bits = bits
-        self.hex = hex
+    __slots__ = ("timestamp", "source", "trace")
+    _fields = WiegandPayload._fields + ("timestamp", "source", "trace")
+
+    def __init__(self, bits=None, hex=None, timestamp=None, source=None, trace=None, *args, **kwargs):
+        super(ESPKeyPayload, self).__init__(bits=bits, hex=hex)
         self.timestamp = timestamp
+        self.source = source
+        self.trace = trace
 
 class ESPKeyCredential(WiegandCredential):
+    __slots__ = ()
+
     def __init__(self, payload=dict(), *args, **kwargs):
         super(ESPKeyCredential, self).__init__(*args, **kwargs)
         self.payload = ESPKeyPayload(**payload)
@@ -0,0 +1,247 @@
+import requests
+import re
+import logging
+from time import monotonic, time, perf_counter
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
+
+from .models import ESPKeyStateModel, ESPKeyCredential
+from .helpers import SeenIndex
+from odo.tracing import stamp
+from odo.metrics import default_registry
+
+carddata = re.compile(r'^(\d+)\s(\w+):(\d+)')
+
+class ESPKeyReader(object):
+    """Polling state for a single ESPKey, shared by single and fleet mode"""
+    def __init__(self, url="http://espkey.local/", log="log.txt", name=None, tail_mode="range", seen_max=4096, seen_max_age=86400, timeout=5, metrics=None, *args, **kwargs):
+        self.url = url
+        self.logfile = log
+        # Host and port, so two ESPKeys behind one address get their own topics and labels
+        self.name = name if name is not None else urlparse(url).netloc
+        self.logger = logging.getLogger(f'odo.espkey.{self.name}')
+        self.tail_mode = tail_mode
+        self.timeout = timeout
+        self.log_offset = 0
+        self.log_size = None
+        self.etag = None
+        self.last_modified = None
+        self.range_ignored = False
+        self.polls = 0
+        self.not_modified = 0
+        self.bytes_fetched = 0
+        self.captures = 0
+        self.capture_latency = 0.0
+        self.capture_latency_max = 0.0
+        self.last_poll = None
+        # False until the log has been read once, what was in it at startup is history
+        self.primed = False
+        self.session = None
+        self.state = ESPKeyStateModel()
+        self.seen = SeenIndex(max_size=seen_max, max_age=seen_max_age)
+        self.latest_credential = ESPKeyCredential()
+        self.sessions = 0
+        self._register_metrics(metrics if metrics is not None else default_registry.labels(module="espkey"))
+
+    def connect(self):
+        """Single attempt at a session, retrying is left to the caller"""
+        s = requests.Session()
+        try:
+            resp = s.get(self.url + 'version', timeout=self.timeout)
+        except requests.exceptions.RequestException:
+            self.logger.error("Could not establish session with ESPKey")
+            return False
+
+        if resp.status_code != 200:
+            self.logger.error(f"Invalid response code: {resp.status_code} to request for /version")
+            return False
+
+        self.state = ESPKeyStateModel(payload=resp.json())
+        self.state.payload.status = "connected"
+        self.logger.info(f"ESPKey Connected. Version: {self.state.to_json()}")
+        self.session = s
+        self.sessions += 1
+        return True
+
+    def disconnect(self):
+        if self.session is not None:
+            self.session.close()
+        self.session = None
+        self.state.payload.status = "disconnected"
+
+    def _rewind_log(self):
+        self.logger.info("Log truncated or rotated, re-reading from start")
+        self.log_offset = 0
+        self.log_size = None
+        self.etag = None
+        self.last_modified = None
+        self.seen.rewind()
+
+    def _register_metrics(self, metrics):
+        """Counts the reader already keeps are read at scrape time, only timings are recorded as they happen"""
+        metrics = metrics.labels(reader=self.name)
+        metrics.counter("espkey_polls_total", "Log polls", fn=lambda: self.polls)
+        metrics.counter("espkey_not_modified_total", "Polls that found the log unchanged", fn=lambda: self.not_modified)
+        metrics.counter("espkey_bytes_fetched_total", "Log bytes downloaded", fn=lambda: self.bytes_fetched)
+        metrics.counter("espkey_captures_total", "New credentials found in the log", fn=lambda: self.captures)
+        metrics.counter("espkey_sessions_total", "Sessions established, more than one means reconnects", fn=lambda: self.sessions)
+        metrics.gauge("espkey_seen_index_size", "Log lines remembered for duplicate suppression", fn=lambda: len(self.seen))
+        self.fetch_seconds = metrics.histogram("espkey_fetch_seconds", "Time to fetch the new tail of the log")
+        self.parse_seconds = metrics.histogram("espkey_parse_seconds", "Time to parse the fetched lines")
+
+    def _log_request(self, logurl, start):
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+
+        if self.tail_mode == "range" and start > 0:
+            headers["Range"] = f"bytes={start}-"
+            return self.session.get(logurl, headers=headers, timeout=self.timeout)
+        elif self.tail_mode == "offset" and start > 0:
+            return self.session.get(logurl, headers=headers, params={"offset": start}, timeout=self.timeout)
+        return self.session.get(logurl, headers=headers, timeout=self.timeout)
+
+    def _log_unchanged(self, logurl):
+        """Cheap HEAD size check for servers that send no validators and ignore Range"""
+        if self.log_size is None or self.etag is not None or self.last_modified is not None:
+            return False
+        resp = self.session.head(logurl, timeout=self.timeout)
+        length = resp.headers.get("Content-Length")
+        return resp.status_code == 200 and length is not None and int(length) == self.log_size
+
+    def _update_validators(self, resp, start):
+        self.etag = resp.headers.get("ETag")
+        self.last_modified = None
+        # Last-Modified has one second resolution, it is only safe to send
+        # back once the log is older than the response
+        last_modified = resp.headers.get("Last-Modified")
+        date = resp.headers.get("Date")
+        if last_modified is not None and date is not None:
+            try:
+                if parsedate_to_datetime(date) > parsedate_to_datetime(last_modified):
+                    self.last_modified = last_modified
+            except (TypeError, ValueError):
+                pass
+        content_range = resp.headers.get("Content-Range")
+        if resp.status_code == 206 and content_range is not None and '/' in content_range:
+            total = content_range.rsplit('/', 1)[1]
+            self.log_size = int(total) if total.isdigit() else None
+        elif resp.status_code == 200:
+            self.log_size = len(resp.content) + (start if self.tail_mode == "offset" else 0)
+            if self.tail_mode == "range" and start > 0:
+                self.range_ignored = True
+
+    def stats(self):
+        return {
+            "polls": self.polls,
+            "not_modified": self.not_modified,
+            "bytes_fetched": self.bytes_fetched,
+            "captures": self.captures,
+            "capture_latency": round(self.capture_latency, 3),
+            "capture_latency_max": round(self.capture_latency_max, 3)
+        }
+
+    def _record_capture(self, now):
+        """Latency is the worst case, the credential may have landed just after the previous poll"""
+        if self.last_poll is None:
+            return
+        latency = now - self.last_poll
+        self.captures += 1
+        self.capture_latency += (latency - self.capture_latency) / self.captures
+        self.capture_latency_max = max(self.capture_latency_max, latency)
+
+    """Returns only the complete lines appended to the log since the last call"""
+    def get_log(self):
+        logurl = self.url + self.logfile
+
+        # Start one byte early so the newline we stopped on last time can be
+        # checked, if it is gone the log was truncated or rotated
+        start = max(self.log_offset - 1, 0)
+        if self.range_ignored and self._log_unchanged(logurl):
+            self.not_modified += 1
+            return b""
+
+        resp = self._log_request(logurl, start)
+        if resp.status_code == 304:
+            self.not_modified += 1
+            return b""
+
+        if resp.status_code == 416:
+            self._rewind_log()
+            start = 0
+            resp = self._log_request(logurl, start)
+
+        if resp.status_code not in (200, 206):
+            self.logger.error("Error fetching logfile")
+            return False
+
+        self.bytes_fetched += len(resp.content)
+        self._update_validators(resp, start)
+        data = resp.content
+        if resp.status_code == 200 and self.tail_mode != "offset":
+            # Server ignored the range, slice the tail out locally
+            data = data[start:]
+
+        if start > 0:
+            if data[:1] != b"\n":
+                self._rewind_log()
+                return self.get_log()
+            data = data[1:]
+            start += 1
+
+        # Only consume complete lines, a partial line is read again next poll
+        end = data.rfind(b"\n") + 1
+        self.log_offset = start + end
+        return data[:end]
+
+    def get_pacs_data(self):
+        """Returns every credential appended to the log since the last poll,
+        oldest first. The first read only returns the newest entry, the rest
+        were captured before startup and are just marked seen"""
+        now = monotonic()
+        polled = time()
+        logdata = self.get_log()
+        fetched = time()
+        self.fetch_seconds.observe(fetched - polled)
+        self.polls += 1
+        credentials = []
+        if logdata is False:
+            self.last_poll = now
+            return credentials
+        primed = self.primed
+        self.primed = True
+        if not logdata:
+            self.last_poll = now
+            return credentials
+
+        parse_start = perf_counter()
+        for line in logdata.splitlines():
+            card = carddata.match(line.decode('utf-8'))
+            if card:
+                if not self.seen.add(int(card.group(1)), card.group(2), card.group(3)):
+                    continue
+                credential = ESPKeyCredential(payload={
+                    "bits": int(card.group(3)),
+                    "hex": card.group(2),
+                    "timestamp": int(card.group(1)),
+                    "source": self.name,
+                    "trace": stamp(stamp(None, "polled", polled), "fetched", fetched)
+                })
+                credentials.append(credential)
+        self.parse_seconds.observe(perf_counter() - parse_start)
+
+        if not primed and len(credentials) > 1:
+            self.logger.info(f"Skipping {len(credentials) - 1} credentials logged before startup")
+            credentials = credentials[-1:]
+        for credential in credentials:
+            self.logger.info(f"New credential from log: {credential}")
+            self._record_capture(now)
+
+        # Repeats are left to the module's DedupCache, which sees every reader
+        if credentials:
+            self.latest_credential = credentials[-1]
+
+        self.last_poll = now
+        return credentials
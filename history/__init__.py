@@ -0,0 +1,104 @@
+import queue
+import logging
+from time import time, perf_counter
+
+from odo.models import BaseMqttDeviceModel
+from odo.serialization import decode
+from .models import HistoryStateModel, HistoryResultModel
+from .store import CredentialStore
+
+class History(BaseMqttDeviceModel):
+    """Records every credential event in an on-disk store and answers paged
+    queries over it. Queries are a "query" command on devices/history/cmd,
+    the page is published to the query's reply_to or results_topic"""
+    def __init__(self, path="history.db", events=("seen", "written"), results_topic="devices/history/results", page_size=50, max_page_size=500, queue_size=1024, *args, **kwargs):
+        super(History, self).__init__(*args, **kwargs)
+        self.logger = logging.getLogger('odo.history.History')
+        self.store = CredentialStore(path)
+        self.state = HistoryStateModel(payload={"path": path})
+        self.results_topic = results_topic
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        # SQLite is only used from the store thread, handlers just queue for it
+        self.requests = queue.Queue(maxsize=queue_size)
+        self.recorded = 0
+        self.metrics.counter("history_events_total", "Credential events recorded", fn=lambda: self.recorded)
+        self.metrics.gauge("history_queue_depth", "Events and queries waiting for the store", fn=lambda: self.requests.qsize())
+        self._query_seconds = self.metrics.histogram("history_query_seconds", "Time to run a history query")
+
+        self._topic_events = {self.credential_topic[event]: event for event in events}
+        self._subscribe_topics = list(self._topic_events) + [self.command_topic]
+
+    def _on_message(self, client, userdata, msg):
+        try:
+            self.requests.put_nowait((msg, time()))
+        except queue.Full:
+            self.logger.error(f"Store queue full, dropping message on {msg.topic}")
+
+    def _message(self, msg):
+        model = getattr(msg, "model", None)
+        if model is not None:
+            return model.to_dict()
+        return decode(msg.payload)
+
+    def _handle(self, msg, received):
+        if msg.topic in self._topic_events:
+            payload = self._message(msg).get("payload") or {}
+            # The written status before the pm3 has done anything isn't history
+            if payload.get("status") == "pending":
+                return
+            self.store.append(self._topic_events[msg.topic], payload, timestamp=received)
+            self.recorded += 1
+
+        elif msg.topic == self.command_topic:
+            message = self._message(msg)
+            if message.get("type") == "query":
+                self._query(message.get("payload") or {})
+            else:
+                self.logger.error("Command type not implemented")
+
+    def _query(self, request):
+        request = dict(request)
+        id = request.pop("id", None)
+        reply_to = request.pop("reply_to", None) or self.results_topic
+        limit = request.pop("limit", None)
+        started = perf_counter()
+        try:
+            limit = max(1, min(int(limit if limit is not None else self.page_size), self.max_page_size))
+            events, before = self.store.query(limit=limit, **request)
+            result = HistoryResultModel(payload={"id": id, "events": events, "before": before})
+        except (ValueError, TypeError) as e:
+            self.logger.error(f"Bad history query {request}: {e}")
+            result = HistoryResultModel(payload={"id": id, "error": str(e)})
+        self._query_seconds.observe(perf_counter() - started)
+        self.publish(reply_to, result)
+
+    def loop(self):
+        self.store.open()
+        self.state.payload.events = len(self.store)
+        self.state.payload.status = "connected"
+        self._send_state()
+        recorded = self.recorded
+        try:
+            while self.running:
+                try:
+                    batch = [self.requests.get(timeout=1)]
+                except queue.Empty:
+                    continue
+                # A burst of captures is committed once
+                while len(batch) < 256:
+                    try:
+                        batch.append(self.requests.get_nowait())
+                    except queue.Empty:
+                        break
+                for msg, received in batch:
+                    try:
+                        self._handle(msg, received)
+                    except Exception as e:
+                        self.logger.error(f"Error handling message on {msg.topic}: {e}")
+                self.store.commit()
+                self.state.payload.events += self.recorded - recorded
+                recorded = self.recorded
+                self._send_state()
+        finally:
+            self.store.close()
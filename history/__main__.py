@@ -0,0 +1,16 @@
+import logging
+from history import History
+
+logging.basicConfig(level=logging.DEBUG,
+                    format='%(asctime)s - [%(name)s] - %(levelname)s - %(message)s [%(threadName)s]',
+)
+
+if __name__ == "__main__":
+    history = History()
+    history.start()
+    try:
+        input("Press enter key to end")
+    except KeyboardInterrupt:
+        pass
+    history.terminate()
+    history.join()
@@ -0,0 +1,32 @@
+from odo.models import StateModel, PayloadModel, MqttApiModel
+
+class HistoryStatePayload(PayloadModel):
+    _fields = ("status", "path", "events")
+
+    def __init__(self, status="disconnected", path=None, events=None, *args, **kwargs):
+        self.status = status
+        self.path = path
+        self.events = events
+
+class HistoryStateModel(StateModel):
+    def __init__(self, payload=dict(), *args, **kwargs):
+        super(HistoryStateModel, self).__init__(*args, **kwargs)
+        self.payload = HistoryStatePayload(**payload)
+
+class HistoryResultPayload(PayloadModel):
+    _fields = ("id", "events", "before", "error")
+
+    def __init__(self, id=None, events=None, before=None, error=None, *args, **kwargs):
+        self.id = id
+        self.events = events if events is not None else []
+        self.before = before
+        self.error = error
+
+class HistoryResultModel(MqttApiModel):
+    """A page of events answering a query, before is what to ask for next
+    and None on the last page"""
+    def __init__(self, payload=dict()):
+        super(HistoryResultModel, self).__init__()
+        self.version = 1
+        self.type = "history"
+        self.payload = HistoryResultPayload(**payload)
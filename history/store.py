@@ -0,0 +1,131 @@
+import json
+import sqlite3
+import logging
+from time import time
+
+schema = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    time REAL NOT NULL,
+    event TEXT NOT NULL,
+    bits INTEGER,
+    hex TEXT,
+    source TEXT,
+    status TEXT,
+    trace TEXT,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_credential ON events (hex, bits);
+CREATE INDEX IF NOT EXISTS events_event ON events (event, status);
+CREATE INDEX IF NOT EXISTS events_source ON events (source);
+CREATE INDEX IF NOT EXISTS events_time ON events (time);
+"""
+
+# Query filter -> column it matches exactly
+filters = {
+    "event": "event",
+    "bits": "bits",
+    "hex": "hex",
+    "source": "source",
+    "status": "status"
+}
+
+class CredentialStore(object):
+    """Append-only SQLite log of credential events. Pages run newest first
+    and continue from the id before the last one returned, so a page costs
+    the same however deep into the history it is. Only use it from the
+    thread that opened it"""
+    def __init__(self, path="history.db"):
+        self.logger = logging.getLogger('odo.history.CredentialStore')
+        self.path = path
+        self.db = None
+
+    def open(self):
+        self.db = sqlite3.connect(self.path)
+        self.db.row_factory = sqlite3.Row
+        # Readers of the file don't block appends, and a crash loses at most the last commit
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(schema)
+        self.db.commit()
+        self.logger.info(f"Opened {self.path}, {len(self)} events")
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+    def __len__(self):
+        return self.db.execute("SELECT count(*) FROM events").fetchone()[0]
+
+    def append(self, event, payload, timestamp=None):
+        """Adds an event, committed by the next commit()"""
+        payload = dict(payload)
+        trace = payload.pop("trace", None)
+        bits = payload.get("bits")
+        hex = payload.get("hex")
+        cursor = self.db.execute(
+            "INSERT INTO events (time, event, bits, hex, source, status, trace, payload) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                timestamp if timestamp is not None else time(),
+                event,
+                int(bits) if bits is not None else None,
+                str(hex).lower() if hex is not None else None,
+                payload.get("source"),
+                payload.get("status"),
+                trace["id"] if trace else None,
+                json.dumps(payload)
+            )
+        )
+        return cursor.lastrowid
+
+    def commit(self):
+        self.db.commit()
+
+    def query(self, before=None, since=None, until=None, unique=False, limit=50, **match):
+        """Returns up to limit events matching every filter given, newest
+        first, and the before to pass for the next page or None on the last.
+        With unique only the latest event of each credential is returned"""
+        limit = max(int(limit), 1)
+        where = []
+        args = []
+        for name, value in match.items():
+            if name not in filters:
+                raise ValueError(f"Unknown filter {name}, expected one of {', '.join(sorted(filters))}")
+            if value is None:
+                continue
+            if name == "hex":
+                value = str(value).lower()
+            elif name == "bits":
+                value = int(value)
+            where.append(f"{{table}}.{filters[name]} = ?")
+            args.append(value)
+        if since is not None:
+            where.append("{table}.time >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("{table}.time < ?")
+            args.append(until)
+
+        conditions = [condition.format(table="events") for condition in where]
+        if unique:
+            # Walking newest first, an event is the latest of its credential
+            # if no later one matches too. Stops once the page is full
+            later = ["later.hex IS events.hex", "later.bits IS events.bits", "later.id > events.id"] + [condition.format(table="later") for condition in where]
+            conditions.append(f"NOT EXISTS (SELECT 1 FROM events AS later WHERE {' AND '.join(later)})")
+            args = args + args
+        if before is not None:
+            conditions.append("events.id < ?")
+            args.append(int(before))
+
+        sql = "SELECT id, time, event, trace, payload FROM events"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY id DESC LIMIT ?"
+        args.append(limit + 1)
+
+        rows = self.db.execute(sql, args).fetchall()
+        events = [{"id": row["id"], "time": row["time"], "event": row["event"], "trace": row["trace"], **json.loads(row["payload"])} for row in rows[:limit]]
+        after = events[-1]["id"] if len(rows) > limit else None
+        return events, after
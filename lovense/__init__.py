@@ -1,19 +1,16 @@
-from asyncio.exceptions import CancelledError
-from time import sleep
+import os
 import sys
+import json
 import asyncio
 import logging
-import json
-from bleak import BleakClient, BleakScanner
+from bleak import BleakScanner
 from bleak.exc import BleakError
 from bleak import _logger as logger
 
-service_uuid = "58300001-0023-4BD4-BBD5-A6920E4C5653"
-tx_char_uuid = "58300002-0023-4BD4-BBD5-A6920E4C5653"
-rx_char_uuid = "58300003-0023-4BD4-BBD5-A6920E4C5653"
-
 from odo.models import BaseMqttDeviceModel
+from odo.serialization import decode
 from .models import LovenseStateModel
+from .device import LovenseDevice
 from .patterns import *
 
 # Linux
@@ -26,18 +23,34 @@ logging.getLogger("bleak.backends.corebluetooth.PeripheralDelegate").setLevel(lo
 logging.getLogger("bleak.backends.corebluetooth.CentralManagerDelegate").setLevel(logging.WARNING)
 
 class Lovense(BaseMqttDeviceModel):
-    def __init__(self, events=event_patterns, default_pattern=foho, *args, **kwargs):
+    def __init__(self, events=event_patterns, default_pattern=foho, priorities=event_priorities, merge_window=None, device_cache="lovense_device.json", cached_timeout=5, connect_timeout=20, scan_timeout=10, retry_interval=1, max_cached=8, *args, **kwargs):
         super(Lovense, self).__init__(*args, **kwargs)
         self.logger = logging.getLogger('odo.lovense.Lovense')
         self.event_loop = asyncio.new_event_loop()
-        self.queue = asyncio.Queue()
-        self.client = None
         self.restart = True
-        self.vibrating = False # Poor man's semaphore
         self._event = None
+        self._device_dropped = None
+        # Toys connected to before, tried directly while scanning for new ones. None to always scan
+        self.device_cache = device_cache
+        self.max_cached = max_cached
+        self.scan_timeout = scan_timeout
+        self.retry_interval = retry_interval
+        # Settings each toy's LovenseDevice is created with
+        self.device_defaults = {
+            "priorities": priorities,
+            "merge_window": merge_window,
+            # A cached toy that is out of range is tried for this long at a time
+            "cached_timeout": cached_timeout,
+            "connect_timeout": connect_timeout,
+            "retry_interval": retry_interval,
+            "metrics": self.metrics
+        }
+        self.devices = {}
+        self._device_tasks = []
         self.state = LovenseStateModel()
         self.event_patterns = event_patterns
         self.default_pattern = default_pattern
+        self.metrics.gauge("ble_devices_connected", "Toys currently connected", fn=lambda: sum(device.connected for device in list(self.devices.values())))
         self._subscribe_topics = [
             self.credential_topic["seen"],
             self.credential_topic["selected"],
@@ -45,23 +58,25 @@ class Lovense(BaseMqttDeviceModel):
             self.command_topic
         ]
 
-    """Overloads _send_state() to not call self.mqtt_client.loop()"""
-    def _send_state(self):
-        self.mqtt_client.publish(self.state_topic, self.state.to_json())
-
     def _handle_credential(self, msg=None):
         self.logger.debug(msg)
         topic = msg.topic.split('/')
         self.logger.debug(topic)
         pattern = self.default_pattern
+        event = topic[1]
         if msg.topic == self.credential_topic['written']:
             self.logger.debug("cred written")
-            message = json.loads(msg.payload)
+            model = getattr(msg, "model", None)
+            if model is not None:
+                message = model.to_dict()
+            else:
+                message = decode(msg.payload)
             self.logger.debug(message)
             if "payload" in message:
                 if "status" in message["payload"]:
                     status = message["payload"]["status"]
                     self.logger.debug(status)
+                    event = f"{topic[1]}/{status}"
                     if status in self.event_patterns[topic[1]]:
                         pattern = self.event_patterns[topic[1]][status]
                     else:
@@ -70,13 +85,20 @@ class Lovense(BaseMqttDeviceModel):
             pattern = self.event_patterns[topic[1]]
 
         if pattern is not None:
-            self.event_loop.create_task(self.vibe_pattern(pattern))
+            self.fan_out(event, pattern)
 
     def _handle_command(self, msg=None):
-        # message = json.loads(msg.payload)
+        # message = decode(msg.payload)
         self.logger.error(f"Command parsing not implemented")
 
+    """Overloads _on_message(), messages arrive on paho's network thread or the
+    publisher's thread and are handed to the event loop"""
     def _on_message(self, client, userdata, msg):
+        if self.event_loop.is_closed():
+            return
+        self.event_loop.call_soon_threadsafe(self._dispatch, msg)
+
+    def _dispatch(self, msg):
         self.logger.debug(f"MQTT message received-> {msg.topic} {str(msg.payload)}")
         if msg.topic in list(self.credential_topic.values()):
             self._handle_credential(msg=msg)
@@ -84,178 +106,129 @@ class Lovense(BaseMqttDeviceModel):
         if msg.topic == self.command_topic:
             self._handle_command(msg=msg)
 
-    async def vibe_pattern(self, pattern):
-        try:
-            self.vibrating = True
-            for vibe, duration in pattern:
-                await self.write_cmd(vibe)
-                sleep(duration)
-            await self.write_cmd(vibe_off)
-        except Exception as e:
-            self.logger.error(e)
-        finally:
-            self.vibrating = False
-
-    async def write_cmd(self, data):
-        self.logger.debug(f"BLE Send: {data}")
-        await self.queue.put(data)
-        try:
-            await self.client.write_gatt_char(tx_char_uuid,bytes(data, encoding="UTF-8"))
-        except BleakError:
-            self.state = LovenseStateModel()
-            self._send_state()
-            raise ConnectionError
+    @property
+    def vibrating(self):
+        return any(device.scheduler.busy for device in list(self.devices.values()))
 
-    async def process_ble_response(self, response):
-        cmd = await self.queue.get()
+    def fan_out(self, event, pattern):
+        """Schedules pattern on every connected toy. Each toy has its own
+        scheduler and pipeline, so they play at once and a slow toy only
+        falls behind itself. Returns the futures from each scheduler"""
+        return [device.scheduler.submit(event, pattern) for device in list(self.devices.values()) if device.connected]
 
-        if cmd.startswith("DeviceType"):
-            values = response.split(':')
-            self.logger.debug(f"Type: {values[0]} Version: {values[1]} MAC: {values[2]}")
-            self.state.payload.device_type = values[0]
-            self.state.payload.version = values[1]
-            self.state.payload.mac_addr = values[2]
-            self._send_state()
+    async def vibe_pattern(self, pattern, event="pattern"):
+        """Plays pattern on every connected toy, returns once each has played or been preempted"""
+        return await asyncio.gather(*self.fan_out(event, pattern))
 
-        elif cmd.startswith("GetBatch"):
-            values = response.split(';')
-            self.logger.debug(f"Batch: {values[0]}")
-            self.state.payload.batch = values[0]
-            self._send_state()
-
-        elif cmd.startswith("Battery"):
-            values = response.split(';')
-            self.logger.debug(f"Battery: {values[0]}")
-            self.state.payload.battery = int(values[0])
-            self._send_state()
-
-        elif cmd.startswith("Vibrate"):
-            if response == "OK;":
-                self.logger.debug("Response from vibrate")
-            else:
-                raise ValueError
+    def _update_devices_state(self):
+        self.state.payload.devices = [device.to_dict() for device in self.devices.values()]
+        if any(device.connected for device in self.devices.values()):
+            self.state.payload.status = "connected"
         else:
-            self.logger.debug(f"Unknown command: {cmd} and response: {response}")
-
-    def ble_callback(self, sender: int, data: bytearray):
-        response = data.decode(encoding="UTF-8")
-        self.logger.debug(f"BLE Recv: {sender}: {response}")
-        if response.endswith(";"):
-            self.event_loop.create_task(self.process_ble_response(response))
-
-    async def ble_disconnect(self):
-        await self.client.stop_notify(rx_char_uuid)
-        await self.client.disconnect()
-        self._disconnect()
+            self.state.payload.status = "disconnected"
+
+    def _device_changed(self, device):
+        if device.connected:
+            self._cache_address(device.address)
+        elif self._device_dropped is not None:
+            self._device_dropped.set()
+        self._update_devices_state()
+        self._send_state()
 
-    async def connect_to_device(self, address):
-        self.logger.info(f"Starting loop for {address}")
+    def _cached_addresses(self):
+        if self.device_cache is None:
+            return []
         try:
-            async with BleakClient(address, loop=self.event_loop, timeout=60) as self.client:
-                self.logger.info(f"Connecting to: {address}")
-                self.state.payload.status = "connected"
-
-                try:
-                    await self.client.start_notify(rx_char_uuid, self.ble_callback)
-                    await self.write_cmd("DeviceType;")
-                    await self.write_cmd("GetBatch;")
-                    await self.vibe_pattern(foho)
-                    await asyncio.sleep(1)
-                except Exception as e:
-                    self.logger.error(e)
-                    raise e
-
-                self._send_state()
-                self._event = asyncio.Event()
-
-                await self._event.wait()
-
-                await self.ble_disconnect()
-        except Exception as e:
-            self.logger.error("Error connecting")
-
-        self.logger.info(f"Disconnect from: {address}")
-
-    async def mqtt_loop(self):
-        while True:
-            if self.state.payload.status == "connected":
-                self.mqtt_client.loop()
-                await asyncio.sleep(0.5)
-            else:
-                await asyncio.sleep(10)
-
-    async def get_battery(self):
-        while True:
-            if (self.state.payload.status == "connected") and (self.state.payload.device_type is not None) and (self.vibrating is False):
-                await self.write_cmd("Battery;")
-                await asyncio.sleep(10)
-            else:
-                await asyncio.sleep(1)
-
+            with open(self.device_cache, 'r') as file:
+                cached = json.load(file)
+        except (IOError, ValueError) as e:
+            self.logger.debug(f"No cached devices: {e}")
+            return []
+        # Written by versions that only knew one toy
+        if "address" in cached:
+            return [cached["address"]]
+        return cached.get("addresses", [])
+
+    def _cache_address(self, address):
+        if self.device_cache is None:
+            return
+        addresses = self._cached_addresses()
+        if addresses[:1] == [address]:
+            return
+        addresses = ([address] + [cached for cached in addresses if cached != address])[:self.max_cached]
+        try:
+            with open(f"{self.device_cache}.tmp", 'w') as file:
+                json.dump({"addresses": addresses}, file)
+            os.replace(f"{self.device_cache}.tmp", self.device_cache)
+        except IOError as e:
+            self.logger.error(f"Could not cache device address: {e}")
+
+    def _add_device(self, address, ble_device=None):
+        device = LovenseDevice(address, ble_device=ble_device, on_change=self._device_changed, **self.device_defaults)
+        self.devices[address] = device
+        self._device_tasks.append(self.event_loop.create_task(device.run(self._event)))
+        self._update_devices_state()
+        return device
+
+    async def find_device(self):
+        """Scans until the first toy not already known is seen rather than for a fixed time"""
+        try:
+            return await BleakScanner.find_device_by_filter(lambda d, ad: str(d.name).startswith("LVS-") and d.address not in self.devices, timeout=self.scan_timeout)
+        except BleakError as e:
+            self.logger.error(f"BLE Error: {e}")
+            sys.exit(1)
+
+    async def _wait(self, event, timeout=None):
+        """Waits for event or termination, whichever comes first"""
+        waiters = [asyncio.ensure_future(self._event.wait()), asyncio.ensure_future(event.wait())]
+        await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in waiters:
+            waiter.cancel()
 
     async def scanner(self):
-        while True:
-            got_device = False
-            tasks = []
-            tasks.append(self.event_loop.create_task(self.mqtt_loop()))
-            tasks.append(self.event_loop.create_task(self.get_battery()))
-            try:
-                devices = await BleakScanner.discover()
-            except BleakError as e:
-                self.logger.error(f"BLE Error: {e}")
-                sys.exit(1)
-
-            for d in devices:
-                if str(d.name).startswith("LVS-"):
-                    task = self.event_loop.create_task(self.connect_to_device(d))
-                    tasks.append(task)
-                    got_device = True
-
-            if got_device:
-                pass
-            else:
-                self.logger.info("No devices found, sleeping before next scan")
-                for t in tasks:
-                    self.logger.debug(f"Canceling: {t}")
-                    t.cancel()
-                for t in tasks:
-                    try:
-                        await t
-                    except CancelledError:
-                        self.logger.debug(f"Canceled: {t}")
-                    finally:
-                        await asyncio.sleep(3)
-                if self.restart:
+        """Connects to every cached toy directly and scans for new ones. Once
+        a scan finds nothing new and every toy is connected, scanning waits
+        for one of them to drop"""
+        self._event = asyncio.Event()
+        self._device_dropped = asyncio.Event()
+        for address in self._cached_addresses():
+            self._add_device(address)
+        try:
+            while self.restart:
+                scan = asyncio.ensure_future(self.find_device())
+                stopped = asyncio.ensure_future(self._event.wait())
+                await asyncio.wait([scan, stopped], return_when=asyncio.FIRST_COMPLETED)
+                stopped.cancel()
+                if not self.restart or not scan.done():
+                    scan.cancel()
+                    break
+                device = scan.result()
+                if device is not None:
+                    self.logger.info(f"Found {device.name} at {device.address}")
+                    self._add_device(device.address, ble_device=device)
                     continue
+                self._device_dropped.clear()
+                if self.devices and all(device.connected for device in self.devices.values()):
+                    await self._wait(self._device_dropped)
                 else:
-                    break
+                    self.logger.info("No new devices found")
+                    await self._wait(self._device_dropped, timeout=self.retry_interval)
+        finally:
+            self._event.set()
+            await asyncio.gather(*self._device_tasks, return_exceptions=True)
+            self._disconnect()
+        self.logger.info('Exiting')
 
-            try:
-                await asyncio.gather(*tasks)
-            except ConnectionError:
-                self.logger.error('Disconnected: cancelling all tasks')
-                for t in tasks:
-                    self.logger.debug(f"Canceling: {t}")
-                    t.cancel()
-                for t in tasks:
-                    try:
-                        await t
-                    except CancelledError:
-                        self.logger.debug(f"Canceled: {t}")
-                    finally:
-                        await asyncio.sleep(3)
-            finally:
-                await asyncio.sleep(5)
-            if self.restart:
-                self.logger.info('Restarting scan')
-            else:
-                self.logger.info('Exiting')
-                break
+    def _cancel_patterns(self):
+        for device in list(self.devices.values()):
+            device.cancel()
 
     def _cleanup(self):
         self.restart = False
-        if self._event is not None:
-            self._event.set()
+        if not self.event_loop.is_closed():
+            self.event_loop.call_soon_threadsafe(self._cancel_patterns)
+            if self._event is not None:
+                self.event_loop.call_soon_threadsafe(self._event.set)
 
     def loop(self):
         self._send_state()
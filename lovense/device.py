@@ -0,0 +1,232 @@
+from asyncio.exceptions import CancelledError
+from time import perf_counter
+import asyncio
+import logging
+from bleak import BleakClient
+from bleak.exc import BleakError
+
+from odo.metrics import default_registry
+from .models import LovenseDeviceState
+from .scheduler import PatternScheduler
+from .pipeline import CommandPipeline
+from .patterns import foho
+
+service_uuid = "58300001-0023-4BD4-BBD5-A6920E4C5653"
+tx_char_uuid = "58300002-0023-4BD4-BBD5-A6920E4C5653"
+rx_char_uuid = "58300003-0023-4BD4-BBD5-A6920E4C5653"
+
+class LovenseDevice(object):
+    """A single toy with its own client, command pipeline, pattern scheduler
+    and state. The Lovense module runs one of these per toy, so a slow toy
+    only delays its own patterns"""
+    def __init__(self, address, ble_device=None, on_change=None, priorities=None, merge_window=None, cached_timeout=5, connect_timeout=20, retry_interval=1, battery_interval=10, metrics=None, *args, **kwargs):
+        self.address = address
+        # Found by a scan, connecting to it doesn't make bluez look for it again
+        self.ble_device = ble_device
+        self.name = getattr(ble_device, "name", None)
+        self.on_change = on_change
+        self.client = None
+        self.pipeline = None
+        self.cached_timeout = cached_timeout
+        self.connect_timeout = connect_timeout
+        self.retry_interval = retry_interval
+        self.battery_interval = battery_interval
+        self.scheduler = PatternScheduler(self.write_cmd, priorities=priorities, merge_window=merge_window)
+        self.state = LovenseDeviceState(address=address, name=self.name)
+        self._link_lost = None
+        self._searching_since = None
+        self.logger = logging.getLogger(f'odo.lovense.{address}')
+        self.metrics = (metrics if metrics is not None else default_registry.labels(module="lovense")).labels(device=address)
+        self._ble_write_seconds = self.metrics.histogram("ble_write_seconds", "Time for a BLE write to be acknowledged")
+        self._ble_connects = self.metrics.counter("ble_connects_total", "Connections to a toy, more than one means reconnects")
+        self._ble_errors = self.metrics.counter("ble_write_errors_total", "BLE writes that failed")
+        self._ble_reconnect_seconds = self.metrics.histogram("ble_reconnect_seconds", "Time from losing the toy, or first trying it, until it is connected again")
+        self._ble_connect_paths = {path: self.metrics.counter("ble_connect_path_total", "Connections made to the cached address or after a scan", labels={"path": path}) for path in ("cached", "scan")}
+        self.metrics.gauge("battery_percent", "Battery level reported by the toy", fn=lambda: self.state.battery)
+        self.metrics.counter("ble_replies_matched_total", "Replies matched to the command that asked", fn=lambda: self.pipeline.matched if self.pipeline else 0)
+        self.metrics.counter("ble_reply_timeouts_total", "Commands whose reply never came", fn=lambda: self.pipeline.timeouts if self.pipeline else 0)
+        self.metrics.counter("patterns_played_total", "Haptic patterns played to the end", fn=lambda: self.scheduler.played)
+        self.metrics.counter("patterns_merged_total", "Haptic events merged into one already playing or waiting", fn=lambda: self.scheduler.merged)
+        self.metrics.counter("patterns_preempted_total", "Haptic patterns cut off by a higher priority event", fn=lambda: self.scheduler.preempted)
+
+    def to_dict(self):
+        return self.state.to_dict()
+
+    @property
+    def connected(self):
+        return self.state.status == "connected" and self.pipeline is not None
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change(self)
+
+    async def _ble_write(self, data, response):
+        self.logger.debug(f"BLE Send: {data}")
+        started = perf_counter()
+        try:
+            await self.client.write_gatt_char(tx_char_uuid, bytes(data, encoding="UTF-8"), response=response)
+            self._ble_write_seconds.observe(perf_counter() - started)
+        except BleakError:
+            self._ble_errors.inc()
+            self.state = LovenseDeviceState(address=self.address, name=self.name, reconnect_time=self.state.reconnect_time)
+            self._changed()
+            if self._link_lost is not None:
+                self._link_lost.set()
+            raise ConnectionError
+
+    async def write_cmd(self, data):
+        """Writes a command that needs no reply, haptic commands go ahead of any telemetry"""
+        if self.pipeline is None:
+            raise ConnectionError
+        await self.pipeline.send(data)
+
+    async def query(self, cmd):
+        """Writes a command and handles its reply"""
+        if self.pipeline is None:
+            raise ConnectionError
+        response = await self.pipeline.request(cmd)
+        if response is not None:
+            self.process_ble_response(cmd, response)
+        return response
+
+    def process_ble_response(self, cmd, response):
+        if cmd.startswith("DeviceType"):
+            values = response.split(':')
+            self.logger.debug(f"Type: {values[0]} Version: {values[1]} MAC: {values[2]}")
+            self.state.device_type = values[0]
+            self.state.version = values[1]
+            self.state.mac_addr = values[2]
+            self._changed()
+
+        elif cmd.startswith("GetBatch"):
+            values = response.split(';')
+            self.logger.debug(f"Batch: {values[0]}")
+            self.state.batch = values[0]
+            self._changed()
+
+        elif cmd.startswith("Battery"):
+            values = response.split(';')
+            self.logger.debug(f"Battery: {values[0]}")
+            self.state.battery = int(values[0])
+            self._changed()
+
+        else:
+            self.logger.debug(f"Unknown command: {cmd} and response: {response}")
+
+    def ble_callback(self, sender: int, data: bytearray):
+        response = data.decode(encoding="UTF-8")
+        self.logger.debug(f"BLE Recv: {sender}: {response}")
+        if response.endswith(";") and self.pipeline is not None:
+            self.pipeline.feed(response)
+
+    async def ble_disconnect(self):
+        if self.client.is_connected:
+            await self.client.stop_notify(rx_char_uuid)
+            await self.client.disconnect()
+
+    def _on_ble_disconnect(self, client):
+        """Called by bleak when the link drops, ends the session so reconnecting starts at once"""
+        self.logger.info(f"Lost connection to {client.address}")
+        if self._searching_since is None:
+            self._searching_since = perf_counter()
+        if self.pipeline is not None:
+            self.pipeline.cancel()
+        if self._link_lost is not None:
+            self._link_lost.set()
+
+    async def get_battery(self):
+        while True:
+            if self.state.device_type is not None and self.scheduler.busy is False:
+                try:
+                    await self.query("Battery;")
+                    await asyncio.sleep(self.battery_interval)
+                except ConnectionError:
+                    await asyncio.sleep(1)
+            else:
+                await asyncio.sleep(1)
+
+    async def session(self, stop, target, path="cached", timeout=None):
+        """Connects to target and runs until the toy disconnects or stop is
+        set, returns False if it could not connect"""
+        self.logger.info(f"Starting loop for {target}")
+        connected = False
+        battery = None
+        self._link_lost = asyncio.Event()
+        try:
+            async with BleakClient(target, disconnected_callback=self._on_ble_disconnect, timeout=timeout or self.connect_timeout) as self.client:
+                self.logger.info(f"Connecting to: {target}")
+                connected = True
+                self._ble_connects.inc()
+                self._ble_connect_paths[path].inc()
+                self.state.status = "connected"
+
+                self.pipeline = CommandPipeline(self._ble_write)
+                try:
+                    await self.client.start_notify(rx_char_uuid, self.ble_callback)
+                    if self._searching_since is not None:
+                        reconnect_time = perf_counter() - self._searching_since
+                        self._ble_reconnect_seconds.observe(reconnect_time)
+                        self.state.reconnect_time = round(reconnect_time, 3)
+                        self.logger.info(f"Connected to {target} ({path}) in {reconnect_time:.2f}s")
+                        self._searching_since = None
+                    await self.query("DeviceType;")
+                    await self.query("GetBatch;")
+                    await self.scheduler.submit("connected", foho)
+                except Exception as e:
+                    self.logger.error(e)
+                    raise e
+
+                self._changed()
+                battery = asyncio.ensure_future(self.get_battery())
+
+                stopped = asyncio.ensure_future(stop.wait())
+                lost = asyncio.ensure_future(self._link_lost.wait())
+                await asyncio.wait([stopped, lost], return_when=asyncio.FIRST_COMPLETED)
+                stopped.cancel()
+                lost.cancel()
+
+                if stop.is_set():
+                    await self.ble_disconnect()
+        except Exception as e:
+            self.logger.error(f"Error connecting to {target}: {e}")
+        finally:
+            if battery is not None:
+                battery.cancel()
+                try:
+                    await battery
+                except CancelledError:
+                    pass
+            self._link_lost = None
+            if self.pipeline is not None:
+                self.pipeline.cancel()
+                self.pipeline = None
+            if connected:
+                self.state.status = "disconnected"
+                self._changed()
+                if self._searching_since is None:
+                    self._searching_since = perf_counter()
+
+        self.logger.info(f"Disconnect from: {target}")
+        return connected
+
+    async def run(self, stop):
+        """Keeps the toy connected until stop is set. Reconnects go straight
+        to its address, a toy that is out of range is tried again every
+        retry_interval"""
+        self._searching_since = perf_counter()
+        if self.ble_device is not None:
+            target, path, timeout = self.ble_device, "scan", None
+        else:
+            target, path, timeout = self.address, "cached", self.cached_timeout
+        while not stop.is_set():
+            connected = await self.session(stop, target, path=path, timeout=timeout)
+            target, path, timeout = self.address, "cached", self.cached_timeout
+            if not connected and not stop.is_set():
+                try:
+                    await asyncio.wait_for(stop.wait(), self.retry_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def cancel(self):
+        """Stops any pattern playing and drops those waiting"""
+        self.scheduler.cancel()
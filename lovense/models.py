@@ -1,13 +1,26 @@
-from odo.models import StateModel
+from odo.models import StateModel, PayloadModel
 
-class LovenseStatePayload(object):
-    def __init__(self, status="disconnected", device_type=None, version=None, mac_addr=None, batch=None, battery=0, *args, **kwargs):
+class LovenseDeviceState(PayloadModel):
+    _fields = ("address", "name", "device_type", "version", "mac_addr", "batch", "battery", "reconnect_time", "status")
+
+    def __init__(self, address=None, name=None, status="disconnected", device_type=None, version=None, mac_addr=None, batch=None, battery=0, reconnect_time=None, *args, **kwargs):
+        self.address = address
+        self.name = name
         self.device_type = device_type
         self.version = version
         self.mac_addr = mac_addr
         self.batch = batch
         self.battery = battery
+        # Seconds from losing the toy, or first trying it, until it was connected again
+        self.reconnect_time = reconnect_time
+        self.status = status
+
+class LovenseStatePayload(PayloadModel):
+    _fields = ("status", "devices")
+
+    def __init__(self, status="disconnected", devices=None, *args, **kwargs):
         self.status = status
+        self.devices = devices if devices is not None else []
 
 class LovenseStateModel(StateModel):
     def __init__(self, payload=dict(), *args, **kwargs):
@@ -28,4 +28,11 @@ event_patterns = {
                 "success": foho,
                 "failure": error
         }
-}
\ No newline at end of file
+}
+# Lower plays first, a higher priority event cuts off the pattern playing
+event_priorities = {
+        "written/failure": 0,
+        "written/success": 1,
+        "selected": 2,
+        "seen": 3
+}
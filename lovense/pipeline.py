@@ -0,0 +1,114 @@
+import asyncio
+import logging
+from collections import deque
+
+# Lovense replies don't name the command they answer, only their shape tells
+# them apart. Commands sharing a reply kind are never in flight together, so a
+# reply always goes to the command that asked for it.
+command_replies = {
+    "DeviceType": "device",
+    "GetBatch": "number",
+    "Battery": "number"
+}
+
+# Commands nothing waits on go out as write-without-response
+fire_and_forget = ("Vibrate",)
+
+command_timeouts = {
+    "DeviceType": 5
+}
+
+def command_name(command):
+    return command.split(':')[0].rstrip(';')
+
+def reply_kind(reply):
+    if ':' in reply:
+        return "device"
+    if reply.startswith("OK") or reply.startswith("ERR"):
+        return "ok"
+    return "number"
+
+class CommandPipeline(object):
+    """Writes commands to a toy and matches each notification to the command
+    it answers. Haptic writes go ahead of telemetry waiting to be written."""
+    def __init__(self, write, timeout=2):
+        self.logger = logging.getLogger('odo.lovense.CommandPipeline')
+        self.write = write
+        self.timeout = timeout
+        self.pending = {}
+        self._kind_locks = {}
+        self._write_lock = asyncio.Lock()
+        self._haptic_waiting = 0
+        self._haptic_done = asyncio.Event()
+        self._haptic_done.set()
+        self.matched = 0
+        self.unmatched = 0
+        self.timeouts = 0
+
+    async def _write(self, command, response, haptic=False):
+        if haptic:
+            self._haptic_waiting += 1
+            self._haptic_done.clear()
+        else:
+            # Telemetry only takes the radio once no haptic write is waiting for it
+            await self._haptic_done.wait()
+        try:
+            async with self._write_lock:
+                await self.write(command, response)
+        finally:
+            if haptic:
+                self._haptic_waiting -= 1
+                if self._haptic_waiting == 0:
+                    self._haptic_done.set()
+
+    async def send(self, command):
+        """Writes a command without waiting for a reply"""
+        name = command_name(command)
+        await self._write(command, response=name not in fire_and_forget, haptic=name in fire_and_forget)
+
+    async def request(self, command, timeout=None):
+        """Writes a command and returns its reply, None if none came in time"""
+        name = command_name(command)
+        kind = command_replies.get(name, "ok")
+        if timeout is None:
+            timeout = command_timeouts.get(name, self.timeout)
+
+        lock = self._kind_locks.setdefault(kind, asyncio.Lock())
+        async with lock:
+            future = asyncio.get_running_loop().create_future()
+            waiting = self.pending.setdefault(kind, deque())
+            waiting.append(future)
+            try:
+                await self._write(command, response=True)
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                self.logger.warning(f"No reply to {command} within {timeout}s")
+                return None
+            finally:
+                if future in waiting:
+                    waiting.remove(future)
+
+    def feed(self, reply):
+        """Called with each complete notification"""
+        kind = reply_kind(reply)
+        waiting = self.pending.get(kind)
+        while waiting:
+            future = waiting.popleft()
+            if not future.done():
+                self.matched += 1
+                future.set_result(reply)
+                return True
+        # Vibrate is written without response but the toy still says OK
+        if kind != "ok":
+            self.unmatched += 1
+            self.logger.debug(f"Reply nothing is waiting for: {reply}")
+        return False
+
+    def cancel(self):
+        """Fails every request still waiting for a reply, the link is gone"""
+        for waiting in self.pending.values():
+            for future in waiting:
+                if not future.done():
+                    future.set_exception(ConnectionError("Disconnected before the reply"))
+            waiting.clear()
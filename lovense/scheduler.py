@@ -0,0 +1,145 @@
+import heapq
+import asyncio
+import logging
+import itertools
+from collections import deque
+
+from .patterns import vibe_off
+
+class LoopClock(object):
+    """Real time from the running event loop"""
+    def now(self):
+        return asyncio.get_running_loop().time()
+
+    async def sleep_until(self, deadline):
+        await asyncio.sleep(max(deadline - self.now(), 0))
+
+class PatternScheduler(object):
+    """Plays haptic patterns without blocking the event loop.
+
+    One pattern plays at a time. A higher priority event (lower number)
+    preempts the one playing, others wait their turn in priority order. An
+    event already playing or waiting is merged rather than queued again.
+    Steps are timed against absolute deadlines, so a slow write delays its own
+    step and is caught up on the next one instead of drifting the pattern.
+    """
+    def __init__(self, write, clock=None, priorities=None, default_priority=10, merge_window=None):
+        self.logger = logging.getLogger('odo.lovense.PatternScheduler')
+        self.write = write
+        self.clock = clock if clock is not None else LoopClock()
+        self.priorities = priorities if priorities is not None else {}
+        self.default_priority = default_priority
+        # A repeat of the playing event within merge_window seconds of it starting is dropped, None for the whole pattern
+        self.merge_window = merge_window
+        self.pending = []
+        self.playing = None
+        self._seq = itertools.count()
+        self._task = None
+        self.played = 0
+        self.merged = 0
+        self.preempted = 0
+        self.jitter = deque(maxlen=1000)
+
+    @property
+    def busy(self):
+        return self.playing is not None or bool(self.pending)
+
+    def _priority(self, event):
+        return self.priorities.get(event, self.default_priority)
+
+    def submit(self, event, pattern, priority=None):
+        """Schedules pattern for event, returns a future that resolves once it
+        has played, been merged into another or was preempted"""
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        if priority is None:
+            priority = self._priority(event)
+
+        playing = self.playing
+        if playing is not None and playing["event"] == event:
+            started = playing["started"]
+            if self.merge_window is None or started is None or self.clock.now() - started <= self.merge_window:
+                self.merged += 1
+                done.set_result("merged")
+                return done
+        for entry in self.pending:
+            if entry[2]["event"] == event:
+                self.merged += 1
+                done.set_result("merged")
+                return done
+
+        job = {"event": event, "pattern": pattern, "priority": priority, "done": done, "started": None, "task": None, "preempted": False}
+        heapq.heappush(self.pending, (priority, next(self._seq), job))
+
+        if playing is not None and priority < playing["priority"]:
+            self.logger.debug(f"{event} preempts {playing['event']}")
+            self.preempted += 1
+            playing["preempted"] = True
+            playing["task"].cancel()
+
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+        return done
+
+    async def _play(self, job):
+        deadline = self.clock.now()
+        job["started"] = deadline
+        for command, duration in job["pattern"]:
+            self.jitter.append(self.clock.now() - deadline)
+            await self.write(command)
+            deadline += duration
+            await self.clock.sleep_until(deadline)
+        if job["pattern"] and job["pattern"][-1][0] != vibe_off:
+            await self.write(vibe_off)
+
+    async def _run(self):
+        while self.pending:
+            priority, seq, job = heapq.heappop(self.pending)
+            self.playing = job
+            try:
+                await self._play_preemptible(job)
+            finally:
+                self.playing = None
+        self._task = None
+
+    async def _play_preemptible(self, job):
+        """Plays job in its own task so a higher priority submit can cancel just the pattern"""
+        task = asyncio.get_running_loop().create_task(self._play(job))
+        job["task"] = task
+        try:
+            await task
+            self.played += 1
+            result = "played"
+        except asyncio.CancelledError:
+            # Only swallow our own preemption, not the scheduler being shut down
+            if not job["preempted"]:
+                raise
+            result = "preempted"
+        except Exception as e:
+            self.logger.error(f"Pattern for {job['event']} failed: {e}")
+            result = "failed"
+        if not job["done"].done():
+            job["done"].set_result(result)
+
+    def stats(self):
+        jitter = sorted(abs(j) for j in self.jitter)
+        return {
+            "played": self.played,
+            "merged": self.merged,
+            "preempted": self.preempted,
+            "jitter_p50": jitter[len(jitter) // 2] if jitter else None,
+            "jitter_max": jitter[-1] if jitter else None
+        }
+
+    def cancel(self):
+        """Stops the playing pattern and drops everything waiting"""
+        for priority, seq, job in self.pending:
+            if not job["done"].done():
+                job["done"].set_result("cancelled")
+        self.pending = []
+        playing = self.playing
+        if playing is not None and playing["task"] is not None:
+            playing["preempted"] = True
+            playing["task"].cancel()
+            if not playing["done"].done():
+                playing["done"].set_result("cancelled")
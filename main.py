@@ -9,12 +9,8 @@ logging.basicConfig(level=logging.DEBUG,
 
 logger = logging.getLogger('odo.main')
 
-from espkey import ESPKey
-from proxmark3 import Proxmark3
-from screen_ws13 import Screen
-from lovense import Lovense
-
-modules = []
+from odo.plugins import PluginRegistry, resident_memory
+from odo.supervisor import Supervisor
 
 try:
     with open('config.yaml','r') as file:
@@ -24,47 +20,40 @@ except IOError:
     sys.exit(1)
 
 if __name__ == "__main__":
+    # Modules in this process share the in-process bus instead of each round tripping through the broker
+    # Settings every python module shares, metrics_port serves all of their metrics from one endpoint
+    # The broker too, so module processes send heartbeats where the supervisor listens. A module's own mqtt_host still wins
+    shared_config = {
+        "local_bus": config.get('local_bus', False),
+        "mqtt_bridge": config.get('mqtt_bridge', True),
+        "metrics_port": config.get('metrics_port'),
+        "mqtt_host": config.get('mqtt_host', "localhost"),
+        "mqtt_port": config.get('mqtt_port', 1883)
+    }
+
+    # Each module is imported only when enabled, in its own process if processes is set
+    plugins = PluginRegistry()
+    logger.info(f"Core loaded, {resident_memory() / 1024:.0f} KiB resident")
+    supervisor = Supervisor(plugins, shared_config,
+        processes=config.get('processes', False),
+        mqtt_host=shared_config["mqtt_host"],
+        mqtt_port=shared_config["mqtt_port"],
+        heartbeat_interval=config.get('heartbeat_interval', 5),
+        shutdown_deadline=config.get('shutdown_deadline', 10),
+        ready_modules=config.get('ready_modules'),
+        ready_timeout=config.get('ready_timeout', 120)
+    )
     for module in config['modules']:
         logger.info(f"{module} enabled.")
         mod_config = config['modules'][module]
         if mod_config:
             logger.debug(f"{module} config: {mod_config}")
+        try:
+            supervisor.add(module, mod_config)
+        except ValueError as e:
+            logger.error(e)
 
-    if "espkey" in config['modules']:
-        mod_config = config['modules']['espkey']
-        if mod_config:
-            esp = ESPKey(**mod_config)
-        else:
-            esp = ESPKey()
-        modules.append(esp)
-
-    if "proxmark3" in config['modules']:
-        mod_config = config['modules']['proxmark3']
-        if mod_config:
-            pm3 = Proxmark3(**mod_config)
-        else:
-            pm3 = Proxmark3()
-        modules.append(pm3)
-    
-    if "screen_ws13" in config['modules']:
-        mod_config = config['modules']['screen_ws13']
-        if mod_config:
-            ws13 = Screen(**mod_config)
-        else:
-            ws13 = Screen()
-        modules.append(ws13)
-
-    if "lovense" in config['modules']:
-        mod_config = config['modules']['lovense']
-        if mod_config:
-            lvs = Lovense(**mod_config)
-        else:
-            lvs = Lovense()
-        modules.append(lvs)
-
-    for module in modules:
-        logger.info(f"Starting: {module}")
-        module.start()
+    supervisor.start()
 
     try:
         input("Press enter or Ctrl + c to end")
@@ -72,8 +61,5 @@ if __name__ == "__main__":
         pass
     finally:
         logger.info("Received signal, exiting")
-        
-    for module in modules:
-        logger.info(f"Stopping: {module}")
-        module.terminate()
-        module.join()
+
+    supervisor.stop()
@@ -0,0 +1,98 @@
+import threading
+import logging
+from collections import OrderedDict
+from paho.mqtt.client import topic_matches_sub
+
+class LocalMessage(object):
+    """Stands in for a paho MQTTMessage, carrying the published model
+    itself. The payload is only serialized if a handler asks for it."""
+    def __init__(self, topic, model, wire_format="json"):
+        self.topic = topic
+        self.model = model
+        self.wire_format = wire_format
+        self._payload = None
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            if hasattr(self.model, "encode"):
+                self._payload = self.model.encode(self.wire_format)
+            elif isinstance(self.model, str):
+                self._payload = self.model.encode('utf-8')
+            else:
+                self._payload = self.model
+        return self._payload
+
+class LocalBus(object):
+    """In-process publish/subscribe for modules running in the same interpreter.
+
+    Handlers are called in the publisher's thread. Messages that are also
+    bridged to MQTT come back from the broker to every local subscriber,
+    those echoes are recorded here so each subscriber can drop its copy.
+    """
+    def __init__(self, max_echoes=1024):
+        self.logger = logging.getLogger('odo.LocalBus')
+        self.subscribers = {}
+        self.max_echoes = max_echoes
+        self._echoes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def subscribe(self, topic, callback):
+        with self._lock:
+            self.subscribers.setdefault(topic, []).append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            for topic in list(self.subscribers):
+                callbacks = [c for c in self.subscribers[topic] if c != callback]
+                if callbacks:
+                    self.subscribers[topic] = callbacks
+                else:
+                    del self.subscribers[topic]
+
+    def _matching(self, topic):
+        with self._lock:
+            callbacks = list(self.subscribers.get(topic, []))
+            for sub, subscribed in self.subscribers.items():
+                if sub != topic and ('+' in sub or '#' in sub) and topic_matches_sub(sub, topic):
+                    callbacks.extend(subscribed)
+        return callbacks
+
+    def publish(self, topic, model, wire_format="json"):
+        """Delivers model to every local subscriber of topic, returns the
+        message and the subscribers called"""
+        callbacks = self._matching(topic)
+        msg = LocalMessage(topic, model, wire_format=wire_format)
+        for callback in callbacks:
+            try:
+                callback(msg)
+            except Exception as e:
+                self.logger.error(f"Local handler for {topic} failed: {e}")
+        return msg, callbacks
+
+    def bridged(self, topic, payload, callbacks):
+        """Records a payload sent on to MQTT that callbacks already received locally"""
+        if not callbacks:
+            return
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        with self._lock:
+            key = (topic, payload)
+            self._echoes.setdefault(key, []).extend(callbacks)
+            self._echoes.move_to_end(key)
+            while len(self._echoes) > self.max_echoes:
+                self._echoes.popitem(last=False)
+
+    def echoed(self, topic, payload, callback):
+        """True if this MQTT message was already delivered locally to callback"""
+        with self._lock:
+            key = (topic, payload)
+            callbacks = self._echoes.get(key)
+            if not callbacks or callback not in callbacks:
+                return False
+            callbacks.remove(callback)
+            if not callbacks:
+                del self._echoes[key]
+            return True
+
+default_bus = LocalBus()
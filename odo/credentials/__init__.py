@@ -1,48 +1,165 @@
 import json
-from odo.models import MqttApiModel
-class WiegandPayload(object):
-    def __init__(self, bits=None, hex=None):
-        self.bits = bits
-        self.hex = hex
+import threading
+from collections import OrderedDict
+from time import monotonic
+from odo.models import MqttApiModel, PayloadModel
+
+class WiegandPayload(PayloadModel):
+    """Keeps the credential value as an int and caches every encoding derived
+    from it, setting bits or hex clears the cache"""
+    __slots__ = ("_bits", "_hex", "_value", "_binary", "_bytes", "_preamble")
+    _fields = ("bits", "hex")
+
+    def __init__(self, bits=None, hex=None, *args, **kwargs):
+        self._bits = bits
+        self._hex = hex
+        self._clear()
+
+    def _clear(self):
+        self._value = None
+        self._binary = None
+        self._bytes = None
+        self._preamble = None
+
+    @property
+    def bits(self):
+        return self._bits
+
+    @bits.setter
+    def bits(self, bits):
+        self._bits = bits
+        self._clear()
+
+    @property
+    def hex(self):
+        return self._hex
+
+    @hex.setter
+    def hex(self, hex):
+        self._hex = hex
+        self._clear()
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = int(self._hex, 16)
+        return self._value
 
 class WiegandCredential(MqttApiModel):
+    __slots__ = ()
+
     def __init__(self, payload=dict(), *args, **kwargs):
         super(WiegandCredential, self).__init__(*args, **kwargs)
         self.version = 1
         self.type = "wiegand"
         self.payload = WiegandPayload(**payload)
-    
+
     def to_binary(self):
-        return bin(int(self.payload.hex, 16))[2:].zfill(int(self.payload.bits))
+        payload = self.payload
+        if payload._binary is None:
+            payload._binary = bin(payload.value)[2:].zfill(int(payload.bits))
+        return payload._binary
 
     def to_bytes(self):
-        num = self.bits / 8
-        if self.bits % 8:
-            num += 1
-        return int(self.payload.hex, 16).to_bytes(num, 'big')
+        payload = self.payload
+        if payload._bytes is None:
+            payload._bytes = payload.value.to_bytes((int(payload.bits) + 7) // 8, 'big')
+        return payload._bytes
 
     def to_hex(self, preamble=False):
         if preamble:
             return self._prox_preamble()
         else:
-            return self.payload.hex()
+            return self.payload.hex
 
     def _prox_preamble(self):
-        t = int()
-        bitnum = self.payload.bits
+        """HID prox raw value, the card data with a sentinel bit above it and
+        bit 37 set for formats shorter than 37 bits"""
+        payload = self.payload
+        if payload._preamble is None:
+            bits = int(payload.bits)
+            t = payload.value
+            if bits < 37:
+                t |= 1 << 37 | 1 << bits
+            payload._preamble = hex(t)[2:]
+        return payload._preamble
 
-        if bitnum < 37:
-            t = 1 << 37
-            t = t | 1 << bitnum
+    def __str__(self):
+        return f"Bits: {self.payload.bits} Hex: {self.payload.hex}"
 
-        for bit in self.to_binary():
-            bitnum = bitnum - 1
-            if bit == '1':
-                t = t | 1 << bitnum
-            else:
-                t = t | 0 << bitnum
+encodings = {
+    "binary": WiegandCredential.to_binary,
+    "bytes": WiegandCredential.to_bytes,
+    "hex": WiegandCredential.to_hex,
+    "preamble": WiegandCredential._prox_preamble
+}
 
-        return hex(t)[2:]
+def encode_batch(credentials, encoding="binary"):
+    """Encodes a list of credentials in one call, repeated credentials come
+    from the cache"""
+    encode = encodings[encoding]
+    return [encode(credential) for credential in credentials]
 
-    def __str__(self):
-        return f"Bits: {self.payload.bits} Hex: {self.payload.hex}"
\ No newline at end of file
+class DedupCache(object):
+    """Remembers credentials by (bits, value) for window seconds so a repeat
+    can be suppressed, wherever it came from. Once max_size are remembered
+    the one added longest ago is dropped. A window of None or 0 remembers
+    nothing"""
+    def __init__(self, window=60, max_size=1024):
+        self.window = window
+        self.max_size = max_size
+        self.suppressed = 0
+        self._added = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._added)
+
+    @staticmethod
+    def key(credential):
+        payload = credential.payload
+        if payload.bits is None or payload.hex is None:
+            return None
+        return (int(payload.bits), payload.value)
+
+    def _expire(self, now):
+        while len(self._added) > self.max_size:
+            self._added.popitem(last=False)
+        cutoff = now - self.window
+        while self._added:
+            key, added = next(iter(self._added.items()))
+            if added >= cutoff:
+                break
+            self._added.popitem(last=False)
+
+    def suppress(self, credential):
+        """Returns True, and counts it, if credential was added within the window"""
+        key = self.key(credential)
+        if not self.window or key is None:
+            return False
+        with self._lock:
+            self._expire(monotonic())
+            if key in self._added:
+                self.suppressed += 1
+                return True
+        return False
+
+    def add(self, credential):
+        """Starts the window for credential again"""
+        key = self.key(credential)
+        if not self.window or key is None:
+            return
+        with self._lock:
+            now = monotonic()
+            self._added.pop(key, None)
+            self._added[key] = now
+            self._expire(now)
+
+    def check(self, credential):
+        """Returns True the first time credential is seen within the window
+        and adds it, False for a repeat"""
+        with self._lock:
+            if self.suppress(credential):
+                return False
+            self.add(credential)
+            return True
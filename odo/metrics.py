@@ -0,0 +1,182 @@
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from odo.tracing import LatencyHistogram
+
+logger = logging.getLogger('odo.metrics')
+
+class Counter(object):
+    """Only goes up. Updates are a plain attribute add, no lock on the hot path,
+    so an increment can very rarely be lost if two threads update one counter"""
+    __slots__ = ("value", "fn")
+    kind = "counter"
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        return self.fn() if self.fn is not None else self.value
+
+class Gauge(Counter):
+    """Set to the current value, or read from fn when scraped so the hot path pays nothing"""
+    __slots__ = ()
+    kind = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+class Histogram(LatencyHistogram):
+    kind = "histogram"
+
+def _format_labels(labels, extra=None):
+    labels = dict(labels)
+    if extra:
+        labels.update(extra)
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{str(value)}"' for name, value in sorted(labels.items()))
+    return "{" + pairs + "}"
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class MetricsRegistry(object):
+    """Metrics for every module in the process, rendered in Prometheus text format.
+    Create metrics once and keep the reference, lookups are not for the hot path"""
+    def __init__(self, prefix="odo"):
+        self.prefix = prefix
+        self.metrics = {}
+        self.help = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        key = (name, tuple(sorted((label, str(value)) for label, value in (labels or {}).items())))
+        with self._lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = cls(**kwargs)
+                self.metrics[key] = metric
+                self.help.setdefault(name, (help, cls.kind))
+            elif kwargs.get("fn") is not None:
+                # A module restarted, read from the new instance
+                metric.fn = kwargs["fn"]
+            return metric
+
+    def counter(self, name, help="", labels=None, fn=None):
+        return self._get(Counter, name, help, labels, fn=fn)
+
+    def gauge(self, name, help="", labels=None, fn=None):
+        return self._get(Gauge, name, help, labels, fn=fn)
+
+    def histogram(self, name, help="", labels=None, **kwargs):
+        return self._get(Histogram, name, help, labels, **kwargs)
+
+    def labels(self, **labels):
+        return LabelledRegistry(self, labels)
+
+    def _render_metric(self, name, labels, metric):
+        if metric.kind != "histogram":
+            try:
+                value = metric.get()
+            except Exception as e:
+                logger.error(f"Could not read {name}: {e}")
+                return []
+            return [f"{name}{_format_labels(labels)} {_format_value(value)}"]
+
+        lines = []
+        cumulative = 0
+        for bound, count in zip(metric.buckets, metric.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labels, {'le': bound})} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels, {'le': '+Inf'})} {metric.count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(metric.sum)}")
+        lines.append(f"{name}_count{_format_labels(labels)} {metric.count}")
+        return lines
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self.metrics.items(), key=lambda item: item[0])
+            help = dict(self.help)
+
+        lines = []
+        current = None
+        for (name, labels), metric in metrics:
+            full_name = f"{self.prefix}_{name}" if self.prefix else name
+            if name != current:
+                description, kind = help[name]
+                lines.append(f"# HELP {full_name} {description}")
+                lines.append(f"# TYPE {full_name} {kind}")
+                current = name
+            lines.extend(self._render_metric(full_name, dict(labels), metric))
+        return "\n".join(lines) + "\n"
+
+class LabelledRegistry(object):
+    """A view on a registry that adds the same labels to every metric"""
+    def __init__(self, registry, labels):
+        self.registry = registry
+        self.base_labels = labels
+
+    def _labels(self, labels):
+        return {**self.base_labels, **(labels or {})}
+
+    def counter(self, name, help="", labels=None, fn=None):
+        return self.registry.counter(name, help, self._labels(labels), fn=fn)
+
+    def gauge(self, name, help="", labels=None, fn=None):
+        return self.registry.gauge(name, help, self._labels(labels), fn=fn)
+
+    def histogram(self, name, help="", labels=None, **kwargs):
+        return self.registry.histogram(name, help, self._labels(labels), **kwargs)
+
+    def labels(self, **labels):
+        return LabelledRegistry(self.registry, self._labels(labels))
+
+default_registry = MetricsRegistry()
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ("/", "/metrics"):
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+def serve(port, host="0.0.0.0", registry=default_registry):
+    """Starts the Prometheus endpoint, modules sharing a port share one server"""
+    with _servers_lock:
+        if port in _servers:
+            return _servers[port]
+        try:
+            server = ThreadingHTTPServer((host, port), _Handler)
+        except OSError as e:
+            logger.error(f"Could not start metrics endpoint on port {port}: {e}")
+            return None
+        server.daemon_threads = True
+        server.registry = registry
+        threading.Thread(target=server.serve_forever, name=f"metrics-{port}", daemon=True).start()
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        _servers[port] = server
+        return server
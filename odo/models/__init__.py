@@ -2,25 +2,85 @@ import paho.mqtt.client as mqtt
 import json
 import threading
 import logging
+from operator import attrgetter
 from time import sleep
+from odo.bus import LocalBus, default_bus
+from odo import serialization
+from odo.metrics import default_registry, serve
 
 default_cred_topics = {
             "seen": "credentials/seen",
             "selected": "credentials/selected",
             "written": "credentials/written"
         }
-class StatePayload(object):
+
+def _to_dict(o):
+    if hasattr(o, "to_dict"):
+        return o.to_dict()
+    return o.__dict__
+
+def _fields_serializer(fields):
+    """Builds a to_dict for a fixed tuple of attribute names"""
+    if not fields:
+        return lambda self: {}
+    if len(fields) == 1:
+        field = fields[0]
+        return lambda self: {field: getattr(self, field)}
+    getter = attrgetter(*fields)
+    return lambda self: dict(zip(fields, getter(self)))
+
+class PayloadModel(object):
+    """Payloads list their fields in _fields, the serializer for them is built
+    once when the class is defined rather than walking __dict__ on every publish"""
+    __slots__ = ()
+    _fields = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super(PayloadModel, cls).__init_subclass__(**kwargs)
+        cls.to_dict = _fields_serializer(cls._fields)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+class StatePayload(PayloadModel):
+    _fields = ("status",)
+
     def __init__(self, status="disconnected", *args, **kwargs):
         self.status = status
 
 class MqttApiModel(object):
+    __slots__ = ("version", "type", "payload")
+
     def __init__(self):
         self.version = 1
         self.type = None
         self.payload = None
 
+    def to_dict(self):
+        payload = self.payload
+        if hasattr(payload, "to_dict"):
+            payload = payload.to_dict()
+        return {"version": self.version, "type": self.type, "payload": payload}
+
+    @classmethod
+    def from_dict(cls, data):
+        model = cls(payload=data.get("payload") or {})
+        model.version = data.get("version", model.version)
+        return model
+
     def to_json(self):
-        return json.dumps(self, default=lambda o: o.__dict__)
+        return json.dumps(self.to_dict(), default=_to_dict)
+
+    def encode(self, wire_format="json"):
+        """Serialized message as bytes in the given wire format"""
+        if wire_format == "json":
+            return self.to_json().encode('utf-8')
+        return serialization.encode(self.to_dict(), wire_format)
+
+    @classmethod
+    def decode(cls, payload):
+        return cls.from_dict(serialization.decode(payload))
 
 class StateModel(MqttApiModel):
     def __init__(self, payload=dict()):
@@ -29,8 +89,38 @@ class StateModel(MqttApiModel):
         self.type = "state"
         self.payload = StatePayload(**payload)
 
+class PipelineStatePayload(PayloadModel):
+    _fields = ("status", "modules", "ready_seconds")
+
+    def __init__(self, status="starting", modules=None, ready_seconds=None, *args, **kwargs):
+        self.status = status
+        self.modules = modules if modules is not None else {}
+        self.ready_seconds = ready_seconds
+
+class PipelineStateModel(MqttApiModel):
+    def __init__(self, payload=dict()):
+        super(PipelineStateModel, self).__init__()
+        self.version = 1
+        self.type = "state"
+        self.payload = PipelineStatePayload(**payload)
+
+class MetricsModel(MqttApiModel):
+    def __init__(self, payload=dict()):
+        super(MetricsModel, self).__init__()
+        self.version = 1
+        self.type = "metrics"
+        self.payload = dict(payload)
+
+class StateDeltaModel(MqttApiModel):
+    """The payload fields of a state that changed since the last one published"""
+    def __init__(self, payload=dict()):
+        super(StateDeltaModel, self).__init__()
+        self.version = 1
+        self.type = "delta"
+        self.payload = dict(payload)
+
 class BaseMqttDeviceModel(threading.Thread):
-    def __init__(self, mqtt_host="localhost", cred_topics=default_cred_topics, mqtt_retry=True, *args, **kwargs):
+    def __init__(self, mqtt_host="localhost", mqtt_port=1883, cred_topics=default_cred_topics, mqtt_retry=True, local_bus=False, mqtt_bridge=True, wire_format="json", metrics_port=None, metrics_host="0.0.0.0", heartbeat_interval=None, state_retain=True, state_delta=False, *args, **kwargs):
         super(BaseMqttDeviceModel, self).__init__(*args, **kwargs)
         self.daemon = True
         self.logger = logging.getLogger('odo.BaseMqttDeviceModel')
@@ -40,10 +130,34 @@ class BaseMqttDeviceModel(threading.Thread):
         self.credential_topic = cred_topics
         self.state = StateModel()
         self.mqtt_host = mqtt_host
+        self.mqtt_port = mqtt_port
         self.mqtt_retry = mqtt_retry
         self.mqtt_client = None
+        if isinstance(local_bus, LocalBus):
+            self.bus = local_bus
+        else:
+            self.bus = default_bus if local_bus else None
+        self.mqtt_bridge = mqtt_bridge
+        self.wire_format = serialization.wire_format(wire_format)
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.metrics = default_registry.labels(module=self.__module__.lower())
+        self._published = self.metrics.counter("mqtt_published_total", "Messages published")
+        self._received = self.metrics.counter("mqtt_received_total", "Messages handled")
+        self._state_unchanged = self.metrics.counter("state_unchanged_total", "State publishes skipped because nothing changed")
+        self._connects = self.metrics.counter("mqtt_connects_total", "Connections to the broker, more than one means reconnects")
+        self.metrics.gauge("mqtt_connected", "Connected to the broker", fn=lambda: self.mqtt_client is not None and self.mqtt_client.is_connected())
         self._subscribe_topics = [self.command_topic]
         self._retry = True
+        self._stop_event = threading.Event()
+        # Seconds between state republished while healthy, for a supervisor to watch. None to only publish changes
+        self.heartbeat_interval = heartbeat_interval
+        # State is only published when it changes, retained so a late subscriber
+        # gets the current one. With state_delta the changed fields also go to <state topic>/delta
+        self.state_retain = state_retain
+        self.state_delta = state_delta
+        self._state_sent = {}
+        self._state_lock = threading.RLock()
 
     def _subscribe(self):
         for topic in self._subscribe_topics:
@@ -53,6 +167,7 @@ class BaseMqttDeviceModel(threading.Thread):
     def _on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             self.logger.info(f"Connected to MQTT Broker: {self.mqtt_host}")
+            self._connects.inc()
         else:
             self.logger.error(f"Failed to connect, return code {rc}")
             raise(ConnectionError)
@@ -62,14 +177,45 @@ class BaseMqttDeviceModel(threading.Thread):
         self.logger.debug(f"MQTT Message received, but not handled")
         pass
 
+    def _on_mqtt_message(self, client, userdata, msg):
+        if self.bus is not None and self.bus.echoed(msg.topic, msg.payload, self._on_local_message):
+            return
+        self._received.inc()
+        self._on_message(client, userdata, msg)
+
+    """Overload if handlers must run on a particular thread, local messages arrive on the publisher's"""
+    def _on_local_message(self, msg):
+        self._received.inc()
+        self._on_message(None, None, msg)
+
+    def publish(self, topic, model, retain=False):
+        """Publishes a model, co-located modules on the local bus get the object
+        itself and MQTT only sees it if bridging is enabled"""
+        self._published.inc()
+        if self.bus is None:
+            payload = model.encode(self.wire_format) if isinstance(model, MqttApiModel) else model
+            self.mqtt_client.publish(topic, payload, retain=retain)
+            return
+
+        # Local handlers may already have serialized the message, reuse it
+        msg, callbacks = self.bus.publish(topic, model, wire_format=self.wire_format)
+        if self.mqtt_bridge:
+            self.bus.bridged(topic, msg.payload, callbacks)
+            self.mqtt_client.publish(topic, msg.payload, retain=retain)
+
     def _create_mqtt_client(self):
         c = mqtt.Client()
         c.on_connect = self._on_connect
-        c.on_message = self._on_message
+        c.on_message = self._on_mqtt_message
+        if self.state_retain:
+            # A module that dies without disconnecting doesn't leave its last state retained
+            will = json.loads(self.state.to_json())
+            will["payload"]["status"] = "disconnected"
+            c.will_set(self.state_topic, serialization.encode(will, self.wire_format), retain=True)
         got_client = False
         while self._retry:
             try:
-                c.connect(self.mqtt_host)
+                c.connect(self.mqtt_host, self.mqtt_port)
                 got_client = True
             except ConnectionRefusedError:
                 if self.mqtt_retry:
@@ -84,9 +230,25 @@ class BaseMqttDeviceModel(threading.Thread):
             self.logger.debug("Not connected to MQTT and not retrying")
             return None
 
-    def _send_state(self):
-        self.mqtt_client.publish(self.state_topic, self.state.to_json())
-        self.mqtt_client.loop()
+    def publish_state(self, topic, model, force=False):
+        """Publishes a state model if it differs from the last one sent on
+        topic, or if forced. Returns True if it was published"""
+        snapshot = json.loads(model.to_json())
+        with self._state_lock:
+            last = self._state_sent.get(topic)
+            if snapshot == last and not force:
+                self._state_unchanged.inc()
+                return False
+            self._state_sent[topic] = snapshot
+            self.publish(topic, model, retain=self.state_retain)
+            if self.state_delta and last is not None:
+                changed = {field: value for field, value in snapshot["payload"].items() if last["payload"].get(field) != value}
+                if changed:
+                    self.publish(f"{topic}/delta", StateDeltaModel(payload=changed))
+        return True
+
+    def _send_state(self, force=False):
+        self.publish_state(self.state_topic, self.state, force=force)
 
     def _disconnect(self):
         self.state.payload.status = "disconnected"
@@ -95,13 +257,39 @@ class BaseMqttDeviceModel(threading.Thread):
             self.mqtt_client.disconnect()
         return
 
+    """Overload to run the module's own work, MQTT is serviced by paho's network
+    thread so handlers run as soon as a message arrives. Return once terminated"""
     def loop(self):
-        raise NotImplementedError("Must override loop")
+        self._stop_event.wait()
+
+    def wait(self, timeout=None):
+        """Sleeps for timeout seconds or until terminated, returns True if terminated"""
+        return self._stop_event.wait(timeout)
+
+    """Overload if the module can do its job before, or only after, its state says connected"""
+    def ready(self):
+        return self.state.payload.status == "connected"
+
+    """Overload to also check the module's own worker threads"""
+    def healthy(self):
+        return self.is_alive()
+
+    def _heartbeat(self):
+        while not self.wait(self.heartbeat_interval):
+            if self.healthy():
+                self._send_state(force=True)
+            else:
+                self.logger.error("Unhealthy, skipping heartbeat")
 
     def terminate(self):
+        if self.bus is not None:
+            self.bus.unsubscribe(self._on_local_message)
         self._cleanup()
         self._retry = False
         self.running = False
+        self._stop_event.set()
+        if self.mqtt_client:
+            self.mqtt_client.loop_stop()
 
     """Overload to cleanup connections when terminated"""
     def _cleanup(self):
@@ -109,7 +297,15 @@ class BaseMqttDeviceModel(threading.Thread):
         pass
 
     def run(self):
+        if self.metrics_port is not None:
+            serve(self.metrics_port, host=self.metrics_host)
         self.mqtt_client = self._create_mqtt_client()
         if self.mqtt_client:
+            if self.bus is not None:
+                for topic in self._subscribe_topics:
+                    self.bus.subscribe(topic, self._on_local_message)
             self.running = True
+            self.mqtt_client.loop_start()
+            if self.heartbeat_interval:
+                threading.Thread(target=self._heartbeat, name=f"{self.__module__.lower()}-heartbeat", daemon=True).start()
             self.loop()
@@ -0,0 +1,83 @@
+import os
+import logging
+import importlib
+from time import perf_counter
+
+from odo.models import BaseMqttDeviceModel
+from odo.metrics import default_registry
+
+# Name in config.yaml -> "package:Class". Only imported when enabled, so a
+# Pi running just espkey never loads bleak or pexpect
+builtin_modules = {
+    "espkey": "espkey:ESPKey",
+    "proxmark3": "proxmark3:Proxmark3",
+    "screen_ws13": "screen_ws13:Screen",
+    "lovense": "lovense:Lovense",
+    "history": "history:History"
+}
+
+# Other packages can add modules by declaring entry points in this group
+entry_point_group = "odo.modules"
+
+def _entry_points():
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return {}
+    found = entry_points()
+    # Python 3.9 returns a dict of groups
+    group = found.select(group=entry_point_group) if hasattr(found, "select") else found.get(entry_point_group, [])
+    return {entry_point.name: entry_point.value for entry_point in group}
+
+def resident_memory():
+    """Resident set size of this process in bytes, 0 where /proc isn't available"""
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, ValueError, IndexError):
+        return 0
+
+class PluginRegistry(object):
+    """Finds the class for each module enabled in config.yaml and creates it,
+    recording how long the import and constructor took and the memory they
+    added. Modules loaded later share what earlier ones imported, so their
+    figures only cover what was new"""
+    def __init__(self, modules=builtin_modules, registry=default_registry):
+        self.logger = logging.getLogger('odo.plugins.PluginRegistry')
+        self.modules = {**_entry_points(), **modules}
+        self.metrics = registry
+        self.stats = {}
+
+    def load(self, name):
+        """Imports the class registered as name"""
+        if name not in self.modules:
+            raise ValueError(f"Unknown module {name}, expected one of {', '.join(sorted(self.modules))}")
+        path, _, attribute = self.modules[name].partition(':')
+        return getattr(importlib.import_module(path), attribute)
+
+    def create(self, name, config=None, shared_config=None):
+        """Imports and creates module name, shared_config only goes to modules
+        built on BaseMqttDeviceModel"""
+        memory = resident_memory()
+        started = perf_counter()
+        cls = self.load(name)
+        imported = perf_counter()
+
+        kwargs = dict(config or {})
+        if issubclass(cls, BaseMqttDeviceModel):
+            kwargs = {**(shared_config or {}), **kwargs}
+        module = cls(**kwargs)
+        created = perf_counter()
+
+        stats = {
+            "import_seconds": round(imported - started, 4),
+            "init_seconds": round(created - imported, 4),
+            "memory_bytes": resident_memory() - memory
+        }
+        self.stats[name] = stats
+        metrics = self.metrics.labels(module=name)
+        metrics.gauge("module_import_seconds", "Time to import the module at startup").set(stats["import_seconds"])
+        metrics.gauge("module_init_seconds", "Time to create the module at startup").set(stats["init_seconds"])
+        metrics.gauge("module_memory_bytes", "Resident memory added by importing and creating the module").set(stats["memory_bytes"])
+        self.logger.info(f"{name}: imported in {stats['import_seconds']:.3f}s, created in {stats['init_seconds']:.3f}s, {stats['memory_bytes'] / 1024:.0f} KiB")
+        return module
@@ -0,0 +1,50 @@
+import json
+import logging
+
+logger = logging.getLogger('odo.serialization')
+
+# Compact binary encodings are optional, JSON is always available
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+def _json_encode(data):
+    return json.dumps(data).encode('utf-8')
+
+encoders = {"json": _json_encode}
+if msgpack is not None:
+    encoders["msgpack"] = msgpack.packb
+if cbor2 is not None:
+    encoders["cbor"] = cbor2.dumps
+
+wire_formats = ("json", "msgpack", "cbor")
+
+def wire_format(name):
+    """Checks a configured wire format, falling back to JSON if its library is missing"""
+    if name not in wire_formats:
+        raise ValueError(f"Unknown wire format: {name}")
+    if name not in encoders:
+        logger.error(f"Wire format {name} not installed, falling back to json")
+        return "json"
+    return name
+
+def encode(data, wire_format="json"):
+    return encoders[wire_format](data)
+
+def decode(payload):
+    """Decodes a message in any wire format. Every message is a map, so the
+    first byte tells JSON from a msgpack or CBOR map"""
+    if isinstance(payload, str):
+        return json.loads(payload)
+    first = payload[0] if payload else 0
+    if msgpack is not None and (0x80 <= first <= 0x8f or first in (0xde, 0xdf)):
+        return msgpack.unpackb(payload, raw=False)
+    if cbor2 is not None and 0xa0 <= first <= 0xbf:
+        return cbor2.loads(payload)
+    return json.loads(payload)
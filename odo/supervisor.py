@@ -0,0 +1,382 @@
+import sys
+import signal
+import logging
+import threading
+import multiprocessing
+from time import monotonic
+
+import paho.mqtt.client as mqtt
+
+from odo.models import PipelineStateModel
+from odo.plugins import PluginRegistry
+from odo.serialization import decode
+from odo.metrics import default_registry, serve
+
+pipeline_topic = "devices/pipeline/state"
+
+def _run_module(name, path, config, shared_config, conn, shutdown_deadline):
+    """Entry point of a module's own process, exits non-zero if the module
+    stops being healthy so the supervisor restarts it"""
+    logger = logging.getLogger(f'odo.supervisor.{name}')
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    # Ctrl + c reaches the whole process group, the supervisor decides when modules stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    module = PluginRegistry(modules={name: path}).create(name, config, shared_config)
+    conn.send({
+        "state_topic": getattr(module, "state_topic", None),
+        "heartbeat": bool(getattr(module, "heartbeat_interval", None))
+    })
+    conn.close()
+    module.start()
+
+    healthy = getattr(module, "healthy", module.is_alive)
+    failed = False
+    while not stop.wait(1):
+        if not healthy():
+            logger.error(f"{name} is no longer healthy")
+            failed = True
+            break
+    module.terminate()
+    module.join(shutdown_deadline)
+    sys.exit(1 if failed else 0)
+
+class ThreadWorker(object):
+    """A module run as a thread of this process, as main.py always did"""
+    def __init__(self, name, config, shared_config, plugins):
+        self.name = name
+        self.config = config
+        self.shared_config = shared_config
+        self.plugins = plugins
+        self.module = None
+        self.state_topic = None
+        self.heartbeat = False
+
+    def start(self):
+        self.module = None
+        module = self.plugins.create(self.name, self.config, self.shared_config)
+        module.start()
+        self.module = module
+
+    def healthy(self):
+        if self.module is None:
+            return False
+        healthy = getattr(self.module, "healthy", self.module.is_alive)
+        return healthy()
+
+    def ready(self, statuses):
+        if self.module is None:
+            return False
+        ready = getattr(self.module, "ready", self.healthy)
+        return ready()
+
+    def stop(self):
+        if self.module is not None:
+            self.module.terminate()
+
+    def join(self, timeout=None):
+        if self.module is None:
+            return True
+        self.module.join(timeout)
+        return not self.module.is_alive()
+
+    def kill(self):
+        # Threads can't be killed, the module's daemon threads end with the process
+        pass
+
+class ProcessWorker(object):
+    """A module run in its own interpreter, so it has its own GIL and a crash
+    takes down only that module"""
+    def __init__(self, name, config, shared_config, plugins, shutdown_deadline=10):
+        self.name = name
+        # Passed as "package:Class", the child imports nothing else
+        self.path = plugins.modules[name]
+        self.config = config
+        self.shared_config = shared_config
+        self.shutdown_deadline = shutdown_deadline
+        self.process = None
+        self.state_topic = None
+        self.heartbeat = False
+        self._conn = None
+        # spawn rather than fork, the child only imports the module it runs
+        self._context = multiprocessing.get_context("spawn")
+
+    def start(self):
+        self.process = None
+        self._conn, child_conn = self._context.Pipe(duplex=False)
+        process = self._context.Process(target=_run_module, args=(self.name, self.path, self.config, self.shared_config, child_conn, self.shutdown_deadline), name=f"odo-{self.name}")
+        process.start()
+        child_conn.close()
+        self.process = process
+
+    def _read_info(self):
+        """The child says which topic its heartbeat comes on once the module is created"""
+        try:
+            if self._conn is not None and self._conn.poll():
+                info = self._conn.recv()
+                self.state_topic = info["state_topic"]
+                self.heartbeat = info["heartbeat"]
+                self._conn.close()
+                self._conn = None
+        except (EOFError, OSError):
+            self._conn = None
+
+    def healthy(self):
+        self._read_info()
+        return self.process is not None and self.process.is_alive()
+
+    def ready(self, statuses):
+        """Ready once the module's own state says connected, the screen has no state so running will do"""
+        if not self.healthy():
+            return False
+        if self.state_topic is None:
+            return self._conn is None
+        return statuses.get(self.state_topic) == "connected"
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+
+    def join(self, timeout=None):
+        if self.process is None:
+            return True
+        self.process.join(timeout)
+        return not self.process.is_alive()
+
+    def kill(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.kill()
+            self.process.join(1)
+
+class Supervisor(object):
+    """Starts every module, restarts one that exits, stops being healthy or
+    whose heartbeat stops, waiting longer after each failure, and stops them
+    all in parallel.
+
+    With processes each module runs in its own process and publishes its
+    state every heartbeat_interval seconds while healthy. A module missing
+    heartbeats for heartbeat_timeout seconds is restarted, but only while
+    the supervisor itself is connected to the broker.
+
+    Modules are started together and the pipeline state on pipeline_topic
+    says "ready" once every module in ready_modules (default all of them)
+    is ready, "degraded" if one isn't ready_timeout seconds after start or
+    drops out later, and "starting" until then. How long each module took is
+    in it too."""
+    def __init__(self, plugins=None, shared_config=None, processes=False, mqtt_host="localhost", mqtt_port=1883, heartbeat_interval=5, heartbeat_timeout=None, startup_grace=5, restart_backoff=1, restart_backoff_max=60, stable_after=60, shutdown_deadline=10, check_interval=1, ready_modules=None, ready_timeout=120, registry=default_registry):
+        self.logger = logging.getLogger('odo.supervisor.Supervisor')
+        self.plugins = plugins if plugins is not None else PluginRegistry()
+        self.shared_config = dict(shared_config or {})
+        self.processes = processes
+        self.mqtt_host = mqtt_host
+        self.mqtt_port = mqtt_port
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout if heartbeat_timeout is not None else heartbeat_interval * 3
+        self.startup_grace = startup_grace
+        self.restart_backoff = restart_backoff
+        self.restart_backoff_max = restart_backoff_max
+        # A module up this long has its backoff reset
+        self.stable_after = stable_after
+        self.shutdown_deadline = shutdown_deadline
+        self.check_interval = check_interval
+        self.ready_modules = ready_modules
+        self.ready_timeout = ready_timeout
+        self.metrics = registry
+        self.workers = []
+        self.heartbeats = {}
+        self.statuses = {}
+        self.state = PipelineStateModel()
+        self.started = None
+        self.ready_at = None
+        self.metrics.gauge("pipeline_ready_seconds", "Time from start until every module was ready", fn=lambda: self.state.payload.ready_seconds)
+        self.mqtt_client = None
+        self._connected_at = None
+        self._stop_event = threading.Event()
+        self._monitor = None
+
+        if self.processes:
+            if self.shared_config.get("local_bus"):
+                self.logger.warning("The local bus only reaches modules in the same process, using MQTT between module processes")
+            self.shared_config["local_bus"] = False
+            self.shared_config["heartbeat_interval"] = heartbeat_interval
+
+    def add(self, name, config=None):
+        if name not in self.plugins.modules:
+            raise ValueError(f"Unknown module {name}, expected one of {', '.join(sorted(self.plugins.modules))}")
+        if self.processes:
+            shared_config = self.shared_config
+            if shared_config.get("metrics_port"):
+                # The supervisor serves its own metrics on metrics_port, each module process the ports after it
+                shared_config = {**shared_config, "metrics_port": shared_config["metrics_port"] + len(self.workers) + 1}
+            worker = ProcessWorker(name, config, shared_config, self.plugins, shutdown_deadline=self.shutdown_deadline)
+        else:
+            worker = ThreadWorker(name, config, self.shared_config, self.plugins)
+        worker.started = None
+        worker.ready_at = None
+        worker.failures = 0
+        worker.restart_at = None
+        metrics = self.metrics.labels(module=name)
+        worker.ready_seconds = metrics.gauge("module_ready_seconds", "Time from the module starting until it was ready")
+        worker.restarts = metrics.counter("module_restarts_total", "Times the supervisor restarted the module")
+        metrics.gauge("module_up", "Module running and healthy", fn=lambda: worker.restart_at is None and worker.started is not None)
+        self.workers.append(worker)
+        return worker
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self._connected_at = monotonic()
+            client.subscribe("devices/+/state")
+
+    def _on_disconnect(self, client, userdata, rc):
+        self._connected_at = None
+
+    def _on_message(self, client, userdata, msg):
+        # Retained states are left from before this supervisor started
+        if msg.retain:
+            return
+        self.heartbeats[msg.topic] = monotonic()
+        try:
+            self.statuses[msg.topic] = decode(msg.payload)["payload"]["status"]
+        except (ValueError, KeyError, TypeError):
+            pass
+
+    def _connect(self):
+        self.mqtt_client = mqtt.Client()
+        self.mqtt_client.on_connect = self._on_connect
+        self.mqtt_client.on_disconnect = self._on_disconnect
+        self.mqtt_client.on_message = self._on_message
+        try:
+            self.mqtt_client.connect_async(self.mqtt_host, self.mqtt_port)
+            self.mqtt_client.loop_start()
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Can't connect to {self.mqtt_host}:{self.mqtt_port} for heartbeats and pipeline state: {e}")
+
+    def _start_worker(self, worker):
+        self.logger.info(f"Starting: {worker.name}")
+        worker.started = monotonic()
+        worker.ready_at = None
+        worker.restart_at = None
+        try:
+            worker.start()
+        except Exception as e:
+            self._restart_later(worker, f"failed to start: {e}", worker.started)
+
+    def start(self):
+        if self.processes and self.shared_config.get("metrics_port"):
+            serve(self.shared_config["metrics_port"], host=self.shared_config.get("metrics_host", "0.0.0.0"))
+        self._connect()
+        self.started = monotonic()
+        # Creating a module is quick, its handshake runs on its own thread, so
+        # every handshake is under way as soon as the last module is created
+        for worker in self.workers:
+            self._start_worker(worker)
+        self._monitor = threading.Thread(target=self._watch, name="supervisor", daemon=True)
+        self._monitor.start()
+
+    def _failure(self, worker, now):
+        """Why worker needs restarting, None if it doesn't"""
+        if now - worker.started < self.startup_grace:
+            return None
+        if not worker.healthy():
+            return "not running"
+        if worker.heartbeat and worker.state_topic and self._connected_at is not None:
+            last = max(self.heartbeats.get(worker.state_topic, 0), worker.started, self._connected_at)
+            if now - last > self.heartbeat_timeout:
+                return f"no heartbeat for {now - last:.0f}s"
+        return None
+
+    def _restart_later(self, worker, reason, now):
+        if now - worker.started >= self.stable_after:
+            worker.failures = 0
+        worker.failures += 1
+        delay = min(self.restart_backoff * 2 ** (worker.failures - 1), self.restart_backoff_max)
+        self.logger.error(f"{worker.name} {reason}, restarting in {delay}s")
+        worker.stop()
+        if not worker.join(self.shutdown_deadline):
+            worker.kill()
+        worker.restart_at = now + delay
+
+    def _update_readiness(self, now):
+        modules = {}
+        required = []
+        for worker in self.workers:
+            ready = worker.started is not None and worker.restart_at is None and worker.ready(self.statuses)
+            if ready and worker.ready_at is None:
+                worker.ready_at = now
+                worker.ready_seconds.set(round(now - worker.started, 3))
+                self.logger.info(f"{worker.name} ready after {now - worker.started:.2f}s")
+            modules[worker.name] = {
+                "ready": ready,
+                "seconds": round(worker.ready_at - worker.started, 3) if worker.ready_at is not None else None,
+                "restarts": worker.restarts.get()
+            }
+            if self.ready_modules is None or worker.name in self.ready_modules:
+                required.append(ready)
+
+        payload = self.state.payload
+        if all(required):
+            status = "ready"
+            if self.ready_at is None:
+                self.ready_at = now
+                payload.ready_seconds = round(now - self.started, 3)
+                self.logger.info(f"Pipeline ready after {payload.ready_seconds:.2f}s")
+        elif self.ready_at is None and now - self.started < self.ready_timeout:
+            status = "starting"
+        else:
+            status = "degraded"
+
+        if status != payload.status or modules != payload.modules:
+            if status != payload.status and status == "degraded":
+                self.logger.error(f"Pipeline degraded, not ready: {', '.join(name for name, module in modules.items() if not module['ready'])}")
+            payload.status = status
+            payload.modules = modules
+            if self.mqtt_client is not None:
+                self.mqtt_client.publish(pipeline_topic, self.state.encode(), retain=True)
+
+    def _watch(self):
+        # Readiness is timed closely until the pipeline is first ready, then checked every check_interval
+        while not self._stop_event.wait(self.check_interval if self.ready_at is not None else min(0.1, self.check_interval)):
+            now = monotonic()
+            for worker in self.workers:
+                if worker.restart_at is not None:
+                    if now >= worker.restart_at and not self._stop_event.is_set():
+                        worker.restarts.inc()
+                        self._start_worker(worker)
+                    continue
+                if worker.started is None:
+                    continue
+                reason = self._failure(worker, now)
+                if reason is not None:
+                    self._restart_later(worker, reason, now)
+            self._update_readiness(monotonic())
+
+    def stop(self, deadline=None):
+        """Stops every module at once, waiting at most deadline seconds in
+        total. Returns the names of modules still running after it"""
+        deadline = deadline if deadline is not None else self.shutdown_deadline
+        self._stop_event.set()
+        if self._monitor is not None:
+            self._monitor.join()
+        running = [worker for worker in self.workers if worker.started is not None and worker.restart_at is None]
+
+        # terminate() can block on a module's cleanup, so each gets its own thread
+        for worker in running:
+            self.logger.info(f"Stopping: {worker.name}")
+            threading.Thread(target=worker.stop, name=f"stop-{worker.name}", daemon=True).start()
+
+        ends = monotonic() + deadline
+        stuck = []
+        for worker in running:
+            if not worker.join(max(ends - monotonic(), 0)):
+                worker.kill()
+                stuck.append(worker.name)
+        for name in stuck:
+            self.logger.error(f"{name} did not stop within {deadline}s")
+
+        if self.mqtt_client is not None:
+            self.state.payload.status = "stopped"
+            self.mqtt_client.publish(pipeline_topic, self.state.encode(), retain=True)
+            self.mqtt_client.disconnect()
+            self.mqtt_client.loop_stop()
+        return stuck
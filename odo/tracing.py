@@ -0,0 +1,95 @@
+import uuid
+import time
+import bisect
+import threading
+
+# Upper bounds in seconds, the last bucket catches everything slower
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def new_trace():
+    return {"id": uuid.uuid4().hex, "stages": {}}
+
+def stamp(trace, stage, timestamp=None):
+    """Records the wall clock time a credential reached stage, starting a
+    trace if it doesn't have one yet. Returns the trace"""
+    if trace is None:
+        trace = new_trace()
+    trace["stages"][stage] = round(timestamp if timestamp is not None else time.time(), 4)
+    return trace
+
+def extend(trace, stage, timestamp=None):
+    """stamp() on a copy, for traces that other subscribers may still hold"""
+    if trace is None:
+        return stamp(None, stage, timestamp)
+    return stamp({"id": trace["id"], "stages": dict(trace["stages"])}, stage, timestamp)
+
+def intervals(trace):
+    """Seconds spent between each stage and the next, in the order they were
+    stamped, plus the total"""
+    stages = list(trace["stages"].items())
+    spans = [(f"{previous}->{stage}", end - start) for (previous, start), (stage, end) in zip(stages, stages[1:])]
+    if len(stages) > 1:
+        spans.append(("total", stages[-1][1] - stages[0][1]))
+    return spans
+
+class LatencyHistogram(object):
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of observations"""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def to_dict(self):
+        return {
+            "buckets": list(self.buckets),
+            "counts": self.counts,
+            "count": self.count,
+            "sum": round(self.sum, 4),
+            "max": round(self.max, 4),
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99)
+        }
+
+class TraceCollector(object):
+    """Aggregates finished traces into a latency histogram per stage"""
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self.stages = {}
+        self.traces = 0
+        self._lock = threading.Lock()
+
+    def record(self, trace):
+        if trace is None:
+            return
+        with self._lock:
+            self.traces += 1
+            for stage, seconds in intervals(trace):
+                if stage not in self.stages:
+                    self.stages[stage] = LatencyHistogram(self.buckets)
+                self.stages[stage].observe(max(seconds, 0))
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "traces": self.traces,
+                "stages": {stage: histogram.to_dict() for stage, histogram in self.stages.items()}
+            }
@@ -1,16 +1,17 @@
-import pexpect
-import sys
-import json
 import logging
-from time import sleep
-import re
+import queue
+import threading
+import itertools
+from time import monotonic
 
-from odo.models import BaseMqttDeviceModel
-from proxmark3.models import Proxmark3StateModel
+from odo.models import BaseMqttDeviceModel, MetricsModel
+from proxmark3.models import Proxmark3StateModel, Proxmark3WrittenCredential
 from espkey.models import ESPKeyCredential
-from .helpers import escape_ansi
-
-prox_regex = "^\[\=\]\sraw:\s*(.+)"
+from odo.credentials import WiegandCredential, DedupCache
+from odo.serialization import decode
+from odo.tracing import TraceCollector, extend, stamp
+from .helpers import WriteJob
+from .device import Proxmark3Device
 
 modes = {
     "auto": ["auto", "seen"],
@@ -18,51 +19,66 @@ modes = {
     "selected": ["selected"]
 }
 
+# Lower runs first, an operator selection jumps ahead of passively seen credentials
+job_priorities = {
+    "selected": 0,
+    "seen": 1
+}
+
 class Proxmark3(BaseMqttDeviceModel):
-    def __init__(self, port=None, client_timeout=10, client_retry=True, mode="seen", target="iclass", verify_prox=True, blind_write_attempts=3, *args, **kwargs):
+    def __init__(self, port=None, ports=None, command="pm3", client_timeout=10, client_retry=True, mode="seen", target="iclass", verify_prox=True, blind_write_attempts=3, command_timeout=30, queue_size=16, metrics_topic="metrics/latency", metrics_interval=10, dedup_window=60, dedup_max=1024, *args, **kwargs):
         super(Proxmark3, self).__init__(*args, **kwargs)
         self.logger = logging.getLogger('odo.proxmark3.Proxmark3')
-        self.port = port
-        self.client = None
-        self.client_timeout = client_timeout
-        self.client_retry = client_retry
-        self._retry_client = True
-        self.verify_prox = verify_prox
-        self.blind_write_attempts = blind_write_attempts
         self.state = Proxmark3StateModel()
         self.state.payload.target = target
+        self.jobs = queue.PriorityQueue(maxsize=queue_size)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._job_seq = itertools.count()
+        self.writers = []
+        # Devices whose client could not be started, their writer retries
+        # after client_retry_min seconds, then twice as long up to client_retry_max
+        self._down = set()
+        self.client_retry_min = 1
+        self.client_retry_max = 60
+        self.traces = TraceCollector()
+        self.metrics_topic = metrics_topic
+        self.metrics_interval = metrics_interval
+        self._metrics_sent = None
+        # Credentials written successfully, a seen repeat within the window isn't cloned again
+        self.dedup = DedupCache(window=dedup_window, max_size=dedup_max)
+
+        device_defaults = {
+            "target": target,
+            "command": command,
+            "client_timeout": client_timeout,
+            "client_retry": client_retry,
+            "verify_prox": verify_prox,
+            "blind_write_attempts": blind_write_attempts,
+            "command_timeout": command_timeout,
+            "metrics": self.metrics
+        }
+        self.devices = []
+        if ports:
+            for device in ports:
+                if not isinstance(device, dict):
+                    device = {"port": device}
+                self.devices.append(Proxmark3Device(**{**device_defaults, **device}))
+        else:
+            self.devices.append(Proxmark3Device(port=port, **device_defaults))
+        self._update_devices_state()
+        self.metrics.gauge("pm3_queue_depth", "Writes waiting for a device", fn=lambda: len(self._pending))
+        self.metrics.gauge("pm3_queue_wait_seconds", "How long the last write waited for a device", fn=lambda: self.state.payload.queue_wait)
+        self.metrics.counter("credentials_suppressed_total", "Seen credentials not written because they were written within dedup_window", fn=lambda: self.dedup.suppressed)
+        self.metrics.gauge("credential_dedup_size", "Credentials remembered for deduplication", fn=lambda: len(self.dedup))
+        self.metrics.gauge("pm3_devices_connected", "Devices with a running client", fn=lambda: sum(device.status != "disconnected" for device in self.devices))
+
         self._subscribe_topics = [
             self.credential_topic["seen"],
             self.credential_topic["selected"],
             self.command_topic
         ]
 
-    def _create_client(self):
-        command = 'pm3'
-        if self.port is not None:
-            command = f'pm3 -p {self.port}'
-        client = pexpect.spawnu(command)
-        while self._retry:
-            self.logger.info(f"Starting client with command: {command}")
-            try:
-                index = client.expect('pm3 --> ', timeout=self.client_timeout)
-            except pexpect.EOF:
-                self.logger.error("Error: could not open client, got EOF")
-                self._cleanup()
-                sys.exit(1)
-            except pexpect.TIMEOUT:
-                if self.client_retry:
-                    self.logger.error("Error: could not open client, got timeout, sleeping till retry")
-                    sleep(10)
-                    continue
-            else:            
-                if index == 0:
-                    self.logger.info(f"Proxmark3 client connected")
-                    self.state.payload.status = "connected"
-                    self._send_state()                
-                    return client
-        
-
     @property
     def mode(self):
         return self.state.payload.mode
@@ -81,10 +97,27 @@ class Proxmark3(BaseMqttDeviceModel):
                 else:
                     raise ValueError
 
+    def _change_target(self, target, port=None):
+        """Changes the target of every device, or only the device on port"""
+        for device in self.devices:
+            if port is None or device.port == port:
+                device.target = target
+        if port is None:
+            self.state.payload.target = target
+        self._update_devices_state()
+        self._send_state()
+
+    def _update_devices_state(self):
+        self.state.payload.devices = [device.to_dict() for device in self.devices]
+        if any(device.status != "disconnected" for device in self.devices):
+            self.state.payload.status = "connected"
+        else:
+            self.state.payload.status = "disconnected"
+
     def _subscribe(self):
         for topic in self._subscribe_topics:
             self.mqtt_client.subscribe(topic)
-    
+
     def _on_message(self, client, userdata, msg):
         self.logger.debug(f"Message received-> {msg.topic} {str(msg.payload)}")
 
@@ -96,12 +129,12 @@ class Proxmark3(BaseMqttDeviceModel):
             
 
     def _handle_command(self, msg=None):
-        message = json.loads(msg.payload)
+        message = decode(msg.payload)
         if message["type"] == "set":
             if "mode" in message["payload"]:
                 self._change_mode(mode=message["payload"]["mode"])
             if "target" in message["payload"]:
-                self.state.payload.target = message["payload"]["target"]
+                self._change_target(message["payload"]["target"], port=message["payload"].get("port"))
         else:
             self.logger.error("Command type not implemented")
 
@@ -118,136 +151,138 @@ class Proxmark3(BaseMqttDeviceModel):
             process_credential = True
 
         if process_credential:
-            message = json.loads(msg.payload)
+            model = getattr(msg, "model", None)
+            if isinstance(model, WiegandCredential):
+                self._queue_write(model, topic[1])
+                return
+
+            message = decode(msg.payload)
             if message["type"] == "wiegand":
-                credential = ESPKeyCredential(payload=message["payload"])
+                self._queue_write(ESPKeyCredential.from_dict(message), topic[1])
 
-                if self.target == "iclass":
-                    self.encode_iclass(credential=credential)
-                elif self.target == "prox":
-                    self.encode_prox(credential=credential)
-                else:
-                    raise NotImplementedError
-
-    def _send_command(self, command, result):
-        self.client.sendline(command)
-        try:
-            index = self.client.expect(result)
-        except pexpect.EOF:
-            self.logger.error("Got EOF")
-            self._cleanup()
-            sys.exit(1)
-        except pexpect.TIMEOUT:
-            self.logger.error("Timeout waiting for response")
-            self._cleanup()
-            sys.exit(1)
-        else:
-            if index == 0:
-                return escape_ansi(str(self.client.before))
-
-    def encode_iclass(self, credential=ESPKeyCredential()):
-        self.logger.info(f"{credential} Bin: {credential.to_binary()}")
-        status_msg = json.loads(credential.to_json())
-        status_msg["payload"]["status"] = "pending"
-        self.mqtt_client.publish(self.credential_topic["written"], json.dumps(status_msg))
-        self.mqtt_client.loop()
-
-        command = f"hf iclass encode --bin {credential.to_binary()} --ki 0"
-        self.logger.debug(f"-> {command}")
-        resp = self._send_command(command, 'pm3 --> ')
-        self.logger.debug(f"<- {resp}")
-        status = [False, False, False]
-        if "Write block 6/0x06 ( ok )".lower() in resp:
-            status[0] = True
-
-        if "Write block 7/0x07 ( ok )".lower() in resp:
-            status[1] = True
-
-        if "Write block 8/0x08 ( ok )".lower() in resp:
-            status[2] = True
-
-        if all(status):
-            self.logger.info(f"Credential: {credential} Written successfully")
-            status_msg["payload"]["status"] = "success"
-        else:
-            status_msg["payload"]["status"] = "failure"
-            for i, state in enumerate(status):
-                if state == False:
-                    self.logger.error(f"Error writing block {i+6}")
+    def _queue_write(self, credential, topic):
+        """Queues a write for the writer thread, a credential already pending is only requeued to raise its priority"""
+        # An operator selection is always written, even if it just was
+        if topic != "selected" and self.dedup.suppress(credential):
+            self.logger.info(f"Credential: {credential} written recently, not writing again")
+            return
+        priority = job_priorities.get(topic, 1)
+        # The incoming trace may be shared with other local subscribers, the job stamps a copy
+        trace = extend(getattr(credential.payload, "trace", None), "received")
+        job = WriteJob(credential, topic, priority, trace=trace)
+        with self._pending_lock:
+            pending = self._pending.get(job.key)
+            if pending is not None:
+                if priority >= pending.priority:
+                    self.logger.info(f"Credential: {credential} already queued")
+                    return
+                pending.cancelled = True
 
-        self.mqtt_client.publish(self.credential_topic["written"], json.dumps(status_msg))
+            try:
+                self.jobs.put_nowait((priority, next(self._job_seq), job))
+            except queue.Full:
+                self.logger.error(f"Write queue full, dropping credential: {credential}")
+                if pending is not None:
+                    pending.cancelled = False
+                return
+            self._pending[job.key] = job
 
-    def encode_prox(self, credential=ESPKeyCredential()):
-        preamble_cred = credential.to_hex(preamble=True)
-        self.logger.info(f"{credential} Bin: {credential.to_binary()} Hex(w/ preamble): {preamble_cred}")
-        status_msg = json.loads(credential.to_json())
+        self.state.payload.queue_depth = len(self._pending)
+        self._send_state()
 
-        status_msg["payload"]["status"] = "pending"
-        self.mqtt_client.publish(self.credential_topic["written"], json.dumps(status_msg))
-        self.mqtt_client.loop()
+    def _write(self, device, credential, trace=None):
+        status_msg = Proxmark3WrittenCredential(payload={**credential.payload.to_dict(), "status": "pending", "trace": trace})
+        self.publish(self.credential_topic["written"], status_msg)
+        self._update_devices_state()
+        self._send_state()
 
-        if not self.verify_prox:
-            retry = self.blind_write_attempts
-        else:
-            retry = 1
-        
-        while retry > 0:
-            retry -= 1
-            command = f"lf hid clone -r {preamble_cred}"
-            self.logger.debug(f"-> {command}")
-            resp = self._send_command(command, 'pm3 --> ')
-            self.logger.debug(f"<- {resp}")
-
-        if self.verify_prox:
-            retry = 3
-            while True:
-                # Check credential write
-                command = f"lf hid reader"
-                self.logger.debug(f"-> {command}")
-                resp = self._send_command(command, 'pm3 --> ')
-                self.logger.debug(f"<- {resp}")
-                
-                # Validate response
-                match = re.search(prox_regex, resp, re.MULTILINE)
-                if match:
-                    current_cred = match.group(1).lstrip('0').strip()
-                    self.logger.debug(f"Target cred: {preamble_cred} Actual cred: {current_cred}")
-                    if preamble_cred == current_cred:
-                        self.logger.info(f"Credential: {credential} Written & Verified successfully")
-                        status_msg["payload"]["status"] = "success"
-                        break
-                    else:
-                        self.logger.error(f"Target cred not cloned successfully")
-                        status_msg["payload"]["status"] = "failure"
-                else:
-                    if retry == 0:
-                        self.logger.error(f"Retries exceeded, target cred not cloned successfully")
-                        status_msg["payload"]["status"] = "failure"
-                        break
-                    else:
-                        retry -= 1
-                        self.logger.info(f"Retrying to validate write ({retry})")
-        else:
-            self.logger.info("Validation disabled, assuming success")
-            status_msg["payload"]["status"] = "success"
+        trace = extend(trace, "writing")
+        status = device.encode(credential, trace=trace)
+        stamp(trace, "written")
+        if status == "success":
+            self.dedup.add(credential)
+        # A new message rather than mutating the pending one, local subscribers may still hold it
+        status_msg = Proxmark3WrittenCredential(payload={**credential.payload.to_dict(), "status": status, "trace": trace})
+        self.publish(self.credential_topic["written"], status_msg)
+        self._update_devices_state()
+        self._send_state()
+        self.traces.record(trace)
+        self._send_metrics()
 
-        self.mqtt_client.publish(self.credential_topic["written"], json.dumps(status_msg))
+    def _send_metrics(self, force=False):
+        """Publishes the per stage latency histograms, at most every metrics_interval seconds"""
+        if self.metrics_topic is None:
+            return
+        now = monotonic()
+        if not force and self._metrics_sent is not None and now - self._metrics_sent < self.metrics_interval:
+            return
+        self._metrics_sent = now
+        self.publish(self.metrics_topic, MetricsModel(payload=self.traces.to_dict()))
 
+    def _start_client(self, device):
+        """Starts device's client, retrying with backoff until it is up or the
+        module is terminated. Returns True once it is up"""
+        retry = self.client_retry_min
+        while self.running:
+            if device.create_client() is not None:
+                self._down.discard(device)
+                self._update_devices_state()
+                self._send_state()
+                return True
+            self._down.add(device)
+            self._update_devices_state()
+            self._send_state()
+            self.logger.error(f"Could not start client for {device.name}, retrying in {retry} seconds")
+            if self.wait(retry):
+                break
+            retry = min(retry * 2, self.client_retry_max)
+        return False
+
+    def _writer(self, device):
+        """One writer per device, an idle device takes the next job off the shared
+        queue. A device without a client takes no jobs until it is back"""
+        while self.running:
+            if device.client is None and not self._start_client(device):
+                break
+
+            try:
+                priority, seq, job = self.jobs.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            with self._pending_lock:
+                if job.cancelled:
+                    continue
+                self._pending.pop(job.key, None)
+                self.state.payload.queue_depth = len(self._pending)
+
+            self.state.payload.queue_wait = round(monotonic() - job.queued, 3)
+            self._send_state()
+
+            if job.topic not in modes[self.mode]:
+                self.logger.debug(f"Dropping queued {job.topic} credential, mode changed to: {self.mode}")
+                continue
+
+            stamp(job.trace, "dequeued")
+            self._write(device, job.credential, trace=job.trace)
+
+    def healthy(self):
+        """Healthy while any writer is running with a client, one unplugged device doesn't stop the others"""
+        return super(Proxmark3, self).healthy() and (not self.writers or any(writer.is_alive() and device not in self._down for writer, device in zip(self.writers, self.devices)))
 
     def _cleanup(self):
-        if self.client:
-            if self.client.isalive():
-                self.client.sendline('quit')
-                index = self.client.expect(pexpect.EOF)
-                if index == 0:
-                    self.logger.info("Proxmark3 client closed cleanly")
+        for device in self.devices:
+            device.close()
 
         if self.mqtt_client:
+            if self.traces.traces:
+                self._send_metrics(force=True)
+            self._update_devices_state()
             self._disconnect()
 
     def loop(self):
-        if self.client is None:
-            self.client = self._create_client()
-
-        while self.running:
-            self.mqtt_client.loop()
+        for device in self.devices:
+            writer = threading.Thread(target=self._writer, args=(device,), name=f"proxmark3-{device.name}", daemon=True)
+            writer.start()
+            self.writers.append(writer)
+        self.wait()
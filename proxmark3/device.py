@@ -0,0 +1,257 @@
+import pexpect
+import logging
+from time import sleep, monotonic
+
+from .parser import Pm3OutputParser
+from odo.tracing import stamp
+from odo.metrics import default_registry
+
+prompt = 'pm3 --> '
+
+# Seconds a command may run before the client is considered stuck
+command_deadlines = {
+    "hf iclass encode": 15,
+    "lf hid clone": 10,
+    "lf hid reader": 10
+}
+
+class Proxmark3Device(object):
+    """A single pm3 client, the Proxmark3 module drives one of these per port"""
+    def __init__(self, port=None, target="iclass", command="pm3", client_timeout=10, client_retry=True, verify_prox=True, blind_write_attempts=3, command_timeout=30, metrics=None, *args, **kwargs):
+        self.port = port
+        self.target = target
+        self.command = command
+        self.client = None
+        self._unsynced = 0
+        self.client_timeout = client_timeout
+        self.command_timeout = command_timeout
+        self.client_retry = client_retry
+        self.retry = True
+        self.verify_prox = verify_prox
+        self.blind_write_attempts = blind_write_attempts
+        self.status = "disconnected"
+        self.writes = 0
+        self.name = port if port is not None else "default"
+        self.logger = logging.getLogger(f'odo.proxmark3.{self.name}')
+        self.metrics = (metrics if metrics is not None else default_registry.labels(module="proxmark3")).labels(device=self.name)
+        self._command_seconds = {}
+        self._restarts = self.metrics.counter("pm3_restarts_total", "Clients restarted after not responding")
+        self._timeouts = self.metrics.counter("pm3_timeouts_total", "Commands that hit their deadline")
+
+    def to_dict(self):
+        return {
+            "port": self.port,
+            "target": self.target,
+            "status": self.status,
+            "writes": self.writes
+        }
+
+    def create_client(self):
+        command = self.command
+        if self.port is not None:
+            command = f'{self.command} -p {self.port}'
+        client = pexpect.spawnu(command)
+        while self.retry:
+            self.logger.info(f"Starting client with command: {command}")
+            try:
+                index = client.expect(prompt, timeout=self.client_timeout)
+            except pexpect.EOF:
+                self.logger.error("Error: could not open client, got EOF")
+                client.close()
+                self.status = "disconnected"
+                return None
+            except pexpect.TIMEOUT:
+                if self.client_retry:
+                    self.logger.error("Error: could not open client, got timeout, sleeping till retry")
+                    sleep(10)
+                    continue
+            else:
+                if index == 0:
+                    self.logger.info(f"Proxmark3 client connected")
+                    self.status = "connected"
+                    self.client = client
+                    return client
+
+    def parser(self, command, **kwargs):
+        deadline = self.command_timeout
+        for prefix, seconds in command_deadlines.items():
+            if command.startswith(prefix):
+                deadline = seconds
+        return Pm3OutputParser(command=command, deadline=deadline, **kwargs)
+
+    def _command_histogram(self, command):
+        name = " ".join(command.split()[:3])
+        for prefix in command_deadlines:
+            if command.startswith(prefix):
+                name = prefix
+        histogram = self._command_seconds.get(name)
+        if histogram is None:
+            histogram = self.metrics.histogram("pm3_command_seconds", "Time from sending a command to its result", labels={"command": name})
+            self._command_seconds[name] = histogram
+        return histogram
+
+    def _sync(self):
+        """Drains output left over from a command we stopped reading early"""
+        while self._unsynced > 0:
+            self.client.expect(prompt, timeout=self.client_timeout)
+            self._unsynced -= 1
+
+    def _restart(self):
+        self.logger.error("Client not responding, restarting it")
+        self._restarts.inc()
+        self._unsynced = 0
+        self.status = "disconnected"
+        if self.client is not None:
+            self.client.terminate(force=True)
+            self.client = None
+        self.create_client()
+
+    def _recover(self, owed):
+        """Waits for the prompts still owed after a timeout, restarting the client if they never come"""
+        self._unsynced += owed
+        try:
+            self._sync()
+            self.logger.info("Client recovered")
+        except (pexpect.TIMEOUT, pexpect.EOF):
+            self._restart()
+
+    def _read_result(self, parser, stop_on_failure=False):
+        deadline = monotonic() + parser.deadline
+        while True:
+            index = self.client.expect([prompt, '\r?\n'], timeout=max(deadline - monotonic(), 0))
+            if index == 0:
+                return parser.finish(self.client.before)
+            if parser.feed(self.client.before) and stop_on_failure:
+                self.logger.debug(f"Failure certain, not waiting for the prompt")
+                self._unsynced += 1
+                return parser.result
+
+    def run(self, parsers, stop_on_failure=False):
+        """Sends a script of commands in one go and collects a result for each,
+        each command has its own deadline. A single command can stop reading
+        as soon as failure is certain."""
+        try:
+            self._sync()
+        except (pexpect.TIMEOUT, pexpect.EOF):
+            self._restart()
+
+        if self.client is None:
+            for parser in parsers:
+                parser.result.timed_out = True
+            return [parser.result for parser in parsers]
+
+        sent = 0
+        results = []
+        started = monotonic()
+        try:
+            for parser in parsers:
+                self.logger.debug(f"-> {parser.command}")
+                self.client.sendline(parser.command)
+                sent += 1
+            for parser in parsers:
+                result = self._read_result(parser, stop_on_failure=stop_on_failure and len(parsers) == 1)
+                # Pipelined commands queue behind each other, time each from when the previous finished
+                finished = monotonic()
+                self._command_histogram(parser.command).observe(finished - started)
+                started = finished
+                self.logger.debug(f"<- {result}")
+                results.append(result)
+        except (pexpect.TIMEOUT, pexpect.EOF, OSError) as e:
+            self.logger.error(f"{type(e).__name__} waiting for response to: {parser.command}")
+            self._timeouts.inc()
+            owed = sent - len(results)
+            for parser in parsers[len(results):]:
+                parser.result.timed_out = True
+                results.append(parser.result)
+            self._recover(owed)
+        return results
+
+    def _send_command(self, command, parser=None, stop_on_failure=True):
+        if parser is None:
+            parser = self.parser(command)
+        return self.run([parser], stop_on_failure=stop_on_failure)[0]
+
+    def encode(self, credential, trace=None):
+        """Writes the credential to the current target, returns the written status.
+        Each step is stamped on trace if one is given"""
+        previous = self.status
+        self.status = "writing"
+        try:
+            if self.target == "iclass":
+                status = self.encode_iclass(credential=credential, trace=trace)
+            elif self.target == "prox":
+                status = self.encode_prox(credential=credential, trace=trace)
+            else:
+                raise NotImplementedError
+        finally:
+            # A restart during the write has already set the status
+            if self.status == "writing":
+                self.status = previous
+        self.writes += 1
+        self.metrics.counter("pm3_writes_total", "Writes by target and result", labels={"target": self.target, "status": status}).inc()
+        return status
+
+    def _stamp(self, trace, stage):
+        if trace is not None:
+            stamp(trace, stage)
+
+    def encode_iclass(self, credential, trace=None):
+        self.logger.info(f"{credential} Bin: {credential.to_binary()}")
+        command = f"hf iclass encode --bin {credential.to_binary()} --ki 0"
+        result = self._send_command(command, self.parser(command, blocks=(6, 7, 8)))
+        self._stamp(trace, "encoded")
+
+        if result.success:
+            self.logger.info(f"Credential: {credential} Written successfully")
+            return "success"
+
+        for block in result.missing_blocks():
+            self.logger.error(f"Error writing block {block}")
+        for error in result.errors:
+            self.logger.error(error)
+        return "failure"
+
+    def encode_prox(self, credential, trace=None):
+        preamble_cred = credential.to_hex(preamble=True)
+        self.logger.info(f"{credential} Bin: {credential.to_binary()} Hex(w/ preamble): {preamble_cred}")
+
+        clone = f"lf hid clone -r {preamble_cred}"
+        verify = f"lf hid reader"
+        if not self.verify_prox:
+            self.run([self.parser(clone) for i in range(self.blind_write_attempts)])
+            self._stamp(trace, "encoded")
+            self.logger.info("Validation disabled, assuming success")
+            return "success"
+
+        # Clone and the first verify read go out as one script
+        results = self.run([self.parser(clone), self.parser(verify, expected_raw=preamble_cred)])
+        result = results[-1]
+        self._stamp(trace, "encoded")
+        retry = 3
+        while True:
+            self.logger.debug(f"Target cred: {preamble_cred} Actual cred: {result.raw}")
+            if result.success:
+                self.logger.info(f"Credential: {credential} Written & Verified successfully")
+                self._stamp(trace, "verified")
+                return "success"
+            elif result.raw is not None:
+                self.logger.error(f"Target cred not cloned successfully")
+
+            if retry == 0 or result.timed_out:
+                self.logger.error(f"Retries exceeded, target cred not cloned successfully")
+                return "failure"
+            retry -= 1
+            self.logger.info(f"Retrying to validate write ({retry})")
+            result = self._send_command(verify, self.parser(verify, expected_raw=preamble_cred))
+
+    def close(self):
+        self.retry = False
+        if self.client:
+            if self.client.isalive():
+                self.client.sendline('quit')
+                try:
+                    self.client.expect(pexpect.EOF, timeout=self.client_timeout)
+                    self.logger.info("Proxmark3 client closed cleanly")
+                except pexpect.TIMEOUT:
+                    self.client.terminate(force=True)
+        self.status = "disconnected"
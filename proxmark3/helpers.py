@@ -1,5 +1,16 @@
 import re
+from time import monotonic
 
 def escape_ansi(line):
     ansi_escape = re.compile(r'(\x9B|\x1B\[)[0-?]*[ -/]*[@-~]')
     return ansi_escape.sub('', str(line)).lower()
+
+class WriteJob(object):
+    def __init__(self, credential, topic, priority, trace=None):
+        self.credential = credential
+        self.topic = topic
+        self.priority = priority
+        self.trace = trace
+        self.key = (str(credential.payload.bits), str(credential.payload.hex).lower())
+        self.queued = monotonic()
+        self.cancelled = False
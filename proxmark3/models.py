@@ -1,12 +1,33 @@
-from odo.models import StateModel
+from odo.models import StateModel, PayloadModel
+from espkey.models import ESPKeyCredential, ESPKeyPayload
 
-class Proxmark3StatePayload(object):
-    def __init__(self, status="disconnected", mode="auto", target="iclass", *args, **kwargs):
+class Proxmark3StatePayload(PayloadModel):
+    _fields = ("status", "mode", "target", "queue_depth", "queue_wait", "devices")
+
+    def __init__(self, status="disconnected", mode="auto", target="iclass", queue_depth=0, queue_wait=0.0, devices=None, *args, **kwargs):
         self.status = status
         self.mode = mode
         self.target = target
+        self.queue_depth = queue_depth
+        self.queue_wait = queue_wait
+        self.devices = devices
 
 class Proxmark3StateModel(StateModel):
     def __init__(self, payload=dict(), *args, **kwargs):
         super(Proxmark3StateModel, self).__init__(*args, **kwargs)
         self.payload = Proxmark3StatePayload(**payload)
+
+class Proxmark3WrittenPayload(ESPKeyPayload):
+    __slots__ = ("status",)
+    _fields = ESPKeyPayload._fields + ("status",)
+
+    def __init__(self, status=None, *args, **kwargs):
+        super(Proxmark3WrittenPayload, self).__init__(*args, **kwargs)
+        self.status = status
+
+class Proxmark3WrittenCredential(ESPKeyCredential):
+    __slots__ = ()
+
+    def __init__(self, payload=dict(), *args, **kwargs):
+        super(Proxmark3WrittenCredential, self).__init__(*args, **kwargs)
+        self.payload = Proxmark3WrittenPayload(**payload)
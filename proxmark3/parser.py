@@ -0,0 +1,91 @@
+import re
+
+from .helpers import escape_ansi
+
+block_regex = re.compile(r'write block (\d+)/0x[0-9a-f]+ \( (\w+) \)')
+raw_regex = re.compile(r'^\[=\]\s+raw:\s*([0-9a-f]+)')
+error_regex = re.compile(r'^\[(-|!!)\]')
+warning_regex = re.compile(r'^\[!\]')
+
+class Pm3Result(object):
+    """Structured result of a single pm3 command"""
+    def __init__(self, command=None, blocks=None, expected_raw=None):
+        self.command = command
+        self.expected_blocks = blocks
+        self.expected_raw = expected_raw
+        self.blocks = {}
+        self.raw = None
+        self.errors = []
+        self.warnings = []
+        self.lines = []
+        self.complete = False
+        self.timed_out = False
+
+    @property
+    def failed(self):
+        """True as soon as the command can no longer succeed"""
+        if self.timed_out or self.errors:
+            return True
+        if not all(self.blocks.values()):
+            return True
+        if self.expected_raw is not None and self.raw is not None:
+            return self.raw != self.expected_raw
+        return False
+
+    @property
+    def success(self):
+        if not self.complete or self.failed:
+            return False
+        if self.expected_blocks is not None:
+            return all(self.blocks.get(block, False) for block in self.expected_blocks)
+        if self.expected_raw is not None:
+            return self.raw == self.expected_raw
+        return True
+
+    def missing_blocks(self):
+        if self.expected_blocks is None:
+            return []
+        return [block for block in self.expected_blocks if not self.blocks.get(block, False)]
+
+    def __str__(self):
+        return "\n".join(self.lines)
+
+class Pm3OutputParser(object):
+    """Incrementally parses pm3 client output into a Pm3Result, one line at a time"""
+    def __init__(self, command=None, blocks=None, expected_raw=None, deadline=30):
+        self.command = command
+        self.deadline = deadline
+        self.result = Pm3Result(command=command, blocks=blocks, expected_raw=expected_raw)
+
+    def feed(self, line):
+        """Parses a line of output, returns True once failure is certain"""
+        line = escape_ansi(line).strip()
+        if not line:
+            return self.result.failed
+        self.result.lines.append(line)
+
+        block = block_regex.search(line)
+        if block:
+            self.result.blocks[int(block.group(1))] = block.group(2) == "ok"
+            return self.result.failed
+
+        raw = raw_regex.match(line)
+        if raw:
+            self.result.raw = raw.group(1).lstrip('0')
+        elif error_regex.match(line):
+            self.result.errors.append(line)
+        elif warning_regex.match(line):
+            self.result.warnings.append(line)
+
+        return self.result.failed
+
+    def feed_text(self, text):
+        for line in str(text).splitlines():
+            self.feed(line)
+        return self.result.failed
+
+    def finish(self, remainder=""):
+        """Called when the prompt comes back, with any output before it"""
+        self.feed_text(remainder)
+        self.result.complete = True
+        return self.result
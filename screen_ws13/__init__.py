@@ -19,6 +19,13 @@ class Screen(threading.Thread):
         self.process = subprocess.Popen(["node", "index"], cwd=dir_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         #self.process.wait()
 
+    def healthy(self):
+        """run() returns once node is started, the screen lives as long as node does"""
+        return self.process is not None and self.process.poll() is None
+
+    def ready(self):
+        return self.healthy()
+
     def terminate(self):
         self._cleanup()
         if self.process is not None:
@@ -0,0 +1,53 @@
+from espkey.reader import ESPKeyReader
+from benchmarks.espkey_tail import FakeLogSession
+
+def reader(session):
+    esp = ESPKeyReader()
+    esp.session = session
+    return esp
+
+def hexes(credentials):
+    return [credential.payload.hex for credential in credentials]
+
+def test_startup_only_returns_the_newest_entry():
+    session = FakeLogSession()
+    for timestamp in range(50):
+        session.append(timestamp, hex=f"{0x20a7000 + timestamp:x}")
+    esp = reader(session)
+
+    assert hexes(esp.get_pacs_data()) == ["20a7031"]
+    # The older entries were marked seen, not left for the next poll
+    assert esp.get_pacs_data() == []
+    assert esp.captures == 0
+
+def test_every_entry_after_startup_is_returned():
+    session = FakeLogSession()
+    session.append(1, hex="20a7456")
+    esp = reader(session)
+    esp.get_pacs_data()
+
+    session.append(2, hex="20a7457")
+    session.append(3, hex="20a7458")
+    assert hexes(esp.get_pacs_data()) == ["20a7457", "20a7458"]
+    assert esp.get_pacs_data() == []
+    assert esp.captures == 2
+
+def test_entries_after_an_empty_startup_log_are_all_returned():
+    session = FakeLogSession()
+    esp = reader(session)
+    assert esp.get_pacs_data() == []
+
+    session.append(1, hex="20a7456")
+    session.append(2, hex="20a7457")
+    assert hexes(esp.get_pacs_data()) == ["20a7456", "20a7457"]
+
+def test_startup_without_range_support():
+    session = FakeLogSession(support_range=False, etag=False)
+    for timestamp in range(10):
+        session.append(timestamp, hex=f"{0x20a7000 + timestamp:x}")
+    esp = reader(session)
+
+    assert hexes(esp.get_pacs_data()) == ["20a7009"]
+    session.append(10, hex="20a7456")
+    session.append(11, hex="20a7457")
+    assert hexes(esp.get_pacs_data()) == ["20a7456", "20a7457"]
@@ -0,0 +1,125 @@
+import json
+import asyncio
+from time import perf_counter
+
+import pytest
+
+import lovense
+import lovense.device
+from lovense import Lovense
+from odo.metrics import MetricsRegistry
+from benchmarks import lovense_reconnect as fake
+
+lush = "AA:00:00:00:00:01"
+spare = "AA:00:00:00:00:02"
+
+class RecordingScanner(fake.FakeScanner):
+    """Remembers what each scan returned and how long it took"""
+    scans = []
+
+    @staticmethod
+    async def find_device_by_filter(filterfunc, timeout=10.0, **kwargs):
+        started = perf_counter()
+        device = await fake.FakeScanner.find_device_by_filter(filterfunc, timeout=timeout, **kwargs)
+        RecordingScanner.scans.append((device, perf_counter() - started))
+        return device
+
+@pytest.fixture
+def radio(monkeypatch):
+    """A fresh fake bleak backend in place of the real one"""
+    radio = fake.FakeRadio()
+    RecordingScanner.scans = []
+    monkeypatch.setattr(fake, "radio", radio)
+    monkeypatch.setattr(lovense.device, "BleakClient", fake.FakeClient)
+    monkeypatch.setattr(lovense, "BleakScanner", RecordingScanner)
+    return radio
+
+@pytest.fixture
+def make_lovense(tmp_path):
+    created = []
+
+    def make(cached=None, **kwargs):
+        cache = tmp_path / "lovense_device.json"
+        if cached is not None:
+            cache.write_text(json.dumps({"addresses": cached}))
+        lvs = Lovense(device_cache=str(cache), **kwargs)
+        lvs.mqtt_client = fake.NullMqttClient()
+        # Counts start at zero for every test
+        lvs.device_defaults["metrics"] = MetricsRegistry().labels(module="lovense")
+        created.append(lvs)
+        return lvs
+
+    yield make
+    for lvs in created:
+        lvs.event_loop.close()
+
+def run(lvs, scenario):
+    """Runs scenario alongside the module's scanner, then shuts it down"""
+    async def main():
+        scanner = asyncio.ensure_future(lvs.scanner())
+        try:
+            return await scenario()
+        finally:
+            lvs._cleanup()
+            await asyncio.wait_for(scanner, 10)
+    return lvs.event_loop.run_until_complete(main())
+
+def paths(device):
+    return {path: counter.get() for path, counter in device._ble_connect_paths.items()}
+
+def test_cached_address_is_connected_without_a_scan(radio, make_lovense):
+    radio.add(lush, "LVS-Lush")
+    lvs = make_lovense(cached=[lush], cached_timeout=1)
+
+    async def scenario():
+        started = perf_counter()
+        await fake.wait_connected(lvs, lush, 1, timeout=5)
+        return perf_counter() - started
+
+    seconds = run(lvs, scenario)
+    assert paths(lvs.devices[lush]) == {"cached": 1, "scan": 0}
+    # Scans skip toys already known, so none of them returned the cached one
+    assert all(device is None or device.address != lush for device, took in RecordingScanner.scans)
+    # One advertising interval and the connect, no scan or fixed sleeps first
+    assert seconds < fake.ble_timing["connect"] + 4 * fake.ble_timing["advertising_interval"] + 0.5
+
+def test_scan_stops_at_the_first_lvs_toy(radio, make_lovense):
+    radio.add("CC:00:00:00:00:01", "Phone")
+    radio.add(lush, "LVS-Lush")
+    radio.add(spare, "LVS-Spare")
+    lvs = make_lovense(scan_timeout=10)
+
+    async def scenario():
+        await fake.wait_connected(lvs, lush, 1, timeout=5)
+        await fake.wait_connected(lvs, spare, 1, timeout=5)
+
+    run(lvs, scenario)
+    found = [(device.address, took) for device, took in RecordingScanner.scans if device is not None]
+    assert [address for address, took in found] == [lush, spare]
+    # Each returned on the first advertisement, long before scan_timeout
+    assert all(took < 1 for address, took in found)
+    assert "CC:00:00:00:00:01" not in lvs.devices
+    assert paths(lvs.devices[lush]) == {"cached": 0, "scan": 1}
+
+def test_reconnect_time_is_recorded(radio, make_lovense):
+    radio.add(lush, "LVS-Lush")
+    lvs = make_lovense(cached_timeout=1)
+    away = 0.5
+
+    async def scenario():
+        await fake.wait_connected(lvs, lush, 1, timeout=5)
+        radio.leave(lush)
+        await asyncio.sleep(away)
+        radio.enter(lush)
+        return await fake.wait_connected(lvs, lush, 2, timeout=10)
+
+    reconnect_time = run(lvs, scenario)
+    device = lvs.devices[lush]
+    assert away < reconnect_time < away + 3
+    assert device.state.reconnect_time == reconnect_time
+    assert device._ble_reconnect_seconds.count == 2
+    # Found by a scan the first time, straight back to its address after the drop
+    assert paths(device) == {"cached": 1, "scan": 1}
+    assert any(entry["reconnect_time"] == reconnect_time for entry in lvs.state.payload.to_dict()["devices"])
+    with open(lvs.device_cache) as file:
+        assert json.load(file)["addresses"] == [lush]
@@ -0,0 +1,116 @@
+import os
+import re
+
+import pytest
+
+from odo.credentials import WiegandCredential
+from proxmark3.parser import Pm3OutputParser
+
+fixtures = os.path.join(os.path.dirname(__file__), "fixtures", "pm3")
+ansi = re.compile(r'\x1b\[[0-9;]*m')
+
+credential = WiegandCredential(payload={"bits": 26, "hex": "20a7456"})
+encode = f"hf iclass encode --bin {credential.to_binary()} --ki 0"
+preamble = credential.to_hex(preamble=True)
+
+def transcript(name, colour=True):
+    """Lines of a pm3 client transcript, with the ANSI colours stripped if colour is False"""
+    with open(os.path.join(fixtures, f"{name}.txt"), encoding="utf-8") as file:
+        text = file.read()
+    return (text if colour else ansi.sub('', text)).splitlines()
+
+def parse(name, colour=True, **kwargs):
+    """Feeds a transcript line by line as the device does, then the prompt"""
+    parser = Pm3OutputParser(**kwargs)
+    failed = [parser.feed(line) for line in transcript(name, colour)]
+    return parser.finish(), failed
+
+@pytest.mark.parametrize("colour", [True, False])
+def test_iclass_encode_all_blocks_ok(colour):
+    result, failed = parse("iclass_encode_ok", colour, command=encode, blocks=(6, 7, 8))
+    assert result.blocks == {6: True, 7: True, 8: True, 9: True}
+    assert result.success
+    assert not result.failed
+    assert result.missing_blocks() == []
+    assert not any(failed)
+
+@pytest.mark.parametrize("colour", [True, False])
+def test_iclass_encode_one_block_fails(colour):
+    result, failed = parse("iclass_encode_block_fail", colour, command=encode, blocks=(6, 7, 8))
+    assert result.blocks[7] is False
+    assert result.failed
+    assert not result.success
+    assert result.missing_blocks() == [7]
+    # Certain from the failed block on, so the device can stop reading there
+    assert failed == [False, False, False, True, True, True]
+
+def test_iclass_encode_error_lines():
+    result, failed = parse("iclass_encode_no_card", command=encode, blocks=(6, 7, 8))
+    assert result.errors == [
+        "[-] failed to authenticate with block 6",
+        "[!!] ⛔ failed to communicate with card"
+    ]
+    assert result.blocks == {}
+    assert result.failed
+    assert not result.success
+    assert result.missing_blocks() == [6, 7, 8]
+    assert failed == [False, False, True, True]
+
+@pytest.mark.parametrize("colour", [True, False])
+def test_lf_hid_reader_matches(colour):
+    result, failed = parse("lf_hid_reader_match", colour, command="lf hid reader", expected_raw=preamble)
+    assert result.raw == preamble
+    assert result.success
+    assert not any(failed)
+
+def test_lf_hid_reader_mismatch():
+    result, failed = parse("lf_hid_reader_mismatch", command="lf hid reader", expected_raw=preamble)
+    assert result.raw == "2006c3e0a1"
+    assert result.failed
+    assert not result.success
+    # Only the raw line decides it
+    assert failed == [False] * (len(failed) - 1) + [True]
+
+def test_lf_hid_reader_no_tag():
+    result, failed = parse("lf_hid_reader_no_tag", command="lf hid reader", expected_raw=preamble)
+    assert result.raw is None
+    assert result.complete
+    assert not result.failed
+    assert not result.success
+
+def test_warnings_are_not_failures():
+    parser = Pm3OutputParser(command="lf hid reader", expected_raw=preamble)
+    assert parser.feed("[\x1b[33m!\x1b[0m] ⚠️  Note: FSK demod only") is False
+    result = parser.finish(transcript("lf_hid_reader_match")[-1])
+    assert result.warnings == ["[!] ⚠️  note: fsk demod only"]
+    assert result.success
+
+def test_not_successful_until_finished():
+    parser = Pm3OutputParser(command=encode, blocks=(6, 7, 8))
+    for line in transcript("iclass_encode_ok"):
+        parser.feed(line)
+    assert not parser.result.complete
+    assert not parser.result.success
+    assert not parser.result.failed
+    assert parser.finish().success
+
+def test_missing_block_fails_on_finish():
+    parser = Pm3OutputParser(command=encode, blocks=(6, 7, 8))
+    for line in transcript("iclass_encode_ok")[:3]:
+        assert parser.feed(line) is False
+    result = parser.finish()
+    assert result.missing_blocks() == [7, 8]
+    assert not result.success
+
+def test_finish_parses_the_output_before_the_prompt():
+    parser = Pm3OutputParser(command="lf hid reader", expected_raw=preamble)
+    result = parser.finish("\r\n".join(transcript("lf_hid_reader_match")))
+    assert result.raw == preamble
+    assert result.success
+
+def test_timed_out_fails():
+    parser = Pm3OutputParser(command="lf hid reader", expected_raw=preamble)
+    parser.feed_text("\n".join(transcript("lf_hid_reader_match")))
+    parser.result.timed_out = True
+    assert parser.result.failed
+    assert not parser.finish().success
@@ -0,0 +1,96 @@
+import json
+import threading
+from time import monotonic, sleep
+
+import pytest
+
+from proxmark3 import Proxmark3
+from proxmark3.device import Proxmark3Device
+from espkey.models import ESPKeyCredential
+from benchmarks.proxmark3_pool import fake_pm3
+
+class RecordingMqttClient(object):
+    def __init__(self):
+        self.statuses = []
+
+    def publish(self, topic, payload, retain=False, **kwargs):
+        if topic == "credentials/written":
+            status = json.loads(payload)["payload"]["status"]
+            if status != "pending":
+                self.statuses.append(status)
+
+    def disconnect(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+def wait_for(condition, timeout=10):
+    deadline = monotonic() + timeout
+    while not condition():
+        if monotonic() > deadline:
+            raise TimeoutError
+        sleep(0.05)
+
+@pytest.fixture(autouse=True)
+def fast_pm3(monkeypatch):
+    monkeypatch.setenv("FAKE_PM3_DELAY", "0.01")
+
+@pytest.fixture
+def make_pm3():
+    created = []
+
+    def make(ports):
+        pm3 = Proxmark3(ports=ports, queue_size=16)
+        pm3.mqtt_client = RecordingMqttClient()
+        pm3.client_retry_max = 0.2
+        # Only the writers run, not the module thread
+        pm3.is_alive = lambda: True
+        pm3.running = True
+        threading.Thread(target=pm3.loop, daemon=True).start()
+        created.append(pm3)
+        return pm3
+
+    yield make
+    for pm3 in created:
+        pm3.terminate()
+
+def test_encode_without_a_client_keeps_it_disconnected():
+    device = Proxmark3Device(port="/dev/gone", command="false")
+    assert device.create_client() is None
+    for i in range(3):
+        assert device.encode(ESPKeyCredential(payload={"bits": 26, "hex": "20a7456"})) == "failure"
+        assert device.status == "disconnected"
+
+def test_encode_restores_connected():
+    device = Proxmark3Device(port="/dev/fake0", command=fake_pm3)
+    assert device.create_client() is not None
+    try:
+        assert device.encode(ESPKeyCredential(payload={"bits": 26, "hex": "20a7456"})) == "success"
+        assert device.status == "connected"
+    finally:
+        device.close()
+
+def test_dead_device_takes_no_jobs(make_pm3):
+    pm3 = make_pm3([{"port": "/dev/fake0", "command": fake_pm3}, {"port": "/dev/gone", "command": "false"}])
+    live, dead = pm3.devices
+    wait_for(lambda: live.status == "connected" and dead in pm3._down)
+
+    for i in range(8):
+        pm3._queue_write(ESPKeyCredential(payload={"bits": 26, "hex": f"{0x20a7000 + i:x}"}), "seen")
+    wait_for(lambda: len(pm3.mqtt_client.statuses) == 8)
+
+    assert pm3.mqtt_client.statuses == ["success"] * 8
+    assert live.writes == 8
+    assert dead.writes == 0
+    assert pm3.healthy()
+
+def test_unhealthy_once_every_client_is_down(make_pm3):
+    pm3 = make_pm3([{"port": "/dev/gone0", "command": "false"}, {"port": "/dev/gone1", "command": "false"}])
+    wait_for(lambda: len(pm3._down) == 2)
+    assert not pm3.healthy()
+    assert pm3.state.payload.status == "disconnected"
+    # Still retrying, and back once a client starts
+    pm3.devices[0].command = fake_pm3
+    wait_for(lambda: pm3.devices[0].status == "connected")
+    assert pm3.healthy()